@@ -0,0 +1,104 @@
+import array
+
+# Rolling statistics of sensor readings with constant memory,
+# last `size` samples are kept in an array, mean/min/max are of the window,
+# EMA and total count are of all samples
+#
+#   agg = Aggregator({"pm2_5": 60, "hcho_ug": 12})
+#   agg.add("pm2_5", 12)
+#   agg.mean("pm2_5")
+
+
+class Rolling:
+    def __init__(self, size=60, alpha=0.2):
+        self.size = size
+        self.alpha = alpha                          # EMA weight of new sample
+        self.values = array.array("f", [0] * size)
+        self.idx = 0                                # next write position
+        self.count = 0                              # samples in window
+        self.total = 0                              # samples since created
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.ema = None
+
+    def reset(self):
+        self.idx = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.ema = None
+
+    def add(self, value):
+        old = None
+        if self.count == self.size:
+            old = self.values[self.idx]
+        else:
+            self.count += 1
+        self.values[self.idx] = value
+        # float32 in array, read back so sum/min/max match the window
+        value = self.values[self.idx]
+        self.idx += 1
+        if self.idx == self.size:
+            self.idx = 0
+        self.total += 1
+        if old is None:
+            self.sum += value
+        else:
+            self.sum += value - old
+        if self.idx == 0:
+            # every round recalculate, no float error piles up
+            self.sum = sum(self.values)
+        if self.ema is None:
+            self.ema = value
+        else:
+            self.ema += self.alpha * (value - self.ema)
+        if self.min is None or value <= self.min:
+            self.min = value
+        elif old is not None and old == self.min:
+            self.min = self._scan(min)
+        if self.max is None or value >= self.max:
+            self.max = value
+        elif old is not None and old == self.max:
+            self.max = self._scan(max)
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.sum / self.count
+
+    def stats(self):
+        return {
+            "mean": self.mean(),
+            "min": self.min,
+            "max": self.max,
+            "ema": self.ema,
+            "count": self.count,
+            "total": self.total
+        }
+
+    def _scan(self, func):
+        # only when the window is full and the min/max sample leaves it
+        return func(self.values)
+
+
+class Aggregator:
+    def __init__(self, channels, alpha=0.2):
+        # channels: {name: window size}
+        self.channels = {}
+        for name in channels:
+            self.channels[name] = Rolling(channels[name], alpha)
+
+    def add(self, name, value):
+        self.channels[name].add(value)
+
+    def get(self, name):
+        return self.channels[name]
+
+    def mean(self, name):
+        return self.channels[name].mean()
+
+    def reset(self):
+        for name in self.channels:
+            self.channels[name].reset()
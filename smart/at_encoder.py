@@ -0,0 +1,184 @@
+import json
+
+# Write the escaped AT+TCMQTTPUB report command into one reusable bytearray,
+# the output is the same as json.dumps + escape `"` and `,` in Explorer_AT before:
+# floats as repr(), non ASCII as \uXXXX. Only NaN and inf differ, they are
+# written as null, json.dumps writes NaN/Infinity which are not JSON
+
+_MID = b'\\"\\, \\"method\\": \\"report\\"\\, \\"params\\": {'
+_TIMESTAMP = b'\\"\\, \\"timestamp\\": '
+_MID_TS = b'\\, \\"method\\": \\"report\\"\\, \\"params\\": {'
+_SEP = b'\\, '
+_COLON = b': '
+_QUOTE = b'\\"'
+_END = b'}}"\r\n'
+_HEX = b"0123456789abcdef"
+
+
+class Report_Encoder:
+    def __init__(self, size=1024):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.n = 0
+        self._topic = None
+        self._prefix = b""
+
+    def report(self, product_key, device_name, send_id, data, timestamp=None):
+        # @return memoryview of command, with "\r\n", valid until next call
+        self.n = 0
+        self._put_bytes(self._get_prefix(product_key, device_name))
+        self._put_uint(send_id, 12)
+        if timestamp is None:
+            self._put_bytes(_MID)
+        else:
+            self._put_bytes(_TIMESTAMP)
+            self._put_uint(timestamp)
+            self._put_bytes(_MID_TS)
+        first = True
+        for key in data:
+            if not first:
+                self._put_bytes(_SEP)
+            first = False
+            self._put_item(key, data[key])
+        self._put_bytes(_END)
+        return self.mv[:self.n]
+
+    def base_len(self, product_key, device_name, timestamp=False):
+        # command length without params and "\r\n", timestamp counted as 13 digits (ms)
+        length = len(self._get_prefix(product_key, device_name)) + 12 + len(_MID) + len(_END) - 2
+        if timestamp:
+            length += len(_TIMESTAMP) + 13 + len(_MID_TS) - len(_MID)
+        return length
+
+    def item_len(self, key, value):
+        # length of one param in the command, with separator
+        start = self.n
+        self._put_item(key, value)
+        length = self.n - start + len(_SEP)
+        self.n = start
+        return length
+
+    def _get_prefix(self, product_key, device_name):
+        if self._topic != (product_key, device_name):
+            self._topic = (product_key, device_name)
+            self._prefix = 'AT+TCMQTTPUB="$thing/up/property/{}/{}",1,"{{\\"clientToken\\": \\"msgpub-token-'.format(
+                product_key, device_name).encode()
+        return self._prefix
+
+    def _put_item(self, key, value):
+        self._put_str(key)
+        self._put_bytes(_COLON)
+        self._put_value(value)
+
+    def _put_value(self, value):
+        if value is True:
+            self._put_bytes(b"true")
+        elif value is False:
+            self._put_bytes(b"false")
+        elif value is None:
+            self._put_bytes(b"null")
+        elif type(value) == int:
+            self._put_int(value)
+        elif type(value) == float:
+            self._put_float(value)
+        elif type(value) == str:
+            self._put_str(value)
+        else:
+            # list, dict etc. are not used by reports now, allocate
+            value = json.dumps(value)
+            for ch in value:
+                if ch == '"':
+                    self._put_bytes(_QUOTE)
+                elif ch == ',':
+                    self._put_bytes(b"\\,")
+                else:
+                    self._put_char(ch)
+
+    def _put_byte(self, b):
+        if self.n >= len(self.buf):
+            raise Exception("report too long, max: {}".format(len(self.buf)))
+        self.buf[self.n] = b
+        self.n += 1
+
+    def _put_bytes(self, data):
+        end = self.n + len(data)
+        if end > len(self.buf):
+            raise Exception("report too long, max: {}".format(len(self.buf)))
+        self.buf[self.n:end] = data
+        self.n = end
+
+    def _put_char(self, ch):
+        # printable ASCII as is, others as \uXXXX like json.dumps
+        c = ord(ch)
+        if 0x20 <= c < 0x7F:
+            self._put_byte(c)
+        elif c > 0xFFFF:
+            c -= 0x10000
+            self._put_escape(0xD800 | (c >> 10))
+            self._put_escape(0xDC00 | (c & 0x3FF))
+        else:
+            self._put_escape(c)
+
+    def _put_escape(self, c):
+        self._put_bytes(b"\\u")
+        self._put_byte(_HEX[c >> 12])
+        self._put_byte(_HEX[(c >> 8) & 0x0F])
+        self._put_byte(_HEX[(c >> 4) & 0x0F])
+        self._put_byte(_HEX[c & 0x0F])
+
+    def _put_uint(self, value, width=0):
+        digits = 1
+        t = value
+        while t >= 10:
+            t //= 10
+            digits += 1
+        while width > digits:
+            self._put_byte(0x30)
+            width -= 1
+        end = self.n + digits
+        if end > len(self.buf):
+            raise Exception("report too long, max: {}".format(len(self.buf)))
+        i = end - 1
+        while i >= self.n:
+            self.buf[i] = 0x30 + value % 10
+            value //= 10
+            i -= 1
+        self.n = end
+
+    def _put_int(self, value):
+        if value < 0:
+            self._put_byte(0x2D)
+            value = -value
+        self._put_uint(value)
+
+    def _put_float(self, value):
+        if value != value or value in (float("inf"), float("-inf")):
+            self._put_bytes(b"null")
+            return
+        # shortest repr like json.dumps, one small str
+        self._put_bytes(repr(value).encode())
+
+    def _put_str(self, value):
+        # json escape first, then `"` and `,` escape for AT command
+        self._put_bytes(_QUOTE)
+        for ch in value:
+            if ch == '"':
+                self._put_byte(0x5C)
+                self._put_bytes(_QUOTE)
+            elif ch == ',':
+                self._put_bytes(b"\\,")
+            elif ch == '\\':
+                self._put_bytes(b"\\\\")
+            elif ch == '\n':
+                self._put_bytes(b"\\n")
+            elif ch == '\r':
+                self._put_bytes(b"\\r")
+            elif ch == '\t':
+                self._put_bytes(b"\\t")
+            elif ch == '\b':
+                self._put_bytes(b"\\b")
+            elif ch == '\f':
+                self._put_bytes(b"\\f")
+            else:
+                self._put_char(ch)
+        self._put_bytes(_QUOTE)
@@ -0,0 +1,128 @@
+import array
+import json
+
+# Latency histogram, fail and timeout counts of every AT command verb,
+# verb is the command before "=", e.g. AT+TCMQTTPUB, AT+CIFSR
+#
+#   metrics.record("AT+CIFSR", 12, True)
+#   print(metrics.dump())
+
+BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000) # ms, upper bound, last bucket is over 10s
+
+# index of verb stats list
+_HIST = 0
+_COUNT = 1
+_FAIL = 2
+_TIMEOUT = 3
+_SUM = 4
+_MAX = 5
+
+
+class AT_Metrics:
+    def __init__(self, max_verbs=16):
+        self.max_verbs = max_verbs    # more verbs are counted as "other"
+        self.verbs = {}               # verb: [hist, count, fail, timeout, sum ms, max ms]
+
+    def reset(self):
+        self.verbs = {}
+
+    def record(self, cmd, ms, ok, reason=None):
+        verb = cmd.split("=", 1)[0]
+        stats = self.verbs.get(verb)
+        if not stats:
+            if len(self.verbs) >= self.max_verbs:
+                verb = "other"
+                stats = self.verbs.get(verb)
+            if not stats:
+                stats = [array.array("I", [0] * (len(BUCKETS) + 1)), 0, 0, 0, 0, 0]
+                self.verbs[verb] = stats
+        i = 0
+        while i < len(BUCKETS) and ms > BUCKETS[i]:
+            i += 1
+        stats[_HIST][i] += 1
+        stats[_COUNT] += 1
+        stats[_SUM] += ms
+        if ms > stats[_MAX]:
+            stats[_MAX] = ms
+        if reason == "timeout":
+            stats[_TIMEOUT] += 1
+        elif not ok:
+            stats[_FAIL] += 1
+
+    def percentile(self, verb, p):
+        # upper bound of the bucket, max for the last bucket, ms
+        stats = self.verbs.get(verb)
+        if not stats or not stats[_COUNT]:
+            return 0
+        need = stats[_COUNT] * p
+        n = 0
+        for i in range(len(BUCKETS)):
+            n += stats[_HIST][i]
+            if n >= need:
+                return min(BUCKETS[i], stats[_MAX])
+        return stats[_MAX]
+
+    def to_dict(self):
+        data = {}
+        for verb in self.verbs:
+            stats = self.verbs[verb]
+            data[verb] = {
+                "n": stats[_COUNT],
+                "fail": stats[_FAIL],
+                "timeout": stats[_TIMEOUT],
+                "avg": stats[_SUM] // stats[_COUNT] if stats[_COUNT] else 0,
+                "max": stats[_MAX],
+                "p50": self.percentile(verb, 0.5),
+                "p95": self.percentile(verb, 0.95),
+                "hist": list(stats[_HIST])
+            }
+        return data
+
+    def dump(self):
+        # for REPL, buckets: BUCKETS
+        return json.dumps({"buckets": BUCKETS, "verbs": self.to_dict()})
+
+    def summary(self, max_len=200):
+        # compact string for cloud report, "verb:n/p50/p95/fail/timeout;..."
+        # verbs with more calls first, cut to max_len
+        verbs = sorted(self.verbs.keys(), key=lambda v: -self.verbs[v][_COUNT])
+        items = []
+        length = 0
+        for verb in verbs:
+            stats = self.verbs[verb]
+            item = "{}:{}/{}/{}/{}/{}".format(short_verb(verb), stats[_COUNT], self.percentile(verb, 0.5),
+                                              self.percentile(verb, 0.95), stats[_FAIL], stats[_TIMEOUT])
+            if length + len(item) + 1 > max_len:
+                break
+            items.append(item)
+            length += len(item) + 1
+        return ";".join(items)
+
+    def lines(self):
+        # text lines for LCD diagnostics page
+        lines = ["{:<12}{:>6}{:>6}{:>6}{:>6}{:>5}{:>5}".format("cmd", "n", "p50", "p95", "max", "fail", "tout")]
+        verbs = sorted(self.verbs.keys(), key=lambda v: -self.verbs[v][_COUNT])
+        for verb in verbs:
+            stats = self.verbs[verb]
+            lines.append("{:<12}{:>6}{:>6}{:>6}{:>6}{:>5}{:>5}".format(
+                short_verb(verb)[:11], stats[_COUNT], self.percentile(verb, 0.5), self.percentile(verb, 0.95),
+                stats[_MAX], stats[_FAIL], stats[_TIMEOUT]))
+        return lines
+
+    def draw(self, img, x=0, y=0, color=(255, 255, 255)):
+        img.draw_string(x, y, "AT command latency (ms)", color=color)
+        y += 20
+        for line in self.lines():
+            if y > img.height() - 16:
+                break
+            img.draw_string(x, y, line, color=color)
+            y += 16
+        return img
+
+
+def short_verb(verb):
+    if verb.startswith("AT+TC"):
+        return verb[5:]
+    if verb.startswith("AT+"):
+        return verb[3:]
+    return verb
@@ -0,0 +1,234 @@
+# Split the AT byte stream into lines, every complete line is decoded once
+# and kept in a fixed size ring until it's read out. Empty lines are dropped,
+# the byte size of a line and the line breaks before it are kept for
+# RcvPub_Framer, which counts the payload in bytes
+
+
+class AT_Parser:
+    def __init__(self, line_max=512, lines_max=16):
+        self._part = bytearray(line_max)   # unfinished line
+        self._part_len = 0
+        self._lines = [None] * lines_max
+        self._sizes = [0] * lines_max      # bytes of line before decode
+        self._seps = [None] * lines_max    # line breaks before line, dropped empty lines included
+        self._sep = ""                     # line breaks since the last line
+        self.line_size = 0                 # of the line last read
+        self.line_sep = ""
+        self._head = 0
+        self._tail = 0
+        self._count = 0
+        self.dropped = 0                   # lines dropped because ring is full
+        self.truncated = 0                 # lines longer than line_max
+        self.decode_errors = 0
+
+    def reset(self):
+        self._part_len = 0
+        self._sep = ""
+        for i in range(len(self._lines)):
+            self._lines[i] = None
+            self._seps[i] = None
+        self._head = 0
+        self._tail = 0
+        self._count = 0
+
+    def any(self):
+        return self._count
+
+    def feed(self, data, start=0):
+        # stop when the ring is full, return the position to continue from
+        while self._count < len(self._lines):
+            idx = data.find(b"\n", start)
+            if idx < 0:
+                self._append_part(data, start, len(data))
+                return len(data)
+            if self._part_len == 0:
+                line = data[start:idx]
+            else:
+                self._append_part(data, start, idx)
+                line = bytes(self._part[:self._part_len])
+                self._part_len = 0
+            if line.endswith(b"\r"):
+                line = line[:-1]
+                end = "\r\n"
+            else:
+                end = "\n"
+            if line:
+                self._push(line)
+                self._sep = end
+            else:
+                self._sep += end
+            start = idx + 1
+        return start
+
+    def readline(self):
+        if not self._count:
+            return None
+        line = self._lines[self._tail]
+        self.line_size = self._sizes[self._tail]
+        self.line_sep = self._seps[self._tail]
+        self._lines[self._tail] = None
+        self._seps[self._tail] = None
+        self._tail = (self._tail + 1) % len(self._lines)
+        self._count -= 1
+        return line
+
+    def _append_part(self, data, start, end):
+        n = end - start
+        if n <= 0:
+            return
+        space = len(self._part) - self._part_len
+        if n > space:
+            self.truncated += 1
+            n = space
+        if n > 0:
+            self._part[self._part_len:self._part_len + n] = data[start:start + n]
+            self._part_len += n
+
+    def _push(self, line):
+        size = len(line)
+        try:
+            line = line.decode()
+        except Exception:
+            self.decode_errors += 1
+            print("decode error: {}".format(line))
+            return
+        if self._count == len(self._lines):
+            # drop oldest line
+            self._tail = (self._tail + 1) % len(self._lines)
+            self._count -= 1
+            self.dropped += 1
+        self._lines[self._head] = line
+        self._sizes[self._head] = size
+        self._seps[self._head] = self._sep
+        self._head = (self._head + 1) % len(self._lines)
+        self._count += 1
+
+
+def match_line(line, tokens):
+    for token in tokens:
+        if line.startswith(token):
+            return True
+    return False
+
+
+
+class RcvPub_Framer:
+    # +TCMQTTRCVPUB:"<topic>",<len>,"<payload>", <len> is in bytes
+    # take lines from AT_Parser, payload with line breaks inside spans several lines,
+    # size and sep of every line are AT_Parser.line_size and line_sep.
+    # A frame with a wrong <len> never completes, a new frame, OK/ERROR or a
+    # +TCMQTT URC while busy drops it, not taken as payload
+    PREFIX = "+TCMQTTRCVPUB:"
+    BREAKS = ("OK", "ERROR")
+    URC = "+TCMQTT"
+
+    def __init__(self, max_len=1024):
+        self.max_len = max_len     # drop frames with longer payload
+        self._parts = []
+        self._got = 0              # payload bytes got
+        self._need = -1            # payload length of unfinished frame, -1: no frame
+        self._topic = None
+        self.frames = 0
+        self.dropped = 0
+
+    def busy(self):
+        return self._need >= 0
+
+    def feed(self, line, size=None, sep="\r\n"):
+        # return (topic, payload) of a complete frame, or None
+        if size is None:
+            size = len(line)
+        if self._need >= 0:
+            if not self._breaks(line):
+                return self._feed_more(line, size, sep)
+            self._parts = []
+            self._drop("short, cut by " + line)
+        if not line.startswith(self.PREFIX):
+            return None
+        start = len(self.PREFIX)
+        if line[start:start + 1] == '"':
+            end = line.find('",', start + 1)
+            if end < 0:
+                return self._drop(line)
+            topic = line[start + 1:end]
+            end += 1
+        else:
+            end = line.find(',', start)
+            if end < 0:
+                return self._drop(line)
+            topic = line[start:end]
+        len_end = line.find(',"', end + 1)
+        if len_end < 0:
+            return self._drop(line)
+        try:
+            length = int(line[end + 1:len_end])
+        except Exception:
+            return self._drop(line)
+        if length > self.max_len:
+            return self._drop(line)
+        self._topic = topic
+        start = len_end + 2
+        rest = line[start:]
+        if size != len(line):
+            # not ASCII, the prefix may be too
+            size -= len(line[:start].encode())
+        else:
+            size -= start
+        return self._take(rest, size, length)
+
+    def _take(self, rest, size, length):
+        # payload is `length` bytes, the closing quote must be right after it
+        if size > length:
+            payload, quote = _cut(rest, size, length)
+            if quote != '"':
+                return self._drop(rest)
+            self._need = -1
+            self.frames += 1
+            return (self._topic, payload)
+        self._parts = [rest]
+        self._got = size
+        self._need = length
+        return None
+
+    def _breaks(self, line):
+        return line in self.BREAKS or line.startswith(self.URC)
+
+    def _feed_more(self, line, size, sep):
+        got = self._got + len(sep)
+        if got + size >= self._need + 1:
+            n = self._need - got
+            quote = None
+            if n >= 0:
+                head, quote = _cut(line, size, n)
+            if quote != '"':
+                self._parts = []
+                return self._drop(line)
+            self._parts.append(sep)
+            self._parts.append(head)
+            payload = "".join(self._parts)
+            self._parts = []
+            self._need = -1
+            self.frames += 1
+            return (self._topic, payload)
+        self._parts.append(sep)
+        self._parts.append(line)
+        self._got = got + size
+        return None
+
+    def _drop(self, line):
+        self._need = -1
+        self.dropped += 1
+        print("--[error] drop frame:", line)
+        return None
+
+
+def _cut(text, size, n):
+    # first n bytes of text (size bytes in utf-8) and the char after them,
+    # (None, None) if n is inside a char
+    if size == len(text):
+        return text[:n], text[n:n + 1]
+    raw = text.encode()
+    try:
+        return raw[:n].decode(), raw[n:n + 1].decode()
+    except UnicodeError:
+        return None, None
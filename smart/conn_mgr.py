@@ -0,0 +1,159 @@
+import time
+try:
+    import urandom as random
+except ImportError:
+    import random
+from explorer import PRIO_HIGH
+
+# Bring the connection to the server up step by step without blocking,
+# every step is one or more Explorer_AT.cmd_async() commands, a failed step
+# is retried after an exponential backoff with jitter.
+
+STATE_NO_WIFI = 0
+STATE_WIFI_UP = 1
+STATE_CONFIGURED = 2
+STATE_MQTT_CONNECTED = 3
+STATE_SUBSCRIBED = 4
+STATE_NAMES = ("no wifi", "wifi up", "configured", "mqtt connected", "subscribed")
+
+
+class Conn_Manager:
+    def __init__(self, explorer, product_key, device_name, device_key, product_secret=None, on_state=None):
+        self.explorer = explorer
+        self.product_key = product_key
+        self.device_name = device_name
+        self.device_key = device_key
+        self.product_secret = product_secret
+        self.on_state = on_state        # on_state(state, ip)
+        self.state = STATE_NO_WIFI
+        self.ip = ""
+        self.wifi_poll_interval = 2000  # ms, AT+CIFSR interval when no IP
+        self.backoff_min = 1000         # ms
+        self.backoff_max = 60000        # ms
+        self.check_interval = 30000     # ms, AT+TCMQTTSTATE? when connected
+        self.fails = 0
+        self._next_t = time.ticks_ms()
+        self._busy = False
+        self._steps = []
+        self._on_done = None
+        self._gen = 0                   # acks of commands sent before reset are ignored
+
+    def reset(self):
+        # start again from AT+CIFSR, e.g. after smartconfig
+        self.fails = 0
+        self._next_t = time.ticks_ms()
+        self._steps = []
+        self._busy = False
+        self._gen += 1
+        self.explorer.online = False
+        self._set_state(STATE_NO_WIFI)
+
+    def connected(self):
+        return self.state == STATE_SUBSCRIBED
+
+    def run(self):
+        if self.state == STATE_SUBSCRIBED and not self._busy and not self.explorer.online:
+            print("--connection lost")
+            self._next_t = time.ticks_ms()
+            self._set_state(STATE_NO_WIFI)
+        if self._busy or time.ticks_ms() - self._next_t < 0:
+            return
+        state = self.state
+        if state == STATE_SUBSCRIBED:
+            if not self.explorer.queue and not self.explorer.pending:
+                self._start([("AT+TCMQTTSTATE?", ["+TCMQTTSTATE:"], ["ERROR"], 2)], self._on_mqtt_state)
+            return
+        if state == STATE_NO_WIFI:
+            self._start([("AT+CIFSR", ["OK"], ["ERROR"], 2)], self._on_ip)
+        elif state == STATE_WIFI_UP:
+            info = (self.product_key, self.device_name, self.device_key, self.product_secret)
+            if self.explorer.configured == info:
+                # device info not changed, no need to set again
+                self._set_state(STATE_CONFIGURED)
+                return
+            self._start(self.explorer.config_cmds(*info), self._on_configured)
+        elif state == STATE_CONFIGURED:
+            self._start(self.explorer.connect_cmds()[:1], self._on_mqtt_connected)
+        elif state == STATE_MQTT_CONNECTED:
+            self._start(self.explorer.connect_cmds()[1:], self._on_subscribed)
+
+    def _on_ip(self, ack):
+        ip = self.explorer.parse_ip(ack)
+        if ip:
+            self.ip = ip
+            self._set_state(STATE_WIFI_UP)
+        else:
+            self._next_t = time.ticks_ms() + self.wifi_poll_interval
+            if self.ip:
+                self.ip = ""
+                self._notify()
+
+    def _on_configured(self, ack):
+        self.explorer.set_device(self.product_key, self.device_name, self.device_key, self.product_secret)
+        self._set_state(STATE_CONFIGURED)
+
+    def _on_mqtt_connected(self, ack):
+        self._set_state(STATE_MQTT_CONNECTED)
+
+    def _on_subscribed(self, ack):
+        self.fails = 0
+        self.explorer.online = True
+        self._set_state(STATE_SUBSCRIBED)
+
+    def _on_mqtt_state(self, ack):
+        # +TCMQTTSTATE:1 connected
+        self._next_t = time.ticks_ms() + self.check_interval
+        if "+TCMQTTSTATE:0" in ack:
+            self.explorer.online = False
+
+    def _start(self, steps, on_done):
+        self._busy = True
+        self._steps = list(steps)
+        self._on_done = on_done
+        self._send_step()
+
+    def _send_step(self):
+        cmd, expected, fail_ack, timeout = self._steps.pop(0)
+        gen = self._gen
+        self.explorer.cmd_async(cmd, expected, fail_ack, timeout, priority=PRIO_HIGH,
+                                callback=lambda ok, ack: self._on_ack(ok, ack, gen))
+
+    def _on_ack(self, ok, ack, gen):
+        if gen != self._gen:
+            return
+        if not ok:
+            self._busy = False
+            self._fail(ack)
+            return
+        if self._steps:
+            self._send_step()
+            return
+        self._busy = False
+        self._on_done(ack)
+
+    def _fail(self, ack):
+        if self.state == STATE_SUBSCRIBED:
+            # state query not supported or fail, keep connection, check later
+            self._next_t = time.ticks_ms() + self.check_interval
+            return
+        self.fails += 1
+        delay = min(self.backoff_max, self.backoff_min << min(self.fails - 1, 16))
+        # half fixed, half random, so devices don't retry at the same time
+        delay = delay // 2 + (delay // 2) * random.getrandbits(8) // 255
+        self._next_t = time.ticks_ms() + delay
+        print("--[ERROR] {} fail {} times, retry after {}ms: {}".format(STATE_NAMES[self.state], self.fails, delay, ack))
+        if self.state != STATE_NO_WIFI:
+            self._set_state(STATE_NO_WIFI)
+
+    def _set_state(self, state):
+        if state != STATE_SUBSCRIBED:
+            self.explorer.online = False
+        changed = state != self.state
+        self.state = state
+        if changed:
+            print("--conn state:", STATE_NAMES[state])
+            self._notify()
+
+    def _notify(self):
+        if self.on_state:
+            self.on_state(self.state, self.ip)
@@ -2,23 +2,27 @@ import time, os
 import json
 import ure
 import image, lcd
-from explorer import Explorer_AT
+from explorer import Explorer_AT, PRIO_HIGH
+from conn_mgr import Conn_Manager, STATE_SUBSCRIBED
 from Maix import GPIO
 from machine import UART
 from fpioa_manager import fm
 from pms7003 import PMS7003
 from ws_h3 import WS_H3
 from face import Face_Recog
-import gc
-import ubinascii
+from face_store import Face_Store, migrate_json
+from uart_capture import Capture_Log
 
 
 class App:
-    def __init__(self, product_key, device_name, device_key, product_secret=None):
+    def __init__(self, product_key, device_name, device_key, product_secret=None, uart_baud=115200, capture=None):
         self.product_key = product_key
         self.device_name = device_name
         self.device_key = device_key
         self.product_secret = product_secret
+        self.uart_baud = uart_baud
+        # record uart traffic to file for tools/replay_uart.py, e.g. "/sd/uart.cap"
+        self.capture = Capture_Log(capture) if capture else None
 
     def init0(self):
         fm.register(8, fm.fpioa.GPIOHS1, force=True)
@@ -32,18 +36,27 @@ class App:
         self.led_b=GPIO(GPIO.GPIOHS6, GPIO.OUT)
         self.button=GPIO(GPIO.GPIOHS3, GPIO.PULL_UP)
         self.uart = UART(UART.UART2,115200,timeout=1000, read_buf_len=4096)
+        if self.capture:
+            self.uart = self.capture.wrap(self.uart, "explorer")
 
         self.led_g.value(1)
         self.led_b.value(1)
         self.wifi_rst_btn.value(1)
         lcd.init()
 
+        # device info set to the module is kept after an error, so Conn_Manager
+        # skips config when it's not changed
+        configured = self.explorer.configured if getattr(self, "explorer", None) else None
         self.explorer = Explorer_AT(self.uart, self.on_msg)
+        if configured:
+            self.explorer.set_device(*configured)
         self.smartconfiging = False
         self.wifi_ip = ""
         self.server_conn = False
         self.show_text = ""
         self.button_down_t = -1
+        self.show_diag = False # AT command metrics page on LCD
+        self._diag_t = 0
         self.explorer.data = {
             "door": 0,
             "last_user": "",
@@ -51,26 +64,26 @@ class App:
             "add_user": 0,
             "clear_users": 0
         }
+        self.explorer.priority = {
+            "door": PRIO_HIGH,
+            "last_user": PRIO_HIGH
+        }
 
         self._init_door()
 
 
     def _init_door(self):
         self.add_user_timeout = 60
-        self.users_conf_name = "door_users.json"
+        self.users_conf_name = "door_users.json" # old format, migrated to users_store_name
+        self.users_store_name = "door_users.bin"
         self.door_open_timeout = 5  # s
         self.door_open_interval = 8 # s
         self.door_open_t = -self.door_open_timeout
-        try:
-            self.face_recog.__del__()
-            del self.face_recog
-            gc.collect()
-        except Exception:
-            pass
+        if getattr(self, "face_recog", None):
+            # init0 again after an error, models, camera and users are kept
+            return
         self.face_recog = Face_Recog()
-        users, features = self.load_users()
-        print("load users:", users, len(features))
-        self.face_recog.set_users(users, features)
+        self.load_users()
 
 
     def add_user(self):
@@ -96,14 +109,10 @@ class App:
                     img.draw_rectangle((0,0, 320, 32), color=(255, 0, 0), fill=True)
                     img.draw_string(100, 3, "record ok", color=(255, 255, 255), scale=2)
                     self.show(img=img)
-                    users, features = self.face_recog.get_users()
-                    user = "No.{}".format(len(users) + 1)
+                    user = "No.{}".format(self.face_recog.gallery.count + 1)
                     print("add user:{}, feature:{}".format(user, feature))
-                    users.append(user)
-                    features.append(feature)
-                    self.face_recog.set_users(users, features)
-                    print("save features")
-                    self.save_users(users, features)
+                    self.users_store.append(user, feature)
+                    self.face_recog.add_user(user, feature)
                     print("save features ok")
                     time.sleep_ms(300)
                     print("add user ok:")
@@ -118,60 +127,25 @@ class App:
                 break
 
     def clear_users(self):
-        with open(self.users_conf_name, "w") as f:
-            info = {
-                "users": [],
-                "features": []
-            }
-            f.write(json.dumps(info))
-        self.face_recog.set_users([], [])        
+        self.users_store.clear()
+        self.face_recog.set_users([], [])
 
     def load_users(self):
-        files = os.listdir()
-        if not self.users_conf_name in files:
-            with open(self.users_conf_name, "w") as f:
-                info = {
-                    "users": [],
-                    "features": []
-                }
-                f.write(json.dumps(info))
-                return [], []
-        with open(self.users_conf_name) as f:
-            conf = f.read()
-            users = []
+        self.users_store = Face_Store(self.users_store_name)
+        if self.users_conf_name in os.listdir():
             try:
-                conf = json.loads(conf)
-                features = []
-                for i, fea in enumerate(conf['features']):
-                    fea = ubinascii.a2b_base64(fea)
-                    if fea: #TODO: length
-                        users.append(conf['users'][i])
-                        features.append(fea)
-                        print("decoded feature:", fea)
-                    else:
-                        print("user {}'s feature not valid".format(conf['users'][i]))
-            except Exception:
-                print("parse config file error")
-                return [], []
-            return users, features
-
-    def save_users(self, users, features):
-        feas_encode = []
-        for fea in features:
-            print("raw feature:", fea)
-            fea = ubinascii.b2a_base64(fea)
-            feas_encode.append(fea)
-        info = {
-            "users": users,
-            "features": feas_encode
-        }
-        with open(self.users_conf_name, "w") as f:
-            info = json.dumps(info)
-            f.write(info)
+                count = migrate_json(self.users_store, self.users_conf_name)
+                print("migrate {} users from {}".format(count, self.users_conf_name))
+            except Exception as e:
+                print("--[ERROR] migrate {} fail: {}".format(self.users_conf_name, e))
+        count = self.face_recog.load_users(self.users_store)
+        print("load users:", self.face_recog.gallery.names, count)
 
     def show(self, text=None, wifi_ip=None, server_conn=None, append=False, print_text=True, img=None):
         if img:
-            lcd.display(img)
+            # diagnostics page stays on LCD, recognition goes on
+            if not self.show_diag:
+                lcd.display(img)
             return
         if not text is None:
             if append:
@@ -228,41 +202,24 @@ class App:
             print("--report reply, id:{}, status:{}".format(msg["clientToken"], msg["status"]) )
 
 
-    def try_connect(self):
-        ip = self.explorer.get_ip()
-        self.show(wifi_ip=ip)
-        print("IP:", ip)
-        if ip:
-            text = "config..."
-            self.show(text=text, print_text=True)
-            self.explorer.config(self.product_key, self.device_name, self.device_key, self.product_secret)
-            text ="--config ok"
-            self.show(text=text, append=True, print_text=True)
-            text = "connect to server..."
-            self.show(text=text, append=True, print_text=True)
-            try:
-                self.explorer.connect()
-                self.show(text="connect to server ok", server_conn=True, append=True, print_text=True)
-                self.on_connect()
-            except Exception as e:
-                self.explorer.server_conn = False
-                print("--connect expoler fail: ", e)
-                self.show(text="connect server fail", server_conn=False, append=True, print_text=True)
-        else:
+    def on_conn_state(self, state, ip):
+        connected = state == STATE_SUBSCRIBED
+        self.show(wifi_ip=ip, server_conn=connected)
+        if connected:
+            self.show(text="connect to server ok", append=True, print_text=True)
+            self.on_connect()
+        elif not ip:
             print("no IP, wait or long push func button to start config WiFi")
             text = "Wait or long push button to config WiFi"
             self.show(text=text)
 
     def on_connect(self):
         keys = list(self.explorer.data.keys())
-        keys = [keys[:len(keys)//2], keys[len(keys)//2:]]
         print("on_connect", keys)
-        self.explorer.notify_report(keys)
+        self.explorer.notify_report(keys, force=True)
 
     def main_loop(self):
-        if not self.wifi_ip or not self.server_conn:
-            time.sleep_ms(2000)
-            self.try_connect()
+        self.conn.run()
 
         if self.button.value() == 0:
             time.sleep_ms(20)
@@ -288,14 +245,23 @@ class App:
                             except Exception:
                                 print("--[ERROR] smartconfig fail")
                                 self.show(wifi_ip="null", server_conn=False)
+                            self.conn.reset() # connect to server again
                             self.set_hint_led(False)
                             self.smartconfiging = False
         else:
+            if self.button_down_t >= 0 and time.ticks_ms() - self.button_down_t < 1000:
+                # short push, switch diagnostics page
+                self.show_diag = not self.show_diag
+                self.show_update()
             self.button_down_t = -1
+            if self.show_diag and time.ticks_ms() - self._diag_t > 1000:
+                self.show_update()
             # sensors
             if self.server_conn:
                 # door face recognzaition
                 self.face_recog.run(self.on_detect, self.on_img, self.on_clear)
+        if self.capture:
+            self.capture.run()
         # door auto close
         if time.ticks_ms() - self.door_open_t * 1000 > self.door_open_timeout * 1000:
             if self.is_door_open():
@@ -313,7 +279,8 @@ class App:
         self.show(img=img)
 
     def on_clear(self):
-        self.show()
+        if not self.show_diag:
+            self.show()
 
     def get_pannel(self):
         img = image.Image(size=(320, 240))
@@ -329,6 +296,13 @@ class App:
         return img
 
     def show_update(self):
+        if self.show_diag:
+            self._diag_t = time.ticks_ms()
+            img = image.Image(size=(320, 240))
+            self.explorer.metrics.draw(img)
+            lcd.display(img)
+            del img
+            return
         pos = (0, 40)
         color = (255, 255, 255)
         scale = 1
@@ -345,12 +319,15 @@ class App:
         self.show(text=text)
         self.explorer.wifi_reset(self.wifi_rst_btn)
         print("reset ok")
+        self.explorer.set_baud(self.uart_baud, self.wifi_rst_btn)
         if not self.device_name:
             mac = self.explorer.get_mac()
             if not mac:
                 raise Exception("can not get MAC address")
             self.device_name = mac.replace(":", "_")
         print("device name:", self.device_name)
+        self.conn = Conn_Manager(self.explorer, self.product_key, self.device_name, self.device_key,
+                                 self.product_secret, on_state=self.on_conn_state)
 
         #print("reset config")
         #self.explorer.restore_config()
@@ -376,7 +353,9 @@ if __name__ == "__main__":
             "product_key": "",
             "device_name": "",
             "device_key": "",
-            "product_secret": "null"
+            "product_secret": "null",
+            "uart_baud": 115200,
+            "capture": ""
         }'''
         with open(config_name, "w") as f:
             f.write(config)
@@ -388,7 +367,8 @@ if __name__ == "__main__":
         import sys
         print("config:", config)
         sys.exit("config error, please config first at explorer.conf")
-    app = App(config["product_key"], config["device_name"], config["device_key"], config["product_secret"])
+    app = App(config["product_key"], config["device_name"], config["device_key"], config["product_secret"],
+              config.get("uart_baud", 115200), config.get("capture"))
 
     while 1:
         try:
@@ -1,39 +1,141 @@
 import time
 import json
 import ure
+from at_parser import AT_Parser, RcvPub_Framer, match_line
+from at_encoder import Report_Encoder
+from at_metrics import AT_Metrics
 
+EPOCH_OFFSET = 946684800 # s, MicroPython time.time() starts from 2000-01-01
+
+# command priority, smaller runs first
+PRIO_SYNC = 0   # blocking _cmd calls
+PRIO_HIGH = 1
+PRIO_NORMAL = 2
+PRIO_LOW = 3
+
+
+class AT_Cmd:
+    def __init__(self, cmd, expected, fail_ack, timeout, priority, deadline, callback):
+        self.cmd = cmd
+        self.expected = expected
+        self.fail_ack = fail_ack
+        self.timeout = timeout      # s, wait ack time after sent
+        self.priority = priority
+        self.deadline = deadline    # ticks ms, drop if still in queue after it, None: never
+        self.callback = callback    # callback(ok, ack)
+        self.encode = None          # encode() return command bytes, instead of cmd
+        self.report = None          # (send_id, report record) of AT+TCMQTTPUB
+        self.ack = []
+        self.sent_t = -1
+        self.done = False
+        self.ok = False
+
+    def ack_str(self):
+        return "\r\n".join(self.ack) + "\r\n"
 
 
 class Explorer_AT:
     def __init__(self, uart, on_msg):
         self.uart = uart
+        self.default_baud = 115200 # module baud after reset
+        self.baud = self.default_baud
         self.on_msg = on_msg
-        self.msg = b""
         self.product_key = None
         self.device_name = None
         self.device_key = None
+        self.product_secret = None
+        self.configured = None # device info set to module by config
         self.send_id = 0
         self.data = {}
-        self.data_changed_keys = []  # [ [], []]
+        self.dirty = {}        # changed keys to report, key: None
+        self.dirty_t = -1
+        self.report_debounce = 200 # ms, wait for more changes before report
+        self._dirty_notify = 0 # notify_report calls since last flush
+        self.max_cmd_len = 256 # AT firmware command buffer size
+        self.encoder = Report_Encoder(1024)
+        # data key: {"deadband": abs, "deadband_rel": ratio of last reported value,
+        #            "min_interval": s, "heartbeat": s}, all items are optional
+        self.policy = {}
+        self._reported = {}    # data key: [value, ticks ms] last reported (report_reply got)
+        self._queued = {}      # data key: value published, waiting for report_reply
+        self._heartbeat_t = time.ticks_ms()
+        self.report_stats = {
+            "notify": 0,       # notify_report calls
+            "suppressed": 0,   # keys not reported because of policy
+            "dup_keys": 0,     # keys notified again before reported
+            "publish": 0,      # publish sent
+            "saved": 0         # publish saved by coalescing
+        }
+        self.parser = AT_Parser(line_max=1200, lines_max=32)
+        self.framer = RcvPub_Framer(max_len=1024)
+        self.poll_interval = 2 # ms, sleep between uart polls to give CPU to others
+        self.queue = []        # AT_Cmd, sorted by priority
+        self.queue_max = 16    # not include PRIO_SYNC commands
+        self.pending = None    # AT_Cmd waiting for ack
+        self.echo = True       # module echoes commands (ATE1)
+        self._stale = False    # a command timed out, drop its late reply until the next echo
+        self.priority = {}     # data key: report priority, default PRIO_NORMAL
+        self.report_deadline = 30 # s, drop report if not sent in time
+        self.online = False    # MQTT connected
+        self.store = None      # Report_Store, keep reports of store_keys when offline
+        self.store_keys = []
+        self.replay_interval = 2000 # ms, one replay publish every interval at most
+        self.replay_batch = 8  # records read from store every time
+        self._replay_t = -self.replay_interval
+        self._replay_busy = False
+        self.replay_retries = 3 # failed replays of the first stored records before they are skipped
+        self._replay_fails = 0
+        self.window = 4        # reports published but not replied (report_reply) at most
+        self.reply_timeout = 10000 # ms, publish again if no report_reply
+        self.report_retries = 2
+        self.inflight = {}     # send_id: [sent ticks ms, data, callback, tries, timestamp, priority]
+        self._puback = []      # send_id waiting +TCMQTTPUB:OK/FAIL, in publish order
+        self._pub_fails = 0    # +TCMQTTPUB:FAIL got while a publish waits for OK
+        self.rtt_stats = {
+            "count": 0,        # report_reply received
+            "min": -1,         # ms, publish to report_reply
+            "max": 0,
+            "sum": 0,
+            "last": 0,
+            "retry": 0,        # publish again after reply timeout, ERROR or +TCMQTTPUB:FAIL
+            "lost": 0,         # no reply after all retries
+            "dropped": 0       # given up before sent, deadline or queue full
+        }
+        self.metrics = AT_Metrics()
+        self.metrics_key = None # data key to report metrics.summary(), None: not report
+        self.metrics_interval = 600 # s
+        self._metrics_t = time.ticks_ms()
 
     def config(self, product_key, device_name, device_key, product_secret=None):
+        for cmd in self.config_cmds(product_key, device_name, device_key, product_secret):
+            ack = self._cmd(*cmd)
+        self.set_device(product_key, device_name, device_key, product_secret)
+
+    def config_cmds(self, product_key, device_name, device_key, product_secret=None):
+        # [(cmd, expected, fail_ack, timeout), ...]
         if not product_secret:
             cmd = 'AT+TCDEVINFOSET=1,"{}","{}","{}"'.format(
                 product_key, device_name, device_key
             )
-            ack = self._cmd(cmd, ["+TCDEVINFOSET:OK"], timeout=3)
-        else: # auto register
-            cmd = 'AT+TCPRDINFOSET=1,"{}","{}","{}"'.format(
-                product_key, product_secret, device_name
-            )
-            cmd2 = 'AT+TCDEVREG'
-            ack = self._cmd(cmd, ["+TCPRDINFOSET:OK"], timeout=3)
-            ack = self._cmd(cmd2, ["+TCDEVREG:OK", "+TCDEVREG:FAIL,1021"], ["+TCDEVREG:FAIL"], timeout=15) # 1021 already registerd
+            return [(cmd, ["+TCDEVINFOSET:OK"], ["ERROR"], 3)]
+        # auto register
+        cmd = 'AT+TCPRDINFOSET=1,"{}","{}","{}"'.format(
+            product_key, product_secret, device_name
+        )
+        cmd2 = 'AT+TCDEVREG'
+        return [
+            (cmd, ["+TCPRDINFOSET:OK"], ["ERROR"], 3),
+            (cmd2, ["+TCDEVREG:OK", "+TCDEVREG:FAIL,1021"], ["+TCDEVREG:FAIL"], 15) # 1021 already registerd
+        ]
+
+    def set_device(self, product_key, device_name, device_key, product_secret=None):
+        # called after config success
         self.product_key = product_key
         self.device_name = device_name
         self.device_key = device_key
         self.product_secret = product_secret
-            
+        self.configured = (product_key, device_name, device_key, product_secret)
+
     def restore_config(self):
         cmd = 'AT+TCRESTORE'
         ack = self._cmd(cmd, ["OK"], timeout=3)
@@ -54,25 +156,215 @@ class Explorer_AT:
         print("--now smartconfig end")
 
     def connect(self):
+        for cmd in self.connect_cmds():
+            ack = self._cmd(*cmd)
+        self.online = True
+
+    def connect_cmds(self):
         cmd = "AT+TCMQTTCONN=1,5000,240,1,1"
         cmd_sub = 'AT+TCMQTTSUB="$thing/down/property/{}/{}",0'.format(self.product_key, self.device_name)
-        ack = self._cmd(cmd, ["+TCMQTTCONN:OK"], ["+TCMQTTCONN:FAIL"], timeout=10)
-        ack = self._cmd(cmd_sub, ["+TCMQTTSUB:OK"], ["+TCMQTTSUB:FAIL", "ERROR"], timeout=10)
-
+        return [
+            (cmd, ["+TCMQTTCONN:OK"], ["+TCMQTTCONN:FAIL"], 10),
+            (cmd_sub, ["+TCMQTTSUB:OK"], ["+TCMQTTSUB:FAIL", "ERROR"], 10)
+        ]
 
-    def report_(self, data):
-        data = json.dumps(data)
-        cmd = '{}"clientToken": "msgpub-token-{}", "method": "report", "params": {}{}'.format(
-             "{", "{:012d}".format(self.send_id),
-            data, "}"
-        )
-        cmd = cmd.replace('"', '\\"')
-        cmd = cmd.replace(',', '\\,')
-        cmd = 'AT+TCMQTTPUB="$thing/up/property/{}/{}",1,"{}"'.format(self.product_key, self.device_name, cmd)
+    def report_(self, data, priority=PRIO_NORMAL, callback=None, block=False, timestamp=None):
+        # callback(ok, ack) is called when report_reply received, or failed after retries,
+        # block only waits until the module accepted the publish
+        send_id = self.send_id
         self.send_id += 1
-        ack = self._cmd(cmd, ["+TCMQTTPUB:OK"], timeout=10)
+        if block:
+            priority = PRIO_SYNC
+        elif not callback:
+            # measured now, or at timestamp (ms from 1970), kept if the report fails
+            ts = int(time.time()) if timestamp is None else timestamp // 1000 - EPOCH_OFFSET
+            callback = lambda ok, ack: self._on_report_ack(ok, ack, data, ts)
+        c = self._publish(send_id, [-1, data, callback, 0, timestamp, priority])
+        if block:
+            self._wait(c)
+
+    def _publish(self, send_id, rec):
+        rec[0] = -1     # not sent yet
+        deadline = None if rec[5] == PRIO_SYNC else self.report_deadline
+        c = self.cmd_async("AT+TCMQTTPUB", ["OK"], ["ERROR"], timeout=10, priority=rec[5], deadline=deadline,
+                           callback=lambda ok, ack: self._on_publish(ok, ack, send_id, rec))
+        c.report = (send_id, rec)
+        # encode when send, so only one command buffer is needed
+        c.encode = lambda: self.encoder.report(self.product_key, self.device_name, send_id, rec[1], rec[4])
+        return c
+
+    def _on_publish(self, ok, ack, send_id, rec):
+        # AT+TCMQTTPUB accepted by module or not, report_reply comes later
+        if rec[0] < 0:
+            # dropped before sent (deadline, queue full), FAIL got so far is of the pending publish
+            self.rtt_stats["dropped"] += 1
+            if rec[2]:
+                rec[2](False, ack)
+            return
+        fails = self._pub_fails
+        self._pub_fails = 0
+        if not ok:
+            # one of the FAIL got while sending is of this publish
+            fails -= 1
+        for i in range(fails):
+            self._on_puback_fail("+TCMQTTPUB:FAIL")
+        if ok:
+            self._puback.append(send_id)
+            return
+        if send_id in self.inflight:
+            # ERROR or no reply, publish again like +TCMQTTPUB:FAIL
+            self._retry(send_id, ack.strip().split("\r\n")[-1])
+
+    def _on_puback(self, line):
+        if not line.startswith("+TCMQTTPUB:FAIL"):
+            if self._puback:
+                self._puback.pop(0)
+            return
+        c = self.pending
+        if c and c.report:
+            # FAIL before OK, it's of this publish if ERROR follows, else of an older one,
+            # decide in _on_publish
+            c.ack.append(line)
+            self._pub_fails += 1
+            return
+        self._on_puback_fail(line)
+
+    def _on_puback_fail(self, line):
+        if not self._puback:
+            return
+        send_id = self._puback.pop(0)
+        if send_id in self.inflight:
+            self._retry(send_id, line)
+
+    def _on_report_reply(self, msg):
+        token = msg.get("clientToken", "")
+        if not token.startswith("msgpub-token-"):
+            return
+        try:
+            send_id = int(token[13:])
+        except ValueError:
+            return
+        rec = self.inflight.pop(send_id, None)
+        if not rec:
+            # reply of a publish already retried or given up
+            return
+        if send_id in self._puback:
+            self._puback.remove(send_id)
+        rtt = time.ticks_ms() - rec[0]
+        stats = self.rtt_stats
+        stats["count"] += 1
+        stats["sum"] += rtt
+        stats["last"] = rtt
+        stats["max"] = max(stats["max"], rtt)
+        if stats["min"] < 0 or rtt < stats["min"]:
+            stats["min"] = rtt
+        if rec[2]:
+            rec[2](msg.get("code", -1) == 0, "{}\r\n".format(msg.get("status", "")))
+
+    def _check_inflight(self):
+        now = time.ticks_ms()
+        for send_id in list(self.inflight.keys()):
+            if self.inflight[send_id][0] >= 0 and now - self.inflight[send_id][0] > self.reply_timeout:
+                self._retry(send_id, "reply timeout")
+
+    def _retry(self, send_id, reason):
+        rec = self.inflight.pop(send_id)
+        if send_id in self._puback:
+            self._puback.remove(send_id)
+        if rec[3] < self.report_retries and self.online:
+            rec[3] += 1
+            self.rtt_stats["retry"] += 1
+            print("--[WARNING] report {} retry {}: {}".format(send_id, rec[3], reason))
+            # same send_id, so a late reply of the last publish still counts
+            self._publish(send_id, rec)
+            return
+        self.rtt_stats["lost"] += 1
+        if rec[2]:
+            rec[2](False, reason)
+
+    def _on_report_ack(self, ok, ack, data=None, ts=None):
+        if data:
+            now = time.ticks_ms()
+            for key in data:
+                if key in self._queued and self._queued[key] == data[key]:
+                    del self._queued[key]
+                if ok:
+                    self._reported[key] = [data[key], now]
+        if ok:
+            print("--report success")
+        else:
+            print("--[ERROR] report fail:", ack)
+            if data:
+                self._store(data, ts)
+
+    def _store(self, data, ts=None):
+        if not self.store:
+            return
+        data0 = {}
+        for key in self.store_keys:
+            if key in data:
+                data0[key] = data[key]
+        if data0:
+            if ts is None:
+                ts = int(time.time())
+            self.store.append(ts, data0)
+
+    def _replay(self):
+        if self._replay_busy or self.queue or self.pending or \
+                time.ticks_ms() - self._replay_t < self.replay_interval:
+            return
+        self._replay_t = time.ticks_ms()
+        records = self.store.peek(self.replay_batch)
+        if not records:
+            return
+        # merge records into one publish until a key repeats or it's too long
+        ts = records[0][0]
+        data = {}
+        length = self.encoder.base_len(self.product_key, self.device_name, timestamp=True)
+        pos = None
+        n = 0
+        for rec in records:
+            item_len = 0
+            for key in rec[1]:
+                if key in data:
+                    item_len = -1
+                    break
+                item_len += self.encoder.item_len(key, rec[1][key])
+            if item_len < 0 or (data and length + item_len > self.max_cmd_len):
+                break
+            data.update(rec[1])
+            length += item_len
+            pos = rec[2]
+            n += 1
+        timestamp = None
+        if ts >= 600000000: # clock is set (after 2019)
+            timestamp = (ts + EPOCH_OFFSET) * 1000
+
+        def on_ack(ok, ack):
+            self._replay_busy = False
+            if ok:
+                self._replay_fails = 0
+                self.store.commit(pos)
+                self.store.stats["replayed"] += n
+                return
+            if self.online:
+                # not counted if failed because of the connection
+                self._replay_fails += 1
+            print("--[ERROR] replay fail {}: {}".format(self._replay_fails, ack))
+            if self._replay_fails >= self.replay_retries:
+                # rejected again and again, don't block the records after them
+                print("--[ERROR] replay skip {} records".format(n))
+                self._replay_fails = 0
+                self.store.commit(pos)
+                self.store.stats["skipped"] += n
+        self._replay_busy = True
+        print("--replay:", data)
+        self.report_(data, PRIO_LOW, callback=on_ack, timestamp=timestamp)
 
     def wifi_reset(self, rest_button):
+        if self.baud != self.default_baud:
+            # AT+UART_CUR is not saved, module starts with default baud
+            self._init_uart(self.default_baud)
         rest_button.value(0)
         time.sleep_ms(200)
         rest_button.value(1)
@@ -89,6 +381,54 @@ class Explorer_AT:
                 raise Exception("reset timeout")
         time.sleep_ms(200)
         read = self.uart.read()
+        self.parser.reset()
+        self._stale = False
+
+    def set_baud(self, baud, rest_button=None):
+        # change baud of module and K210 side, check with `AT`, change back if fail,
+        # call after wifi_reset, @return baud in use
+        if baud == self.baud:
+            return baud
+        old = self.baud
+        try:
+            self._cmd("AT+UART_CUR={},8,1,0,0".format(baud), ["OK"], timeout=2)
+        except Exception as e:
+            print("--[ERROR] set baud {} fail: {}".format(baud, e))
+            return self.baud
+        # OK is sent with old baud, module switches after it
+        time.sleep_ms(20)
+        self._init_uart(baud)
+        if self._check_link():
+            print("--baud:", baud)
+            return baud
+        print("--[ERROR] baud {} check fail, back to {}".format(baud, old))
+        if rest_button:
+            # can't talk to module at the new baud, reset it to default
+            self.wifi_reset(rest_button)
+        else:
+            self._init_uart(old)
+            self._check_link()
+        return self.baud
+
+    def _init_uart(self, baud):
+        self.uart.init(baud, 8, None, 1, timeout=1000, read_buf_len=4096)
+        self.baud = baud
+        self.uart.read()
+        self.parser.reset()
+        self._stale = False
+
+    def _check_link(self, tries=3):
+        for i in range(tries):
+            try:
+                self._cmd("AT", ["OK"], timeout=1)
+                return True
+            except Exception:
+                # drop garbage of the last try
+                time.sleep_ms(50)
+                self.uart.read()
+                self.parser.reset()
+                self._stale = False
+        return False
     
     def get_ip(self):
         cmd = "AT+CIFSR"
@@ -97,6 +437,9 @@ class Explorer_AT:
         except Exception as e:
             print("--[ERROR] AT ack erro:", e)
             return ""
+        return self.parse_ip(ack)
+
+    def parse_ip(self, ack):
         # 'AT+CIFSR\r\n+CIFSR:STAIP,"0.0.0.0"\r\n+CIFSR:STAMAC,"18:fe:34:de:a6:00"\r\n\r\nOK\r\n'
         mat = ure.match('.*CIFSR:STAIP\,"(.*)".*CIFSR.*', ack)
         if mat:
@@ -120,85 +463,262 @@ class Explorer_AT:
 
 
     def _cmd(self, cmd, expected=[], fail_ack=["ERROR"], timeout=6):
-        cmd += "\r\n"
-        self.uart.read()
-        self.uart.write(cmd.encode())
-        ack = ""
-        t = time.ticks_ms()
-        while 1:
-            read = self.uart.read()
-            if read:
-                try:
-                    read = read.decode()
-                    ack += read
-                except Exception as e:
-                    print("decode error: {}".format(read))
-                for msg in expected:
-                    if msg in ack:
-                        return ack
-                for msg in fail_ack:
-                    if msg in ack:
-                        break
-            if time.ticks_ms() - t > timeout * 1000:
-                break
-        raise Exception("cmd ack error: {}, ack: {}".format(cmd, ack))
+        c = self.cmd_async(cmd, expected, fail_ack, timeout, priority=PRIO_SYNC)
+        return self._wait(c)
+
+    def _wait(self, c):
+        while not c.done:
+            if not self.poll():
+                time.sleep_ms(self.poll_interval)
+        if not c.ok:
+            raise Exception("cmd ack error: {}, ack: {}".format(c.cmd, c.ack))
+        return c.ack_str()
+
+    def cmd_async(self, cmd, expected=[], fail_ack=["ERROR"], timeout=6, priority=PRIO_NORMAL, deadline=None, callback=None):
+        if deadline is not None:
+            deadline = time.ticks_ms() + int(deadline * 1000)
+        c = AT_Cmd(cmd, expected, fail_ack, timeout, priority, deadline, callback)
+        if priority != PRIO_SYNC and len(self.queue) >= self.queue_max:
+            # queue full, replace the last (lowest priority) one if this one is more important
+            if self.queue[-1].priority <= priority:
+                self._finish(c, False, "queue full")
+                return c
+            self._finish(self.queue.pop(), False, "queue full")
+        i = len(self.queue)
+        while i > 0 and self.queue[i - 1].priority > priority:
+            i -= 1
+        self.queue.insert(i, c)
+        return c
+
+    def poll(self):
+        # non-blocking: read uart, dispatch lines and send next command,
+        # return True if got data from uart
+        read = self.uart.read()
+        if read:
+            pos = 0
+            while pos < len(read):
+                pos = self.parser.feed(read, pos)
+                while self.parser.any():
+                    self._on_line(self.parser.readline())
+        c = self.pending
+        if c and time.ticks_ms() - c.sent_t > c.timeout * 1000:
+            self._finish(c, False, "timeout")
+            self._stale = self.echo
+        if self.inflight:
+            self._check_inflight()
+        if not self.pending:
+            self._send_next()
+        return bool(read)
+
+    def _send_next(self):
+        i = 0
+        while i < len(self.queue):
+            c = self.queue[i]
+            if c.deadline is not None and time.ticks_ms() > c.deadline:
+                self.queue.pop(i)
+                self._finish(c, False, "deadline")
+                continue
+            if c.report and len(self.inflight) >= self.window:
+                # wait for report_reply, other commands can go first
+                i += 1
+                continue
+            self.queue.pop(i)
+            self.pending = c
+            c.sent_t = time.ticks_ms()
+            if c.report:
+                c.report[1][0] = c.sent_t
+                self.inflight[c.report[0]] = c.report[1]
+            if c.encode:
+                self.uart.write(c.encode())
+            else:
+                self.uart.write((c.cmd + "\r\n").encode())
+            break
+
+    def _on_line(self, line):
+        if self.framer.busy() or line.startswith(RcvPub_Framer.PREFIX):
+            frame = self.framer.feed(line, self.parser.line_size, self.parser.line_sep)
+            if frame:
+                self._on_rcvpub(frame[0], frame[1])
+                return
+            if self.framer.busy() or line.startswith(RcvPub_Framer.PREFIX):
+                return
+            # OK/ERROR/URC cut a short frame, or rest of a broken frame,
+            # go on as a normal line
+        if line.startswith("+TCMQTTDISCON"):
+            self.online = False
+            c = self.pending
+            if not c or not (match_line(line, c.expected) or match_line(line, c.fail_ack)):
+                # URC, not a reply of the pending command
+                return
+        elif line.startswith("+TCMQTTPUB:"):
+            c = self.pending
+            if self._puback or not c or c.report or \
+                    not (match_line(line, c.expected) or match_line(line, c.fail_ack)):
+                # QoS1 puback, may come after other commands sent
+                self._on_puback(line)
+                return
+            # reply of AT+TCMQTTPUB sent by _cmd, no publish waits for it
+        c = self.pending
+        if not c:
+            return
+        if self._stale:
+            # lines before the echo are the late reply of the command timed out
+            if line != c.cmd and not (c.encode and line.startswith(c.cmd + "=")):
+                return
+            self._stale = False
+        c.ack.append(line)
+        if match_line(line, c.expected):
+            self._finish(c, True)
+        elif match_line(line, c.fail_ack):
+            self._finish(c, False)
+
+    def _finish(self, c, ok, reason=None):
+        if reason:
+            c.ack.append(reason)
+        if c.sent_t >= 0:
+            self.metrics.record(c.cmd, time.ticks_ms() - c.sent_t, ok, reason)
+        c.done = True
+        c.ok = ok
+        if c is self.pending:
+            self.pending = None
+        if c.callback:
+            c.callback(ok, c.ack_str())
+
+    def _on_rcvpub(self, topic, payload):
+        print("--msg:", topic, payload)
+        try:
+            pub_msg = json.loads(payload)
+        except Exception as e:
+            print(e)
+            print("--[error] pub msg decode error:{}".format(payload))
+            return
+        if pub_msg:
+            if pub_msg.get("method") == "report_reply":
+                self._on_report_reply(pub_msg)
+            self.on_msg(pub_msg)
+
+    def notify_report(self, keys, force=False):
+        self.report_stats["notify"] += 1
+        added = False
+        for key in keys:
+            if type(key) == list:
+                self.notify_report(key, force)
+                continue
+            if not force and not self._need_report(key):
+                self.report_stats["suppressed"] += 1
+                continue
+            if key in self.dirty:
+                self.report_stats["dup_keys"] += 1
+                continue
+            if not self.dirty:
+                self.dirty_t = time.ticks_ms()
+            self.dirty[key] = None
+            added = True
+        if added:
+            self._dirty_notify += 1
+
+    def _need_report(self, key):
+        policy = self.policy.get(key)
+        if not policy:
+            return True
+        value = self.data[key]
+        if key in self._queued and self._queued[key] == value:
+            # the same value is published already, wait for its report_reply
+            return False
+        last = self._reported.get(key)
+        if not last:
+            return True
+        elapsed = time.ticks_ms() - last[1]
+        heartbeat = policy.get("heartbeat")
+        if heartbeat and elapsed >= heartbeat * 1000:
+            return True
+        min_interval = policy.get("min_interval")
+        if min_interval and elapsed < min_interval * 1000:
+            return False
+        try:
+            delta = abs(value - last[0])
+        except TypeError:
+            return value != last[0]
+        band = max(policy.get("deadband", 0), abs(last[0]) * policy.get("deadband_rel", 0))
+        return delta > band
 
-    def notify_report(self, keys):
-        if not self.data_changed_keys:
-            self.data_changed_keys = list(keys)
-        else:
-            for item in keys:
-                self.data_changed_keys.append(item)
-    
     def report(self, keys):
         data = {}
         for key in keys:
             data[key] = self.data[key]
         print("--report:", data)
-        self.report_(data)
+        self.report_(data, block=True)
         print("--report success")
 
-    def run(self):
-        if len(self.data_changed_keys) > 0:
+    def flush_report(self):
+        # pack changed keys into as few publishes as possible, higher priority first
+        keys = sorted(self.dirty.keys(), key=lambda k: self.priority.get(k, PRIO_NORMAL))
+        self.dirty = {}
+        if not self.online:
+            # keep for replay after connected, others are reported by on_connect
             data = {}
-            for key in self.data_changed_keys:
-                if type(key) == list:
-                    data0 = {}
-                    for key0 in key:
-                        data0[key0] = self.data[key0]
-                    if data0:
-                        print("--report:", data0)
-                        self.report_(data0)
-                        print("--report success")
-                else:
-                    data[key] = self.data[key]
-            if data:
+            for key in keys:
+                data[key] = self.data[key]
+            self._store(data)
+            self._dirty_notify = 0
+            return
+        for key in keys:
+            self._queued[key] = self.data[key]
+        base_len = self.encoder.base_len(self.product_key, self.device_name)
+        data = {}
+        length = base_len
+        prio = PRIO_LOW
+        publish = 0
+        for key in keys:
+            item_len = self.encoder.item_len(key, self.data[key])
+            if data and length + item_len > self.max_cmd_len:
                 print("--report:", data)
-                self.report_(data)
-                print("--report success")
-            self.data_changed_keys = []
-        msg = self.uart.read()
-        if msg:
-            self.msg += msg
-            idx = self.msg.find(b"+TCMQTTRCVPUB:")
-            if idx >= 0:
-                self.msg = self.msg[idx:]
-                print("--msg:", self.msg)
-                idx = self.msg.find(b'}"\r\n') + 2
-                if idx >= 0:
-                    pub_msg = self.msg
-                    try:
-                        mat = ure.match('.*"{(.*)}".*', pub_msg.decode())
-                        if mat:
-                            pub_msg = '{'+mat.group(1)+'}'
-                            pub_msg = json.loads(pub_msg)
-                    except Exception as e:
-                        print(e)
-                        print("--[error] pub msg decode error:{}".format(pub_msg))
-                        pub_msg = None
-                    if pub_msg:
-                        self.on_msg(pub_msg)
-                    self.msg = self.msg[idx+2:] # remove "+TCMQTTRCVPUB:...\r\n"
+                self.report_(data, prio)
+                publish += 1
+                data = {}
+                length = base_len
+                prio = PRIO_LOW
+            if base_len + item_len > self.max_cmd_len:
+                print("--[WARNING] report item too long:", key)
+            data[key] = self.data[key]
+            length += item_len
+            prio = min(prio, self.priority.get(key, PRIO_NORMAL))
+        if data:
+            print("--report:", data)
+            self.report_(data, prio)
+            publish += 1
+        self.report_stats["publish"] += publish
+        if self._dirty_notify > publish:
+            self.report_stats["saved"] += self._dirty_notify - publish
+        self._dirty_notify = 0
+
+    def _check_heartbeat(self):
+        # keys not reported for heartbeat s, also if no notify_report comes
+        now = time.ticks_ms()
+        keys = []
+        for key in self.policy:
+            heartbeat = self.policy[key].get("heartbeat")
+            last = self._reported.get(key)
+            if heartbeat and last and now - last[1] >= heartbeat * 1000 and \
+                    key in self.data and key not in self.dirty and key not in self._queued:
+                keys.append(key)
+        if keys:
+            self.notify_report(keys)
+
+    def run(self):
+        if self.online and time.ticks_ms() - self._heartbeat_t >= 1000:
+            self._heartbeat_t = time.ticks_ms()
+            self._check_heartbeat()
+        if self.dirty and time.ticks_ms() - self.dirty_t >= self.report_debounce:
+            self.flush_report()
+        if self.online and self.store and self.store.any():
+            self._replay()
+        if self.metrics_key and self.online and \
+                time.ticks_ms() - self._metrics_t > self.metrics_interval * 1000:
+            self._metrics_t = time.ticks_ms()
+            self.data[self.metrics_key] = self.metrics.summary()
+            self.notify_report([self.metrics_key], force=True)
+        self.poll()
 
 
 if __name__ == "__main__":
@@ -3,103 +3,168 @@ import sensor,image,lcd
 import KPU as kpu
 import time
 from Maix import FPIOA,GPIO
+from face_gallery import Face_Gallery
+from face_tracker import Face_Tracker
+from motion_gate import Motion_Gate
+from profiler import Profiler
+import kpu_models
+
+# stages of Face_Recog.run in Face_Recog.prof, per face stages are summed over the faces of a frame
+STAGES = ("snapshot", "gate", "yolo", "crop", "landmark", "warp", "feature", "compare", "draw", "display")
+S_SNAPSHOT = 0
+S_GATE = 1
+S_YOLO = 2
+S_CROP = 3
+S_LANDMARK = 4
+S_WARP = 5
+S_FEATURE = 6
+S_COMPARE = 7
+S_DRAW = 8
+S_DISPLAY = 9   # on_detect/on_img/on_clear/on_people callbacks, lcd.display mostly
 
 
 class Face_Recog:
-    def __init__(self):
-        self._m_fd = kpu.load(0x200000)
-        self._m_ld = kpu.load(0x300000)
-        self._m_fe = kpu.load(0x400000)
+    def __init__(self, fd_model=0x200000, detect_size=None, max_faces=2):
+        # detect_size: (w, h) to detect faces on a downscaled frame, fd_model must
+        #              be a YOLO model of this input size, None: the QVGA frame
+        # max_faces:   faces to recognize in a frame, largest first
+        self.detect_size = detect_size
+        self.max_faces = max_faces
         self._anchor = (1.889, 2.5245, 2.9465, 3.94056, 3.99987, 5.3658, 5.155437, 6.92275, 6.718375, 9.01025)
         self._dst_point = [(44,59),(84,59),(64,82),(47,105),(81,105)]
-        self.names = []
-        self.features = []
-        _ = kpu.init_yolo2(self._m_fd, 0.5, 0.3, 5, self._anchor)
+        # models and camera are kept by kpu_models, loaded once per boot
+        self._addr = {"fd": fd_model, "ld": 0x300000, "fe": 0x400000}
+        self._fails = {"fd": 0, "ld": 0, "fe": 0}
+        self.max_fails = 3  # kpu errors in a row to load a model again
+        self._load_models()
+        self.gallery = Face_Gallery(kpu.face_compare, threshold=85)
         self.img_face=image.Image(size=(128,128))
         _ = self.img_face.pix_to_ai()
-        sensor.reset()
-        sensor.set_pixformat(sensor.RGB565)
-        sensor.set_framesize(sensor.QVGA)
-        # sensor.set_hmirror(1)
-        sensor.set_vflip(1)
+        self._init_sensor()
         self.show_img_timeout = 5
         self._show_img_t = -5
+        # reuse identity of a face in the next frames, embed again every 10 frames or if moved
+        self.tracker = Face_Tracker(embed_every=10)
+        # run detection only on motion, a tracked face, or every 5s when idle, None: every frame
+        self.gate = Motion_Gate(idle_interval=5)
+        self.stats = {
+            "frames": 0,
+            "kpu_calls": 0
+        }
+        self.fps = 0
+        self.kpu_rate = 0
+        self.rate_interval = 10 # s
+        self._rate_t = time.ticks_ms()
+        self._rate_base = (0, 0)
+        # time of every stage, overlay: fps and the slowest stage on the frame
+        self.prof = Profiler(STAGES, size=64)
+        self.overlay = False
     
-    def __del__(self):
-        _ = kpu.deinit(self._m_fe)
-        _ = kpu.deinit(self._m_ld)
-        _ = kpu.deinit(self._m_fd)
+    def _load_models(self):
+        self._m_fd = kpu_models.init_yolo2(self._addr["fd"], 0.5, 0.3, 5, self._anchor)
+        self._m_ld = kpu_models.load(self._addr["ld"])
+        self._m_fe = kpu_models.load(self._addr["fe"])
+
+    def _init_sensor(self):
+        # sensor.set_hmirror(1)
+        kpu_models.init_sensor(sensor.RGB565, sensor.QVGA, vflip=True)
+
+    def _kpu_result(self, model, ok):
+        # count kpu errors in a row, load only this model again after max_fails
+        if ok:
+            self._fails[model] = 0
+            return
+        self._fails[model] += 1
+        if self._fails[model] >= self.max_fails:
+            print("--[ERROR] kpu model {} fail, load again".format(model))
+            self._fails[model] = 0
+            kpu_models.release(self._addr[model])
+            self._load_models()
 
     def set_users(self, names, features):
-        self.names = names
-        self.features = features
+        self.gallery.set(names, features)
+        self.tracker.reset()
     
     def get_users(self):
-        return self.names, self.features
+        return list(self.gallery.names), self.gallery.features()
+
+    def load_users(self, store):
+        # users of a Face_Store, @return count
+        count = store.load_into(self.gallery)
+        self.tracker.reset()
+        return count
+
+    def add_user(self, name, feature):
+        self.gallery.add(name, feature)
+        self.tracker.reset()
 
     def run(self, on_detect, on_img, on_clear, on_people=None, always_show_img=False):
-        img = sensor.snapshot()
+        prof = self.prof
+        t = prof.start()
         try:
-            code = kpu.run_yolo2(self._m_fd, img)
+            img = sensor.snapshot()
         except Exception:
+            # reset camera only
+            kpu_models.sensor_failed()
+            self._init_sensor()
             return
-        if code:
-            for i in code:
-                face_cut = img.cut(i.x(),i.y(),i.w(),i.h())
-                face_cut_128 = face_cut.resize(128,128)
-                a = face_cut_128.pix_to_ai()
-                #a = img.draw_image(face_cut_128, (0,0))
-                # Landmark for face 5 points
-                try:
-                    fmap = kpu.forward(self._m_ld, face_cut_128)
-                except Exception:
-                    continue
-                plist=fmap[:]
-                le=(i.x()+int(plist[0]*i.w() - 10), i.y()+int(plist[1]*i.h()))
-                re=(i.x()+int(plist[2]*i.w()), i.y()+int(plist[3]*i.h()))
-                nose=(i.x()+int(plist[4]*i.w()), i.y()+int(plist[5]*i.h()))
-                lm=(i.x()+int(plist[6]*i.w()), i.y()+int(plist[7]*i.h()))
-                rm=(i.x()+int(plist[8]*i.w()), i.y()+int(plist[9]*i.h()))
-                a = img.draw_circle(le[0], le[1], 4)
-                a = img.draw_circle(re[0], re[1], 4)
-                a = img.draw_circle(nose[0], nose[1], 4)
-                a = img.draw_circle(lm[0], lm[1], 4)
-                a = img.draw_circle(rm[0], rm[1], 4)
-                # align face to standard position
-                src_point = [le, re, nose, lm, rm]
-                T=image.get_affine_transform(src_point, self._dst_point)
-                a=image.warp_affine_ai(img, self.img_face, T)
-                a=self.img_face.ai_to_pix()
-                #a = img.draw_image(img_face, (128,0))
-                del(face_cut_128)
-                # calculate face feature vector
-                try:
-                    fmap = kpu.forward(self._m_fe, self.img_face)
-                except Exception:
-                    continue
-                feature=kpu.face_encode(fmap[:])
-                scores = []
-                for j in range(len(self.features)):
-                    score = kpu.face_compare(self.features[j], feature)
-                    scores.append(score)
-                max_score = 0
-                index = 0
-                for k in range(len(scores)):
-                    if max_score < scores[k]:
-                        max_score = scores[k]
-                        index = k
-                if max_score > 85:
-                    a = img.draw_rectangle(i.rect(), color=(0, 255, 0))
-                    a = img.draw_string(i.x(),i.y(), ("%s :%2.1f" % (self.names[index], max_score)), color=(0,255,0),scale=2)
-                    on_detect(self.names[index], feature, max_score, img)
-                else:
-                    a = img.draw_rectangle(i.rect(), color=(255, 0, 0))
-                    # a = img.draw_string(i.x(),i.y(), ("X :%2.1f" % (max_score)), color=(255,0,0),scale=2)
-                    on_img(img)
-                if on_people:
-                    on_people(feature, img)
-                self._show_img_t = time.ticks_ms() / 1000.0
+        t = prof.lap(S_SNAPSHOT, t)
+        # add user (always_show_img) needs detection of every frame
+        if self.gate and not always_show_img and not self.gate.check(img, bool(self.tracker.tracks)):
+            code = None
+            self._count(1, 0)
+            t = prof.lap(S_GATE, t)
         else:
+            if self.gate and not always_show_img:
+                t = prof.lap(S_GATE, t)
+            try:
+                code = self._detect(img)
+            except Exception:
+                self._kpu_result("fd", False)
+                prof.frame()
+                return
+            self._kpu_result("fd", True)
+            self._count(1)
+            t = prof.lap(S_YOLO, t)
+        rects = code or []
+        faces = []  # (rect, track, landmark points or None)
+        for rect, track, embed in self.tracker.update(rects):
+            points = None
+            if embed:
+                feature, points, t = self._embed(img, rect, t)
+                if feature is None:
+                    continue
+                name, max_score = self.gallery.match(feature)
+                self.tracker.set_identity(track, name, max_score, feature)
+                t = prof.lap(S_COMPARE, t)
+            faces.append((rect, track, points))
+        # draw after every face is cut, the aligned faces are cut from img
+        if self.overlay:
+            prof.draw(img)
+            t = prof.lap(S_DRAW, t)
+        for rect, track, points in faces:
+            if points:
+                for p in points:
+                    a = img.draw_circle(p[0], p[1], 4)
+                t = prof.lap(S_DRAW, t)
+            name, max_score, feature = track.name, track.score, track.feature
+            if feature is None:
+                continue
+            if name is not None:
+                a = img.draw_rectangle(rect, color=(0, 255, 0))
+                a = img.draw_string(rect[0], rect[1], ("%s :%2.1f" % (name, max_score)), color=(0,255,0),scale=2)
+                t = prof.lap(S_DRAW, t)
+                on_detect(name, feature, max_score, img)
+            else:
+                a = img.draw_rectangle(rect, color=(255, 0, 0))
+                # a = img.draw_string(rect[0], rect[1], ("X :%2.1f" % (max_score)), color=(255,0,0),scale=2)
+                t = prof.lap(S_DRAW, t)
+                on_img(img)
+            if on_people:
+                on_people(feature, img)
+            t = prof.lap(S_DISPLAY, t)
+            self._show_img_t = time.ticks_ms() / 1000.0
+        if not rects:
             if always_show_img:
                 on_img(img)
             else:
@@ -107,11 +172,126 @@ class Face_Recog:
                     on_img(img)
                 else:
                     on_clear()
+            prof.lap(S_DISPLAY, t)
+        prof.frame()
+
+    def _detect(self, img):
+        # @return [(x, y, w, h)] of faces in img, largest first, at most max_faces
+        if self.detect_size:
+            w, h = self.detect_size
+            small = img.resize(w, h)
+            a = small.pix_to_ai()
+            code = kpu.run_yolo2(self._m_fd, small)
+            del small
+            sx = img.width() / w
+            sy = img.height() / h
+        else:
+            code = kpu.run_yolo2(self._m_fd, img)
+            sx = 1
+            sy = 1
+        rects = []
+        if not code:
+            return rects
+        for i in code:
+            x = max(0, int(i.x() * sx))
+            y = max(0, int(i.y() * sy))
+            w = min(int(i.w() * sx), img.width() - x)
+            h = min(int(i.h() * sy), img.height() - y)
+            if w > 0 and h > 0:
+                rects.append((x, y, w, h))
+        rects.sort(key=lambda r: r[2] * r[3], reverse=True)
+        return rects[:self.max_faces]
+
+    def _embed(self, img, rect, t):
+        # landmark, align and feature model of one face, full resolution,
+        # t: profiler time, @return feature, landmark points, t or None, None, t
+        prof = self.prof
+        x, y, w, h = rect
+        face_cut = img.cut(x, y, w, h)
+        face_cut_128 = face_cut.resize(128,128)
+        a = face_cut_128.pix_to_ai()
+        #a = img.draw_image(face_cut_128, (0,0))
+        t = prof.lap(S_CROP, t)
+        # Landmark for face 5 points
+        try:
+            self._count(0, 1)
+            fmap = kpu.forward(self._m_ld, face_cut_128)
+        except Exception:
+            self._kpu_result("ld", False)
+            return None, None, prof.lap(S_LANDMARK, t)
+        self._kpu_result("ld", True)
+        t = prof.lap(S_LANDMARK, t)
+        plist=fmap[:]
+        le=(x+int(plist[0]*w - 10), y+int(plist[1]*h))
+        re=(x+int(plist[2]*w), y+int(plist[3]*h))
+        nose=(x+int(plist[4]*w), y+int(plist[5]*h))
+        lm=(x+int(plist[6]*w), y+int(plist[7]*h))
+        rm=(x+int(plist[8]*w), y+int(plist[9]*h))
+        # align face to standard position
+        src_point = [le, re, nose, lm, rm]
+        T=image.get_affine_transform(src_point, self._dst_point)
+        a=image.warp_affine_ai(img, self.img_face, T)
+        a=self.img_face.ai_to_pix()
+        #a = img.draw_image(img_face, (128,0))
+        del(face_cut_128)
+        t = prof.lap(S_WARP, t)
+        # calculate face feature vector
+        try:
+            self._count(0, 1)
+            fmap = kpu.forward(self._m_fe, self.img_face)
+        except Exception:
+            self._kpu_result("fe", False)
+            return None, None, prof.lap(S_FEATURE, t)
+        self._kpu_result("fe", True)
+        feature = kpu.face_encode(fmap[:])
+        return feature, src_point, prof.lap(S_FEATURE, t)
+
+    def _count(self, frames, kpu_calls=1):
+        # frame rate and KPU calls per second, printed every rate_interval
+        self.stats["frames"] += frames
+        self.stats["kpu_calls"] += kpu_calls
+        t = time.ticks_ms() - self._rate_t
+        if t >= self.rate_interval * 1000:
+            self.fps = (self.stats["frames"] - self._rate_base[0]) * 1000.0 / t
+            self.kpu_rate = (self.stats["kpu_calls"] - self._rate_base[1]) * 1000.0 / t
+            self._rate_t = time.ticks_ms()
+            self._rate_base = (self.stats["frames"], self.stats["kpu_calls"])
+            print("--face fps: {:.1f}, kpu calls/s: {:.1f}, tracker: {}".format(self.fps, self.kpu_rate, self.tracker.stats))
+            if self.gate:
+                print("--motion gate: detect {:.0f}% of frames, threshold {}, {}".format(
+                    self.gate.duty() * 100, self.gate.thresh, self.gate.stats))
             
 
+def bench(face, frames=200, gate=False):
+    # run `frames` frames with every stage timed, print the table,
+    # gate=False: detect on every frame
+    if not gate:
+        face.gate = None
+    face.overlay = True
+    face.prof.reset()
+    def on_detect(user, feature, score, img):
+        lcd.display(img)
+    def on_img(img):
+        lcd.display(img)
+    def on_clear():
+        lcd.clear()
+    t = time.ticks_ms()
+    for i in range(frames):
+        face.run(on_detect, on_img, on_clear)
+    t = time.ticks_ms() - t
+    print("--bench {} frames in {}ms, {:.1f}fps, kpu calls: {}".format(frames, t, frames * 1000.0 / t, face.stats["kpu_calls"]))
+    for line in face.prof.lines():
+        print(line)
+
+
+# frames of bench mode, 0: normal run
+BENCH_FRAMES = 0
+
 if __name__ == "__main__":
     face = Face_Recog()
     lcd.init()
+    if BENCH_FRAMES:
+        bench(face, BENCH_FRAMES)
     def on_detect(user, feature, score, img):
         print(user, feature, score)
         lcd.display(img)
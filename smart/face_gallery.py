@@ -0,0 +1,180 @@
+import ustruct
+
+# Enrolled face features in one contiguous buffer, for Face_Recog.
+# search() scores every candidate once, keeping the best on the fly. It
+# doesn't stop at the first score over the threshold, with similar users
+# enrolled that one depends on storage order. For galleries of hundreds
+# of users build_index() groups the features around `sqrt(n)` centroids, a
+# search scores the centroids first and then only the users of the `probe`
+# nearest groups.
+#
+#   gallery = Face_Gallery(kpu.face_compare)
+#   gallery.set(names, features)
+#   gallery.search(feature)         # [(score, index)], best first
+#
+# compare(feature_a, feature_b) -> score 0~100, kpu.face_compare on K210,
+# tools/face_gallery_ref.py has a host one.
+
+
+class Face_Gallery:
+    def __init__(self, compare, threshold=85, coarse_min=64, probe=2):
+        self.compare = compare
+        self.threshold = threshold
+        self.coarse_min = coarse_min    # use index from this many users
+        self.probe = probe              # groups scanned of an indexed search
+        self.dim = 0
+        self.count = 0
+        self.names = []
+        self.buf = bytearray(0)
+        self.mv = memoryview(self.buf)
+        self.centroids = []             # [feature bytes]
+        self.groups = []                # [[index of feature]] of every centroid
+        self._index_count = 0           # count when index built
+        self.stats = {
+            "searches": 0,
+            "compares": 0
+        }
+
+    def set(self, names, features):
+        self.count = 0
+        self.names = []
+        self.dim = len(features[0]) if features else 0
+        self._reserve(len(features))
+        for i in range(len(features)):
+            self.add(names[i], features[i], index=False)
+        self.build_index()
+
+    def reset(self, dim, capacity=0):
+        # empty gallery for `capacity` features of `dim` bytes, fill with slot() and push()
+        self.count = 0
+        self.names = []
+        self.dim = dim
+        self.centroids = []
+        self.groups = []
+        self._index_count = 0
+        self._reserve(capacity)
+
+    def slot(self):
+        # buffer of the next feature, to read into, push() to keep it
+        if (self.count + 1) * self.dim > len(self.buf):
+            self._reserve(max(self.count * 2, 16))
+        return self.mv[self.count * self.dim:(self.count + 1) * self.dim]
+
+    def push(self, name):
+        self.names.append(name)
+        self.count += 1
+
+    def add(self, name, feature, index=True):
+        if not self.dim:
+            self.dim = len(feature)
+        if len(feature) != self.dim:
+            raise Exception("feature length {} != {}".format(len(feature), self.dim))
+        if (self.count + 1) * self.dim > len(self.buf):
+            self._reserve(max(self.count * 2, 16))
+        pos = self.count * self.dim
+        self.buf[pos:pos + self.dim] = feature
+        self.names.append(name)
+        self.count += 1
+        if index:
+            if self.count >= 2 * self._index_count and self.count >= self.coarse_min:
+                self.build_index()
+            elif self.centroids:
+                self.groups[self._nearest(feature)].append(self.count - 1)
+
+    def feature(self, i):
+        return self.mv[i * self.dim:(i + 1) * self.dim]
+
+    def features(self):
+        # copies, to save
+        return [bytes(self.feature(i)) for i in range(self.count)]
+
+    def search(self, feature, k=1, coarse=True):
+        # @return [(score, index)] best first, up to k items, of all users,
+        # or of the nearest groups when coarse and indexed
+        self.stats["searches"] += 1
+        if coarse and self.centroids:
+            candidates = self._candidates(feature)
+        else:
+            candidates = range(self.count)
+        best = []       # [(score, index)] best first
+        compare = self.compare
+        n = 0
+        for i in candidates:
+            score = compare(self.mv[i * self.dim:(i + 1) * self.dim], feature)
+            n += 1
+            if len(best) < k or score > best[-1][0]:
+                j = len(best)
+                while j > 0 and best[j - 1][0] < score:
+                    j -= 1
+                best.insert(j, (score, i))
+                if len(best) > k:
+                    best.pop()
+        self.stats["compares"] += n
+        return best
+
+    def match(self, feature):
+        # @return (name, score) of the best match over threshold, or (None, best score)
+        best = self.search(feature)
+        if best and best[0][0] > self.threshold:
+            return self.names[best[0][1]], best[0][0]
+        return None, best[0][0] if best else 0
+
+    def build_index(self, iters=4):
+        # group features around centroids (k-means, scored by compare)
+        self.centroids = []
+        self.groups = []
+        self._index_count = self.count
+        if self.count < self.coarse_min:
+            return
+        n = int(self.count ** 0.5)
+        step = self.count // n
+        self.centroids = [bytes(self.feature(i * step)) for i in range(n)]
+        for it in range(iters):
+            self.groups = [[] for c in self.centroids]
+            for i in range(self.count):
+                self.groups[self._nearest(self.feature(i))].append(i)
+            if it < iters - 1:
+                for c in range(n):
+                    if self.groups[c]:
+                        self.centroids[c] = self._mean(self.groups[c])
+
+    def _candidates(self, feature):
+        scores = []
+        for c in range(len(self.centroids)):
+            scores.append((self.compare(self.centroids[c], feature), c))
+        self.stats["compares"] += len(scores)
+        scores.sort(reverse=True)
+        candidates = []
+        for score, c in scores[:self.probe]:
+            candidates.extend(self.groups[c])
+        return candidates
+
+    def _nearest(self, feature):
+        best = -1
+        index = 0
+        for c in range(len(self.centroids)):
+            score = self.compare(self.centroids[c], feature)
+            if score > best:
+                best = score
+                index = c
+        return index
+
+    def _mean(self, members):
+        # features are int8
+        fmt = "{}b".format(self.dim)
+        total = [0] * self.dim
+        for i in members:
+            values = ustruct.unpack_from(fmt, self.buf, i * self.dim)
+            for d in range(self.dim):
+                total[d] += values[d]
+        n = len(members)
+        return ustruct.pack(fmt, *[int(v / n) for v in total])
+
+    def _reserve(self, count):
+        size = count * self.dim
+        if size <= len(self.buf):
+            return
+        buf = bytearray(size)
+        buf[:self.count * self.dim] = self.mv[:self.count * self.dim]
+        self.buf = buf
+        self.mv = memoryview(buf)
@@ -0,0 +1,193 @@
+import os
+import ustruct
+try:
+    from ubinascii import crc32
+except ImportError:
+    crc32 = None
+
+# Enrolled users in a binary file of fixed size records.
+# Enroll appends one record, delete marks the record dead (one byte written)
+# and compact() rewrites the live records to a temp file which replaces the
+# store by rename, a `.bak` is kept until the new file is in place.
+# load_into() reads features straight into the Face_Gallery buffer.
+#
+# header: magic "FACE" version(B) name_size(B) dim(H) record_size(H) 6 bytes 0
+# record: state(B) name_len(B) name(name_size) feature(dim) crc32(I)
+#         state: LIVE or DEAD, crc of name_len, name and feature
+
+MAGIC = b"FACE"
+VERSION = 1
+LIVE = 0xA5
+DEAD = 0x00
+_HEAD = "<4sBBHH6x"
+_HEAD_LEN = 16
+
+
+class Face_Store:
+    def __init__(self, path="door_users.bin", name_size=24):
+        self.path = path
+        self.name_size = name_size
+        self.dim = 0
+        self.rec_size = 0
+        self.records = 0    # record slots in file, live and dead
+        self.slots = []     # record slot of every live user, same order as the gallery
+        self.dead = 0
+        self.stats = {
+            "bad": 0        # broken records skipped when loading
+        }
+        files = os.listdir()
+        if path not in files and path + ".bak" in files:
+            # power lost while compact() replaced the file
+            os.rename(path + ".bak", path)
+            files.append(path)
+        if path in files:
+            self._read_head()
+        else:
+            self._write_file(path, 0, [])
+
+    def load_into(self, gallery):
+        # read live users into gallery, @return count
+        gallery.reset(self.dim, self.records)
+        self.slots = []
+        self.dead = 0
+        if not self.records:
+            gallery.build_index()
+            return 0
+        head = bytearray(2 + self.name_size)
+        tail = bytearray(4)
+        with open(self.path, "rb") as f:
+            f.seek(_HEAD_LEN)
+            for slot in range(self.records):
+                feature = gallery.slot()
+                if f.readinto(head) != len(head) or f.readinto(feature) != self.dim or f.readinto(tail) != 4:
+                    break
+                if head[0] == DEAD:
+                    self.dead += 1
+                    continue
+                if head[0] != LIVE or head[1] > self.name_size or \
+                        _crc(feature, _crc(memoryview(head)[1:])) != ustruct.unpack("<I", tail)[0]:
+                    self.stats["bad"] += 1
+                    self.dead += 1
+                    continue
+                gallery.push(bytes(head[2:2 + head[1]]).decode())
+                self.slots.append(slot)
+        gallery.build_index()
+        return len(self.slots)
+
+    def append(self, name, feature):
+        if not self.dim:
+            # empty store, dim of the first user
+            self._write_file(self.path, len(feature), [])
+        if len(feature) != self.dim:
+            raise Exception("feature length {} != {}".format(len(feature), self.dim))
+        with open(self.path, "r+b") as f:
+            # a broken tail record (power lost) is overwritten
+            f.seek(_HEAD_LEN + self.records * self.rec_size)
+            f.write(self._pack(name, feature))
+        self.slots.append(self.records)
+        self.records += 1
+
+    def remove(self, i):
+        # i: index of user in the gallery
+        slot = self.slots.pop(i)
+        with open(self.path, "r+b") as f:
+            f.seek(_HEAD_LEN + slot * self.rec_size)
+            f.write(bytes([DEAD]))
+        self.dead += 1
+        if self.dead > 16 and self.dead > len(self.slots):
+            self.compact()
+
+    def clear(self):
+        self._replace(0, [])
+
+    def compact(self, names=None, features=None):
+        # rewrite live records, or the given users
+        if names is None:
+            names = []
+            features = []
+            with open(self.path, "rb") as f:
+                for slot in self.slots:
+                    f.seek(_HEAD_LEN + slot * self.rec_size)
+                    raw = f.read(self.rec_size)
+                    names.append(bytes(raw[2:2 + raw[1]]).decode())
+                    features.append(raw[2 + self.name_size:2 + self.name_size + self.dim])
+        self._replace(len(features[0]) if features else self.dim, [self._pack(names[i], features[i], len(features[i]))
+                                                                  for i in range(len(names))])
+
+    def _replace(self, dim, records):
+        tmp = self.path + ".tmp"
+        self._write_file(tmp, dim, records)
+        bak = self.path + ".bak"
+        try:
+            os.remove(bak)
+        except OSError:
+            pass
+        os.rename(self.path, bak)
+        os.rename(tmp, self.path)
+        os.remove(bak)
+        self.slots = list(range(len(records)))
+        self.dead = 0
+
+    def _write_file(self, path, dim, records):
+        rec_size = 2 + self.name_size + dim + 4
+        with open(path, "wb") as f:
+            f.write(ustruct.pack(_HEAD, MAGIC, VERSION, self.name_size, dim, rec_size))
+            for rec in records:
+                f.write(rec)
+        if path == self.path:
+            self.slots = list(range(len(records)))
+            self.dead = 0
+        self.dim = dim
+        self.rec_size = rec_size
+        self.records = len(records)
+
+    def _read_head(self):
+        with open(self.path, "rb") as f:
+            raw = f.read(_HEAD_LEN)
+        magic, version, name_size, dim, rec_size = ustruct.unpack(_HEAD, raw)
+        if magic != MAGIC or version != VERSION or rec_size != 2 + name_size + dim + 4:
+            raise Exception("{} is not a face store".format(self.path))
+        self.name_size = name_size
+        self.dim = dim
+        self.rec_size = rec_size
+        size = os.stat(self.path)[6]
+        self.records = (size - _HEAD_LEN) // rec_size
+
+    def _pack(self, name, feature, dim=None):
+        name = name.encode()[:self.name_size]
+        body = bytearray(1 + self.name_size + (dim or self.dim))
+        body[0] = len(name)
+        body[1:1 + len(name)] = name
+        body[1 + self.name_size:] = feature
+        return bytes([LIVE]) + body + ustruct.pack("<I", _crc(body))
+
+
+def migrate_json(store, json_path):
+    # users of the old door_users.json to store, the json is renamed to .bak
+    import json
+    import ubinascii
+    with open(json_path) as f:
+        conf = json.loads(f.read())
+    names = []
+    features = []
+    for i in range(len(conf["features"])):
+        feature = ubinascii.a2b_base64(conf["features"][i])
+        if feature and (not features or len(feature) == len(features[0])):
+            names.append(conf["users"][i])
+            features.append(feature)
+        else:
+            print("--[WARNING] user {}'s feature not valid".format(conf["users"][i]))
+    store.compact(names, features)
+    os.rename(json_path, json_path + ".bak")
+    return len(names)
+
+
+def _crc(data, value=0):
+    if crc32:
+        return crc32(data, value) & 0xFFFFFFFF
+    value ^= 0xFFFFFFFF
+    for b in data:
+        value ^= b
+        for i in range(8):
+            value = (value >> 1) ^ (0xEDB88320 & -(value & 1))
+    return value ^ 0xFFFFFFFF
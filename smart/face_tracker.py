@@ -0,0 +1,139 @@
+# Follow faces across frames so Face_Recog only runs landmark + feature model
+# and the gallery search when needed: a new face, every `embed_every` frames,
+# or when the box moved or changed size since the last embedding.
+# Detections are matched to tracks by IoU, or by centroid distance for fast
+# moves, the identity of a track stays until it's not seen `max_missed` frames.
+# A track matched only by centroid, or seen again after missed frames, may be
+# another face now (someone stepping into the spot), its identity is dropped
+# and it is embedded again before the name is used.
+#
+#   for rect, track, embed in tracker.update(rects):
+#       if embed:
+#           ... tracker.set_identity(track, name, score, feature)
+
+
+class Track:
+    def __init__(self, track_id, rect):
+        self.id = track_id
+        self.rect = rect            # (x, y, w, h) of last frame
+        self.embed_rect = None      # rect when embedded
+        self.name = None            # None: stranger
+        self.score = 0
+        self.feature = None
+        self.age = 0                # frames since embedded
+        self.missed = 0
+
+
+class Face_Tracker:
+    def __init__(self, embed_every=10, iou_min=0.3, move_ratio=0.25, size_ratio=0.2, max_missed=3):
+        self.embed_every = embed_every
+        self.iou_min = iou_min
+        self.move_ratio = move_ratio    # centroid move / width to embed again
+        self.size_ratio = size_ratio    # width change / width to embed again
+        self.max_missed = max_missed
+        self.tracks = []
+        self._next_id = 1
+        self.stats = {
+            "tracks": 0,
+            "embeds": 0,
+            "reused": 0,
+            "forced": 0         # embedded again after a centroid match or missed frames
+        }
+
+    def update(self, rects):
+        # rects: [(x, y, w, h)] of this frame, @return [(rect, track, need embed)]
+        pairs = []
+        for t in range(len(self.tracks)):
+            for r in range(len(rects)):
+                score = iou(self.tracks[t].rect, rects[r])
+                near = False
+                if score < self.iou_min and self._near(self.tracks[t].rect, rects[r]):
+                    # fast move, keep it after all IoU pairs
+                    score = self.iou_min / 2
+                    near = True
+                if score > 0:
+                    pairs.append((score, t, r, near))
+        pairs.sort(reverse=True)
+        track_of = [None] * len(rects)
+        near_of = [False] * len(rects)
+        used = [False] * len(self.tracks)
+        for score, t, r, near in pairs:
+            if used[t] or track_of[r] is not None:
+                continue
+            used[t] = True
+            track_of[r] = self.tracks[t]
+            near_of[r] = near
+        tracks = []
+        for t in range(len(self.tracks)):
+            track = self.tracks[t]
+            if not used[t]:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    continue
+            tracks.append(track)
+        out = []
+        for r in range(len(rects)):
+            track = track_of[r]
+            if track is None:
+                track = Track(self._next_id, rects[r])
+                self._next_id += 1
+                self.stats["tracks"] += 1
+                tracks.append(track)
+            elif near_of[r] or track.missed:
+                self._forget(track)
+                self.stats["forced"] += 1
+            track.rect = rects[r]
+            track.missed = 0
+            track.age += 1
+            embed = self._need_embed(track)
+            if embed:
+                self.stats["embeds"] += 1
+            else:
+                self.stats["reused"] += 1
+            out.append((rects[r], track, embed))
+        self.tracks = tracks
+        return out
+
+    def set_identity(self, track, name, score, feature):
+        track.name = name
+        track.score = score
+        track.feature = feature
+        track.embed_rect = track.rect
+        track.age = 0
+
+    def reset(self):
+        self.tracks = []
+
+    def _forget(self, track):
+        # identity not passed on, embed on this frame
+        track.name = None
+        track.score = 0
+        track.feature = None
+        track.embed_rect = None
+
+    def _need_embed(self, track):
+        if track.embed_rect is None or track.age >= self.embed_every:
+            return True
+        x0, y0, w0, h0 = track.embed_rect
+        x1, y1, w1, h1 = track.rect
+        dx = (x1 + w1 / 2) - (x0 + w0 / 2)
+        dy = (y1 + h1 / 2) - (y0 + h0 / 2)
+        if dx * dx + dy * dy > (self.move_ratio * w0) ** 2:
+            return True
+        return abs(w1 - w0) > self.size_ratio * w0
+
+    def _near(self, a, b):
+        dx = (a[0] + a[2] / 2) - (b[0] + b[2] / 2)
+        dy = (a[1] + a[3] / 2) - (b[1] + b[3] / 2)
+        return dx * dx + dy * dy < (a[2] * 0.75) ** 2
+
+
+def iou(a, b):
+    x0 = max(a[0], b[0])
+    y0 = max(a[1], b[1])
+    x1 = min(a[0] + a[2], b[0] + b[2])
+    y1 = min(a[1] + a[3], b[1] + b[3])
+    if x1 <= x0 or y1 <= y0:
+        return 0
+    inter = (x1 - x0) * (y1 - y0)
+    return inter / (a[2] * a[3] + b[2] * b[3] - inter)
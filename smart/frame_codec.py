@@ -0,0 +1,237 @@
+import ustruct
+
+# Find and decode sensor frames in a UART byte stream.
+# A sensor declares its frames with a Frame_Spec, Frame_Codec keeps the unread
+# bytes in a fixed buffer, scans for the header, checks the layout bytes,
+# length and checksum, skips garbage and yields every complete frame.
+# With a short header and an 8 bit checksum garbage passes now and then, so
+# if another right frame starts inside a right frame, the outer one is taken
+# as garbage. A frame with the start of such an inner frame at its end is
+# held until the rest comes, or until frames() is called with no data.
+#
+#   codec = Frame_Codec(SPEC)
+#   for name, values in codec.frames(uart.read()):   # None if nothing read
+#       ...
+
+
+class Frame_Spec:
+    def __init__(self, header, layouts, checksum, size=0, length_field=None, max_size=64):
+        # header:       bytes every frame starts with
+        # layouts:      [(name, select, fmt, keys)], first matched is used,
+        #               select: (offset, byte value) or None to match any,
+        #               keys: names of unpacked values, None to skip the value
+        # checksum:     checksum(buf, start, size) return True if frame is right,
+        #               must not allocate
+        # size:         frame size, 0 if set by length_field
+        # length_field: (offset, fmt, extra), frame size = value + extra
+        self.header = header
+        self.layouts = layouts
+        self.checksum = checksum
+        self.size = size
+        self.length_field = length_field
+        self.max_size = max_size
+        self.min_size = size if size else length_field[0] + ustruct.calcsize(length_field[1])
+        if self.min_size < len(header):
+            self.min_size = len(header)
+
+
+class Frame_Codec:
+    def __init__(self, spec, buf_size=128):
+        self.spec = spec
+        self.buf = bytearray(buf_size)
+        self.mv = memoryview(self.buf)
+        self.start = 0      # unread bytes: buf[start:end]
+        self.end = 0
+        self.stats = {
+            "frames": 0,
+            "garbage": 0,   # bytes skipped to find a header
+            "bad_len": 0,
+            "bad_sum": 0,
+            "overflow": 0,  # bytes dropped because buffer is full of garbage
+            "unknown": 0    # checksum right, but no layout matched
+        }
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+
+    def frames(self, data=None, flush=False):
+        # add data read from uart, yield (layout name, {key: value}) of every complete frame,
+        # data None or flush: no more bytes for now, don't hold a frame back
+        pos = 0
+        n = len(data) if data else 0
+        while 1:
+            if pos < n:
+                pos += self._fill(data, pos)
+            for frame in self._scan(pos < n or (n > 0 and not flush)):
+                yield frame
+            if pos >= n:
+                break
+
+    def _fill(self, data, pos):
+        size = len(self.buf)
+        if self.end == size:
+            # move unread bytes to the front
+            count = self.end - self.start
+            if count == size:
+                # no frame in a full buffer, drop it
+                self.stats["overflow"] += count
+                count = 0
+            elif self.start:
+                self.buf[0:count] = self.mv[self.start:self.end]
+            self.start = 0
+            self.end = count
+        n = min(len(data) - pos, size - self.end)
+        if pos or n < len(data):
+            data = memoryview(data)[pos:pos + n]
+        self.buf[self.end:self.end + n] = data
+        self.end += n
+        return n
+
+    def _scan(self, wait=True):
+        spec = self.spec
+        buf = self.buf
+        h0 = spec.header[0]
+        while self.end - self.start >= spec.min_size:
+            start = self.start
+            if buf[start] != h0 or not self._match_header(start) or self._match_layout(start) is False:
+                # resync: skip to the next possible header
+                i = start + 1
+                while i < self.end and buf[i] != h0:
+                    i += 1
+                self.stats["garbage"] += i - start
+                self.start = i
+                continue
+            size = self._size(start)
+            if not size:
+                self.stats["bad_len"] += 1
+                self.start += 1
+                continue
+            if self.end - start < size:
+                break
+            if not spec.checksum(buf, start, size):
+                # maybe a header in data, try again from the next byte
+                self.stats["bad_sum"] += 1
+                self.start += 1
+                continue
+            frame = self._decode(start, size)
+            if not frame:
+                # checksum is right by chance, no layout matched
+                self.stats["unknown"] += 1
+                self.start += 1
+                continue
+            inner = self._inner_frame(start, size)
+            if inner < 0:
+                if wait:
+                    # wait for the rest of the inner one
+                    break
+                inner = 0
+            if inner:
+                self.stats["garbage"] += inner - start
+                self.start = inner
+                continue
+            self.start += size
+            self.stats["frames"] += 1
+            yield frame
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+
+    def _match_header(self, start):
+        header = self.spec.header
+        if self.end - start < len(header):
+            # wait for more bytes
+            return True
+        for i in range(1, len(header)):
+            if self.buf[start + i] != header[i]:
+                return False
+        return True
+
+    def _match_layout(self, start):
+        # True if the select byte of a layout matches, None if not received yet
+        for name, select, fmt, keys in self.spec.layouts:
+            if not select:
+                return True
+            if start + select[0] >= self.end:
+                return None
+            if self.buf[start + select[0]] == select[1]:
+                return True
+        return False
+
+    def _size(self, start):
+        # frame size, 0 if length field is wrong, length field must be received
+        spec = self.spec
+        if spec.size:
+            return spec.size
+        field = spec.length_field
+        size = ustruct.unpack_from(field[1], self.buf, start + field[0])[0] + field[2]
+        if size < spec.min_size or size > spec.max_size:
+            return 0
+        return size
+
+    def _inner_frame(self, start, size):
+        # start of a frame with right header, layout, length and checksum inside
+        # the frame at start, 0 if none, -1 if one may be, not all received
+        spec = self.spec
+        buf = self.buf
+        h0 = spec.header[0]
+        for i in range(start + 1, start + size):
+            # header and layout byte must be received, a lone header byte at the
+            # end doesn't hold back the frame
+            if buf[i] != h0 or self.end - i < len(spec.header) or \
+                    not self._match_header(i) or not self._match_layout(i):
+                continue
+            if self.end - i < spec.min_size:
+                return -1
+            size2 = self._size(i)
+            if not size2:
+                continue
+            if self.end - i < size2:
+                return -1
+            if spec.checksum(buf, i, size2):
+                return i
+        return 0
+
+    def _decode(self, start, size):
+        buf = self.buf
+        for name, select, fmt, keys in self.spec.layouts:
+            if select and (select[0] >= size or buf[start + select[0]] != select[1]):
+                continue
+            if ustruct.calcsize(fmt) > size:
+                continue
+            values = ustruct.unpack_from(fmt, buf, start)
+            data = {}
+            for i in range(len(keys)):
+                if keys[i] is not None:
+                    data[keys[i]] = values[i]
+            return (name, data)
+        return None
+
+
+# checksum helpers, (buf, start, size)
+
+def sum16_be(buf, start, size):
+    # sum of bytes before the last 2, big endian u16 at the end
+    total = 0
+    for i in range(start, start + size - 2):
+        total += buf[i]
+    return (total & 0xFFFF) == (buf[start + size - 2] << 8 | buf[start + size - 1])
+
+
+def neg_sum8(buf, start, size):
+    # two's complement of the sum of bytes between header and the last byte
+    return (~sum8(buf, start + 1, start + size - 1) + 1) & 0xFF == buf[start + size - 1]
+
+
+def sum8(buf, start, end):
+    total = 0
+    for i in range(start, end):
+        total += buf[i]
+    return total & 0xFF
+
+
+def sum16(buf, start, end):
+    total = 0
+    for i in range(start, end):
+        total += buf[i]
+    return total & 0xFFFF
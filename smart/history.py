@@ -0,0 +1,288 @@
+import os
+import time
+import ustruct
+
+# Sensor history in flash, one fixed size ring file per tier:
+#   minute: 1440 records (24 hours), hour: 720 (30 days), day: 366 (1 year)
+# A record's slot is (ts // period) % slots, the ts in the record tells if it
+# is of this round, so a time range is read with one seek, no index and no
+# scan of the lower tiers. When a bucket closes its record is written and
+# folded into the bucket of the next tier in RAM, after reboot the open
+# buckets are rebuilt from the tier below.
+# Nothing sets the RTC now, time.time() starts from 2000-01-01 at every boot,
+# so until the clock is set the history time goes on from the last record of
+# the last boot plus uptime, power off time is left out.
+#
+#   history = History(["pm2_5", "hcho_ug"])
+#   history.add({"pm2_5": 12, "hcho_ug": 3})
+#   history.series("pm2_5", 30 * 86400)     # [(ts, mean)] from the hour tier
+#
+# record: ts(I) [mean(h) min(h) max(h)] for every key, value * SCALE, NONE if no data
+
+NONE = -32768
+SCALE = 10
+CLOCK_SET = 600000000   # time.time() over it (after 2019): RTC is set
+TIERS = (
+    # name, period s, slots
+    ("m", 60, 1440),
+    ("h", 3600, 720),
+    ("d", 86400, 366)
+)
+_READ_RECORDS = 64  # records of one file read
+
+
+class Tier:
+    def __init__(self, path, period, slots, n_keys):
+        self.path = path
+        self.period = period
+        self.slots = slots
+        self.fmt = "<I" + "hhh" * n_keys
+        self.rec_size = ustruct.calcsize(self.fmt)
+        size = self.rec_size * slots
+        if _size(path) != size:
+            # new, or keys changed, all slots empty
+            block = bytes(self.rec_size * _READ_RECORDS)
+            with open(path, "wb") as f:
+                while size > 0:
+                    f.write(block[:min(size, len(block))])
+                    size -= len(block)
+
+    def write(self, ts, values):
+        # values: [mean, min, max] * keys, already scaled
+        with open(self.path, "r+b") as f:
+            f.seek((ts // self.period) % self.slots * self.rec_size)
+            f.write(ustruct.pack(self.fmt, ts, *values))
+
+    def read(self, start, end):
+        # @return [(ts, mean, min, max, ...)] of buckets start <= ts < end, oldest first
+        period = self.period
+        start -= start % period
+        n = (end - start + period - 1) // period
+        if n > self.slots:
+            start += (n - self.slots) * period
+            n = self.slots
+        records = []
+        if n <= 0:
+            return records
+        first = start // period
+        pos = 0
+        with open(self.path, "rb") as f:
+            while pos < n:
+                slot = (first + pos) % self.slots
+                count = min(n - pos, self.slots - slot, _READ_RECORDS)
+                f.seek(slot * self.rec_size)
+                raw = f.read(count * self.rec_size)
+                for i in range(count):
+                    rec = ustruct.unpack_from(self.fmt, raw, i * self.rec_size)
+                    if rec[0] == start + (pos + i) * period:
+                        records.append(rec)
+                pos += count
+        return records
+
+    def last_ts(self):
+        # ts of the newest record, 0 if empty
+        last = 0
+        with open(self.path, "rb") as f:
+            while 1:
+                raw = f.read(self.rec_size * _READ_RECORDS)
+                if not raw:
+                    break
+                for off in range(0, len(raw) - self.rec_size + 1, self.rec_size):
+                    ts = ustruct.unpack_from("<I", raw, off)[0]
+                    if ts > last:
+                        last = ts
+        return last
+
+
+class History:
+    def __init__(self, keys, prefix="hist_", tiers=TIERS):
+        self.keys = keys
+        self.tiers = []
+        for name, period, slots in tiers:
+            self.tiers.append(Tier("{}{}.bin".format(prefix, name), period, slots, len(keys)))
+        # open bucket of every tier: start ts, [sum, count, min, max] per key,
+        # tier 0 gets samples, the others get means of the closed records below
+        self._bucket = [None] * len(self.tiers)
+        self._acc = [self._new_acc() for tier in self.tiers]
+        self._offset = None     # s added to time.time() while the clock is not set
+        self._now = 0
+        self.stats = {
+            "samples": 0,
+            "writes": 0
+        }
+
+    def add(self, values, ts=None):
+        # values: {key: number}, keys not in self.keys are ignored
+        if ts is None:
+            ts = self.now()
+        if self._bucket[0] is None:
+            self._restore(ts)
+        else:
+            self._roll(ts)
+        acc = self._acc[0]
+        for i in range(len(self.keys)):
+            value = values.get(self.keys[i])
+            if value is not None:
+                _fold(acc[i], value, value, value)
+        self.stats["samples"] += 1
+
+    def read(self, tier, start, end):
+        # tier: index in self.tiers, @return [(ts, {key: (mean, min, max)})]
+        out = []
+        for rec in self.tiers[tier].read(start, end):
+            out.append((rec[0], self._unpack(rec)))
+        return out
+
+    def series(self, key, span, now=None):
+        # means of key in the last `span` s from the first tier that covers it,
+        # open bucket included, @return [(ts, mean)], period of tier
+        if now is None:
+            now = self.now()
+        i = 0
+        while i < len(self.tiers) - 1 and self.tiers[i].period * self.tiers[i].slots < span:
+            i += 1
+        tier = self.tiers[i]
+        k = self.keys.index(key)
+        points = []
+        for rec in tier.read(now - span, now):
+            if rec[1 + k * 3] != NONE:
+                points.append((rec[0], rec[1 + k * 3] / SCALE))
+        acc = self._acc[i][k]
+        if self._bucket[i] is not None and acc[1] and now - self._bucket[i] < span:
+            points.append((self._bucket[i], acc[0] / acc[1]))
+        return points, tier.period
+
+    def now(self):
+        # s from 2000, goes on from the records of the last boot if the clock is not set
+        t = int(time.time())
+        if t < CLOCK_SET:
+            if self._offset is None:
+                last = self.tiers[0].last_ts()
+                self._offset = last + self.tiers[0].period - t if last > t else 0
+            t += self._offset
+        # never back, records of a later ts may be written already
+        if t < self._now:
+            t = self._now
+        self._now = t
+        return t
+
+    def _roll(self, ts):
+        # close the buckets ts is out of, from minute up
+        for i in range(len(self.tiers)):
+            tier = self.tiers[i]
+            bucket = ts - ts % tier.period
+            if bucket == self._bucket[i]:
+                break
+            values = self._close(i)
+            if values and i + 1 < len(self.tiers):
+                acc = self._acc[i + 1]
+                for k in range(len(self.keys)):
+                    if values[k * 3] != NONE:
+                        _fold(acc[k], values[k * 3] / SCALE, values[k * 3 + 1] / SCALE, values[k * 3 + 2] / SCALE)
+            self._bucket[i] = bucket
+            self._acc[i] = self._new_acc()
+
+    def _close(self, i):
+        # write record of the open bucket of tier i, @return scaled values or None if no data
+        values = []
+        has_data = False
+        for acc in self._acc[i]:
+            if acc[1]:
+                has_data = True
+                values.extend((_scale(acc[0] / acc[1]), _scale(acc[2]), _scale(acc[3])))
+            else:
+                values.extend((NONE, NONE, NONE))
+        if not has_data:
+            return None
+        self.tiers[i].write(self._bucket[i], values)
+        self.stats["writes"] += 1
+        return values
+
+    def _restore(self, ts):
+        # open buckets after boot, from the records already written below
+        for i in range(len(self.tiers)):
+            tier = self.tiers[i]
+            self._bucket[i] = ts - ts % tier.period
+            if i == 0:
+                continue
+            acc = self._acc[i]
+            for rec in self.tiers[i - 1].read(self._bucket[i], self._bucket[i - 1]):
+                for k in range(len(self.keys)):
+                    if rec[1 + k * 3] != NONE:
+                        _fold(acc[k], rec[1 + k * 3] / SCALE, rec[2 + k * 3] / SCALE, rec[3 + k * 3] / SCALE)
+
+    def _new_acc(self):
+        return [[0.0, 0, None, None] for key in self.keys]
+
+    def _unpack(self, rec):
+        data = {}
+        for k in range(len(self.keys)):
+            if rec[1 + k * 3] != NONE:
+                data[self.keys[k]] = (rec[1 + k * 3] / SCALE, rec[2 + k * 3] / SCALE, rec[3 + k * 3] / SCALE)
+        return data
+
+
+def draw_trend(img, history, key, span, x=0, y=0, w=320, h=120, color=(0, 255, 0), title=None, now=None):
+    # line chart of key in the last `span` s, reads only the tier for span
+    if now is None:
+        now = history.now()
+    points, period = history.series(key, span, now)
+    white = (255, 255, 255)
+    img.draw_string(x, y, "{} {}".format(title or key, _span_str(span)), color=white)
+    top = y + 16
+    bottom = y + h - 16
+    img.draw_rectangle((x, top, w, bottom - top + 1), color=(80, 80, 80))
+    if not points:
+        img.draw_string(x + 4, top + 4, "no data", color=white)
+        return img
+    low = points[0][1]
+    high = low
+    for ts, value in points:
+        if value < low:
+            low = value
+        if value > high:
+            high = value
+    scale = (bottom - top) / (high - low) if high > low else 0
+    start = now - span
+    last = None
+    for ts, value in points:
+        px = x + (ts - start) * (w - 1) // span
+        py = bottom - int((value - low) * scale)
+        if last and ts - last[0] <= period * 3:
+            img.draw_line(last[1], last[2], px, py, color=color)
+        else:
+            img.draw_circle(px, py, 1, color=color)
+        last = (ts, px, py)
+    img.draw_string(x, bottom + 2, "min {:.1f}  max {:.1f}  now {:.1f}".format(low, high, points[-1][1]), color=white)
+    return img
+
+
+def _fold(acc, mean, low, high):
+    acc[0] += mean
+    acc[1] += 1
+    if acc[2] is None or low < acc[2]:
+        acc[2] = low
+    if acc[3] is None or high > acc[3]:
+        acc[3] = high
+
+
+def _scale(value):
+    value = int(value * SCALE + (0.5 if value >= 0 else -0.5))
+    if value > 32767:
+        return 32767
+    if value < -32767:
+        return -32767
+    return value
+
+
+def _span_str(span):
+    if span >= 86400:
+        return "{}d".format(span // 86400)
+    return "{}h".format(span // 3600)
+
+
+def _size(path):
+    try:
+        return os.stat(path)[6]
+    except OSError:
+        return 0
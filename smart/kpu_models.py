@@ -0,0 +1,81 @@
+import KPU as kpu
+import sensor
+
+# KPU models and camera set up once per boot, shared by every Face_Recog, so
+# App.init0() after an error doesn't read the models from flash again or
+# reset the camera. A model is loaded again only after release(), the camera
+# is reset again only after sensor_failed() or with another config.
+#
+#   task = kpu_models.init_yolo2(0x200000, 0.5, 0.3, 5, anchor)
+#   task = kpu_models.load(0x300000)
+#   kpu_models.init_sensor(sensor.RGB565, sensor.QVGA, vflip=True)
+
+_models = {}    # flash address: task
+_yolo = {}      # flash address: init_yolo2 args
+_sensor = None  # camera config
+stats = {
+    "loads": 0,
+    "hits": 0,
+    "sensor_resets": 0
+}
+
+
+def load(addr):
+    task = _models.get(addr)
+    if task is not None:
+        stats["hits"] += 1
+        return task
+    task = kpu.load(addr)
+    _models[addr] = task
+    stats["loads"] += 1
+    return task
+
+
+def init_yolo2(addr, threshold, nms, anchor_num, anchor):
+    task = load(addr)
+    args = (threshold, nms, anchor_num, anchor)
+    if _yolo.get(addr) != args:
+        _ = kpu.init_yolo2(task, threshold, nms, anchor_num, anchor)
+        _yolo[addr] = args
+    return task
+
+
+def release(addr):
+    # deinit model, next load() reads it from flash, e.g. after kpu errors
+    task = _models.pop(addr, None)
+    _yolo.pop(addr, None)
+    if task is not None:
+        try:
+            _ = kpu.deinit(task)
+        except Exception:
+            pass
+
+
+def release_all():
+    for addr in list(_models):
+        release(addr)
+
+
+def init_sensor(pixformat, framesize, vflip=False, hmirror=False):
+    # @return True if camera was reset
+    global _sensor
+    config = (pixformat, framesize, vflip, hmirror)
+    if _sensor == config:
+        return False
+    _sensor = None
+    sensor.reset()
+    sensor.set_pixformat(pixformat)
+    sensor.set_framesize(framesize)
+    if hmirror:
+        sensor.set_hmirror(1)
+    if vflip:
+        sensor.set_vflip(1)
+    _sensor = config
+    stats["sensor_resets"] += 1
+    return True
+
+
+def sensor_failed():
+    # next init_sensor() resets the camera
+    global _sensor
+    _sensor = None
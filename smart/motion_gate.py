@@ -0,0 +1,109 @@
+import time
+
+# Skip face detection while nothing moves in front of the camera.
+# The frame is downscaled to `size` and turned to gray, compared with a
+# running background, a pixel changed if its difference is over a threshold
+# that follows the camera noise (EMA of the mean difference). Detection runs
+# when enough pixels changed, while a face is tracked or was seen in the last
+# `hold` s, and every `idle_interval` s when idle.
+#
+#   gate = Motion_Gate()
+#   if gate.check(img, active=bool(tracker.tracks)):
+#       kpu.run_yolo2(...)
+
+
+class Motion_Gate:
+    def __init__(self, size=(32, 24), idle_interval=5, hold=3, area_ratio=0.02,
+                 noise_k=4, min_thresh=8, learn_shift=3, idle_sleep_ms=50):
+        self.size = size
+        self.idle_interval = idle_interval  # s, detection when idle, 0: never
+        self.hold = hold                    # s, keep detecting after motion or face
+        self.area_ratio = area_ratio        # changed pixels / all to be motion
+        self.noise_k = noise_k              # threshold = noise_k * noise
+        self.min_thresh = min_thresh
+        self.learn_shift = learn_shift      # background += (gray - background) >> learn_shift
+        self.idle_sleep_ms = idle_sleep_ms  # sleep when gated, lower frame rate and power
+        self.background = None
+        self.noise = float(min_thresh)      # EMA of mean abs difference
+        self.thresh = min_thresh
+        self.changed = 0                    # changed pixels of last frame
+        self._active_t = -hold * 1000
+        self._idle_t = time.ticks_ms()
+        self.stats = {
+            "frames": 0,
+            "motion": 0,
+            "detect": 0,
+            "gated": 0
+        }
+
+    def check(self, img, active=False):
+        # img: camera frame, active: a face is tracked, @return True to run detection
+        moved = self.update(self.gray(img))
+        now = time.ticks_ms()
+        if moved or active:
+            self._active_t = now
+        if now - self._active_t < self.hold * 1000:
+            detect = True
+        elif self.idle_interval and now - self._idle_t >= self.idle_interval * 1000:
+            detect = True
+        else:
+            detect = False
+        if detect:
+            self._idle_t = now
+            self.stats["detect"] += 1
+        else:
+            self.stats["gated"] += 1
+            if self.idle_sleep_ms:
+                time.sleep_ms(self.idle_sleep_ms)
+        return detect
+
+    def gray(self, img):
+        # downscaled gray pixels of img, bytearray w * h
+        w, h = self.size
+        small = img.resize(w, h)
+        out = bytearray(w * h)
+        i = 0
+        for y in range(h):
+            for x in range(w):
+                p = small.get_pixel(x, y)
+                if type(p) == tuple:
+                    p = (p[0] * 77 + p[1] * 150 + p[2] * 29) >> 8
+                out[i] = p
+                i += 1
+        del small
+        return out
+
+    def update(self, gray):
+        # compare with background and learn, @return True if motion
+        self.stats["frames"] += 1
+        bg = self.background
+        if bg is None or len(bg) != len(gray):
+            self.background = bytearray(gray)
+            return True
+        thresh = self.thresh
+        shift = self.learn_shift
+        half = 1 << (shift - 1) if shift else 0
+        changed = 0
+        total = 0
+        for i in range(len(gray)):
+            diff = gray[i] - bg[i]
+            d = -diff if diff < 0 else diff
+            total += d
+            if d > thresh:
+                changed += 1
+            bg[i] += (diff + half) >> shift
+        self.changed = changed
+        moved = changed > self.area_ratio * len(gray)
+        if moved:
+            self.stats["motion"] += 1
+        else:
+            # learn noise only from still frames
+            self.noise += ((total / len(gray)) - self.noise) * 0.1
+            self.thresh = max(self.min_thresh, int(self.noise_k * self.noise))
+        return moved
+
+    def duty(self):
+        # part of frames detection ran on
+        if not self.stats["frames"]:
+            return 1.0
+        return self.stats["detect"] / self.stats["frames"]
@@ -1,32 +1,45 @@
-from fpioa_manager import fm
-from board import board_info
-from machine import UART
 import ustruct
 import time
+from frame_codec import Frame_Spec, Frame_Codec, sum16_be, sum16
+
+KEYS = [
+    # μg/m3 CF=1, Standard particles
+    "pm1.0",
+    "pm2.5",
+    "pm10" ,
+    # μg/m3 Atmospheric 
+    "pm1.0_atm",
+    "pm2.5_atm",
+    "pm10_atm",
+    # Number of particles with a diameter of `x` um or more in 0.1 liter of air
+    "num0.3um",
+    "num0.5um",
+    "num1.0um",
+    "num2.5um",
+    "num5.0um",
+    "num10um",
+    "version",
+    "err_code"]
+
+# 0x42 0x4d, length(H), data or command ack, checksum(H): sum of all bytes before
+FRAME = Frame_Spec(
+    header=b"\x42\x4d",
+    length_field=(2, ">H", 4),
+    max_size=40,
+    checksum=sum16_be,
+    layouts=[
+        ("data", None, ">HHHHHHHHHHHHHHBBH", [None, None] + KEYS + [None]),
+        ("ack", None, ">HHBBH", [None, None, "cmd", "data", None])
+    ])
+
 
 class PMS7003:
     def __init__(self, uart_obj, on_data):
         self.uart = uart_obj
         self.on_data = on_data
         self.data_mode_active = None
-        self.keys = [
-            # μg/m3 CF=1, Standard particles
-            "pm1.0",
-            "pm2.5",
-            "pm10" ,
-            # μg/m3 Atmospheric 
-            "pm1.0_atm",
-            "pm2.5_atm",
-            "pm10_atm",
-            # Number of particles with a diameter of `x` um or more in 0.1 liter of air
-            "num0.3um",
-            "num0.5um",
-            "num1.0um",
-            "num2.5um",
-            "num5.0um",
-            "num10um",
-            "version",
-            "err_code"]
+        self.keys = KEYS
+        self.codec = Frame_Codec(FRAME, 128)
 
 
     def run(self):
@@ -37,13 +50,24 @@ class PMS7003:
         elif self.data_mode_active:
             if self.uart.any():
                 read_data = self.uart.read()
-
         else:
             read_data = self.read_passive()
-        if read_data:
-            data = self._decode(read_data)
-            if data and self.on_data:
-                self.on_data(data)
+        self.handle(read_data)
+
+    def handle(self, read_data, discard=False):
+        # decode bytes read, send data to on_data, @return count of data frames
+        # discard: only count, e.g. frames during warm-up
+        n = 0
+        for name, data in self.codec.frames(read_data):
+            if name == "data":
+                n += 1
+                if self.on_data and not discard:
+                    self.on_data(data)
+        return n
+
+    def passive_cmd(self):
+        # request of passive read, the response is a data frame
+        return self._with_parity(b'\x42\x4d\xe2\x00\x00')
 
     def read_passive(self):
         cmd = b'\x42\x4d\xe2\x00\x00'
@@ -54,10 +78,11 @@ class PMS7003:
         #     return self._decode(ack)
         # return None
     
+    def _with_parity(self, cmd):
+        return cmd + ustruct.pack(">H", sum16(cmd, 0, len(cmd)))
+
     def _send_cmd(self, cmd):
-        parity = sum(list(cmd)) % 0xffff
-        parity = ustruct.pack(">H", parity)
-        cmd += parity
+        cmd = self._with_parity(cmd)
         print("send:", cmd)
         sent_len = self.uart.write(cmd)
         if sent_len != len(cmd):
@@ -83,20 +108,125 @@ class PMS7003:
         ack = self._send_cmd(cmd)
         print("ack:", ack)
 
+    def power_cmd(self, low_power):
+        # command of set_power_mode, to write without waiting ack
+        if low_power:
+            return self._with_parity(b'\x42\x4d\xe4\x00\x00')
+        return self._with_parity(b'\x42\x4d\xe4\x00\x01')
+
     def _decode(self, raw_data):
+        # decode frames in raw_data, @return data of the last data frame or None
         data = None
-        data = ustruct.unpack(">HHHHHHHHHHHHHHBBH",raw_data)
-        if data[0] == 0x424d:
-            parity = sum(list(raw_data)[:-2]) % 0xffff
-            if parity != data[16]:
-                print("check parity error: {}--{}".format(parity, data[15]))
-                return None
-            print(data)
-            data = data[2:-1]
-            data = dict(zip(self.keys, data))
+        for name, values in self.codec.frames(raw_data, flush=True):
+            if name == "data":
+                data = values
         return data
 
+
+class Duty_Cycle:
+    # Sleep the sensor between samples to save power and laser/fan lifetime.
+    # Every `period` s: wake, wait `warmup` s for the airflow to be stable
+    # (datasheet: >= 30s), take `samples` passive readings, sleep again.
+    # If there is no time left to sleep, the sensor keeps running.
+    # Used in place of the sensor by Sensor_Poller: passive_cmd() is None
+    # until warm-up is done, frames out of the sample phase are dropped.
+    SLEEP = 0
+    WARMUP = 1
+    SAMPLE = 2
+
+    def __init__(self, sensor, period=120, warmup=30, samples=5):
+        # sensor: PMS7003 in passive mode, awake
+        self.sensor = sensor
+        self.uart = sensor.uart
+        self.period = int(period * 1000)
+        self.warmup = int(warmup * 1000)
+        self.samples = samples
+        now = time.ticks_ms()
+        self.state = Duty_Cycle.WARMUP
+        self._wake_t = now      # start of this cycle, sampling starts warmup later
+        self._count = 0
+        self._start_t = now
+        self._up_t = now        # woken up at
+        self.stats = {
+            "wakes": 1,
+            "awake_ms": 0,      # finished awake spans
+            "samples": 0,
+            "discard": 0,       # frames got out of the sample phase
+            "short": 0          # cycles end before enough samples
+        }
+
+    def run(self):
+        now = time.ticks_ms()
+        if self.state == Duty_Cycle.SLEEP:
+            if now - self._wake_t >= 0:
+                print("--pms7003 wake up")
+                self.uart.write(self.sensor.power_cmd(low_power=False))
+                self.stats["wakes"] += 1
+                self._up_t = now
+                self._wake_t = now
+                self._count = 0
+                self.state = Duty_Cycle.WARMUP
+        elif self.state == Duty_Cycle.WARMUP:
+            if now - self._wake_t >= self.warmup:
+                self.state = Duty_Cycle.SAMPLE
+        elif now - self._wake_t - self.warmup >= self.period:
+            # sensor not responding in a whole period, don't keep it awake
+            self.stats["short"] += 1
+            self._end_sample(now)
+
+    def passive_cmd(self):
+        if self.state != Duty_Cycle.SAMPLE:
+            return None
+        return self.sensor.passive_cmd()
+
+    def handle(self, read_data):
+        if self.state != Duty_Cycle.SAMPLE:
+            self.stats["discard"] += self.sensor.handle(read_data, discard=True)
+            return 0
+        n = self.sensor.handle(read_data)
+        self._count += n
+        self.stats["samples"] += n
+        if self._count >= self.samples:
+            self._end_sample(time.ticks_ms())
+        return n
+
+    def _end_sample(self, now):
+        next_t = self._wake_t + self.period
+        self._count = 0
+        if next_t - now <= self.warmup:
+            # sleep shorter than warm-up, keep running and sample at next_t
+            self._wake_t = next_t
+            self.state = Duty_Cycle.WARMUP
+            return
+        self.uart.write(self.sensor.power_cmd(low_power=True))
+        self.stats["awake_ms"] += now - self._up_t
+        self._wake_t = next_t
+        self.state = Duty_Cycle.SLEEP
+
+    def awake_ms(self):
+        now = time.ticks_ms()
+        awake = self.stats["awake_ms"]
+        if self.state != Duty_Cycle.SLEEP:
+            awake += now - self._up_t
+        return awake
+
+    def duty(self):
+        # awake time / time since created, 1.0 is continuous mode
+        total = time.ticks_ms() - self._start_t
+        if total <= 0:
+            return 1.0
+        return self.awake_ms() / total
+
+    def lines(self):
+        return ["pms7003 awake {:.0f}% ({}s of {}s), {} wakes, {} discard".format(
+            self.duty() * 100, self.awake_ms() // 1000, (time.ticks_ms() - self._start_t) // 1000,
+            self.stats["wakes"], self.stats["discard"])]
+
+
 if __name__ == "__main__":
+    from fpioa_manager import fm
+    from machine import UART
+
     fm.register(24, fm.fpioa.UART1_TX, force=True)
     fm.register(25, fm.fpioa.UART1_RX, force=True)
     uart = UART(UART.UART1, 9600, 8, 0, 0, timeout=1000, read_buf_len=1024)
@@ -0,0 +1,118 @@
+import array
+import time
+
+# Time of the stages of a loop, last `size` samples of every stage in one
+# preallocated array, so recording is a subtraction and an add, cheap
+# enough to keep on. A stage lapped several times in a loop (once per face)
+# is summed, every stage run in the loop gets one sample at frame().
+# Percentiles sort a copy, only when asked.
+#
+#   prof = Profiler(("snapshot", "yolo"))
+#   t = prof.start()
+#   img = sensor.snapshot()
+#   t = prof.lap(0, t)      # stage 0, @return now for the next stage
+#   ...
+#   prof.frame()            # end of a loop, fps
+
+
+class Profiler:
+    def __init__(self, stages, size=64, slowest_every=16):
+        self.stages = stages
+        self.size = size
+        self.samples = array.array("I", [0] * (size * (len(stages) + 1)))   # us, last row is frame time
+        self.pos = array.array("H", [0] * (len(stages) + 1))
+        self.count = array.array("I", [0] * (len(stages) + 1))
+        self._sum = array.array("I", [0] * len(stages))     # us of every stage in this loop
+        self._laps = array.array("H", [0] * len(stages))
+        self.enabled = True
+        self._frame_t = time.ticks_us()
+        self.slowest_every = slowest_every   # frames, draw() sorts the rings this often
+        self._slowest = (None, 0)
+
+    def start(self):
+        return time.ticks_us()
+
+    def lap(self, stage, t):
+        now = time.ticks_us()
+        if self.enabled:
+            self._sum[stage] += now - t
+            self._laps[stage] += 1
+        return now
+
+    def add(self, stage, us):
+        i = self.pos[stage]
+        self.samples[stage * self.size + i] = us
+        i += 1
+        self.pos[stage] = 0 if i == self.size else i
+        self.count[stage] += 1
+
+    def frame(self):
+        now = time.ticks_us()
+        if self.enabled:
+            for i in range(len(self.stages)):
+                if self._laps[i]:
+                    self.add(i, self._sum[i])
+                    self._sum[i] = 0
+                    self._laps[i] = 0
+            stage = len(self.stages)
+            self.add(stage, now - self._frame_t)
+            if self.count[stage] % self.slowest_every == 0:
+                self._slowest = self.slowest()
+        self._frame_t = now
+
+    def reset(self):
+        for i in range(len(self.pos)):
+            self.pos[i] = 0
+            self.count[i] = 0
+        for i in range(len(self.stages)):
+            self._sum[i] = 0
+            self._laps[i] = 0
+        self._slowest = (None, 0)
+        self._frame_t = time.ticks_us()
+
+    def percentile(self, stage, p):
+        # us, None if no sample
+        n = min(self.count[stage], self.size)
+        if not n:
+            return None
+        start = stage * self.size
+        values = sorted(self.samples[start:start + n])
+        return values[min(n - 1, n * p // 100)]
+
+    def fps(self):
+        stage = len(self.stages)
+        n = min(self.count[stage], self.size)
+        if not n:
+            return 0
+        start = stage * self.size
+        total = sum(self.samples[start:start + n])
+        return n * 1000000 / total if total else 0
+
+    def slowest(self):
+        # (stage name, p50 us) of the stage with the biggest median
+        best = (None, 0)
+        for i in range(len(self.stages)):
+            p50 = self.percentile(i, 50)
+            if p50 is not None and p50 > best[1]:
+                best = (self.stages[i], p50)
+        return best
+
+    def lines(self):
+        lines = ["{:<10}{:>7}{:>8}{:>8}{:>8}".format("stage", "count", "p50ms", "p95ms", "maxms")]
+        for i in range(len(self.stages) + 1):
+            if not self.count[i]:
+                continue
+            name = self.stages[i] if i < len(self.stages) else "frame"
+            lines.append("{:<10}{:>7}{:>8.1f}{:>8.1f}{:>8.1f}".format(
+                name, self.count[i], self.percentile(i, 50) / 1000,
+                self.percentile(i, 95) / 1000, self.percentile(i, 100) / 1000))
+        return lines
+
+    def draw(self, img, x=0, y=0, color=(255, 255, 0)):
+        # fps and slowest stage overlay, slowest stage is found again every slowest_every frames
+        name, p50 = self._slowest
+        text = "{:.1f}fps".format(self.fps())
+        if name:
+            text += " {} {}ms".format(name, p50 // 1000)
+        img.draw_string(x, y, text, color=color)
+        return img
@@ -0,0 +1,204 @@
+import os
+import ustruct
+
+# Keep property reports in flash while the server is not connected.
+# Records are appended to segment files `<prefix><n>.bin`, a segment is never
+# rewritten, it's removed when all of its records are replayed, or when the
+# store is full (drop oldest). The replay position in the first segment is
+# kept in `<prefix>pos` so records committed before a reboot aren't replayed
+# again.
+#
+# record: magic(B) length(H) timestamp(I) items(B) [item...] checksum(B)
+# item:   key_len(B) key type(B) value, type: i int32, f float32, b bool, s str(len(B) + bytes)
+
+_MAGIC = 0xA5
+_HEAD = "<BHIB"
+_HEAD_LEN = 8
+_POS = "<II"
+
+
+class Report_Store:
+    def __init__(self, prefix="rq_", seg_size=4096, seg_max=8, buf_size=256):
+        self.prefix = prefix
+        self.seg_size = seg_size
+        self.seg_max = seg_max
+        self._buf = bytearray(buf_size)   # records not written to flash yet
+        self._buf_len = 0
+        self._segs = []
+        for name in os.listdir():
+            if name.startswith(prefix) and name.endswith(".bin"):
+                try:
+                    self._segs.append(int(name[len(prefix):-4]))
+                except ValueError:
+                    pass
+        self._segs.sort()
+        self._write_size = self._size(self._segs[-1]) if self._segs else 0
+        self._read_off = self._load_pos()
+        self.stats = {
+            "stored": 0,
+            "replayed": 0,
+            "skipped": 0,      # records given up after replay_retries failed replays
+            "dropped_segs": 0,
+            "bad": 0
+        }
+
+    def any(self):
+        return self._buf_len > 0 or len(self._segs) > 1 or (
+            len(self._segs) == 1 and self._read_off < self._write_size)
+
+    def append(self, ts, data):
+        rec = self._pack(ts, data)
+        if not rec:
+            return False
+        if self._buf_len + len(rec) > len(self._buf):
+            self.flush()
+        if len(rec) > len(self._buf):
+            self._write(rec)
+        else:
+            self._buf[self._buf_len:self._buf_len + len(rec)] = rec
+            self._buf_len += len(rec)
+        self.stats["stored"] += 1
+        return True
+
+    def flush(self):
+        if self._buf_len:
+            self._write(self._buf[:self._buf_len])
+            self._buf_len = 0
+
+    def peek(self, max_records=8):
+        # @return [(ts, data, pos), ...], call commit(pos) after records before pos sent
+        self.flush()
+        if not self._segs:
+            return []
+        seg = self._segs[0]
+        with open(self._name(seg), "rb") as f:
+            f.seek(self._read_off)
+            raw = f.read(self.seg_size)
+        records = []
+        off = 0
+        while len(records) < max_records and off + _HEAD_LEN < len(raw):
+            rec = self._unpack(raw, off)
+            if rec is None:
+                # broken record (power lost while writing), skip the rest of segment
+                self.stats["bad"] += 1
+                self.commit((seg, self._read_off + len(raw)))
+                break
+            off = rec[2]
+            records.append((rec[0], rec[1], (seg, self._read_off + off)))
+        return records
+
+    def commit(self, pos):
+        if not pos or not self._segs or pos[0] != self._segs[0]:
+            return
+        seg, off = pos
+        self._read_off = off
+        size = self._write_size if seg == self._segs[-1] else self._size(seg)
+        if off >= size:
+            self._remove(seg)
+            self._read_off = 0
+        # offset 0 after removed, numbers start from 0 again when store is empty
+        self._save_pos(seg, self._read_off)
+
+    def _load_pos(self):
+        # offset in the first segment, 0 if position is of a removed segment
+        try:
+            with open(self.prefix + "pos", "rb") as f:
+                seg, off = ustruct.unpack(_POS, f.read(8))
+        except Exception:
+            return 0
+        if self._segs and seg == self._segs[0] and off <= self._size(seg):
+            return off
+        return 0
+
+    def _save_pos(self, seg, off):
+        with open(self.prefix + "pos", "wb") as f:
+            f.write(ustruct.pack(_POS, seg, off))
+
+    def _write(self, data):
+        if not self._segs or self._write_size + len(data) > self.seg_size:
+            self._segs.append(self._segs[-1] + 1 if self._segs else 0)
+            self._write_size = 0
+            while len(self._segs) > self.seg_max:
+                self._remove(self._segs[0])
+                self._read_off = 0
+                self.stats["dropped_segs"] += 1
+        with open(self._name(self._segs[-1]), "ab") as f:
+            f.write(data)
+        self._write_size += len(data)
+
+    def _remove(self, seg):
+        try:
+            os.remove(self._name(seg))
+        except OSError:
+            pass
+        self._segs.remove(seg)
+        if not self._segs:
+            self._write_size = 0
+
+    def _name(self, seg):
+        return "{}{}.bin".format(self.prefix, seg)
+
+    def _size(self, seg):
+        try:
+            return os.stat(self._name(seg))[6]
+        except OSError:
+            return 0
+
+    def _pack(self, ts, data):
+        items = []
+        for key in data:
+            value = data[key]
+            key_b = key.encode()
+            if type(value) == bool:
+                item = ustruct.pack("<B", len(key_b)) + key_b + b"b" + ustruct.pack("<B", 1 if value else 0)
+            elif type(value) == int:
+                item = ustruct.pack("<B", len(key_b)) + key_b + b"i" + ustruct.pack("<i", value)
+            elif type(value) == float:
+                item = ustruct.pack("<B", len(key_b)) + key_b + b"f" + ustruct.pack("<f", value)
+            elif type(value) == str:
+                value = value.encode()[:255]
+                item = ustruct.pack("<B", len(key_b)) + key_b + b"s" + ustruct.pack("<B", len(value)) + value
+            else:
+                continue
+            items.append(item)
+        if not items:
+            return None
+        body = b"".join(items)
+        rec = ustruct.pack(_HEAD, _MAGIC, _HEAD_LEN + len(body) + 1, ts, len(items)) + body
+        return rec + ustruct.pack("<B", sum(rec) & 0xFF)
+
+    def _unpack(self, raw, off):
+        # @return (ts, data, next offset) or None
+        magic, length, ts, n = ustruct.unpack_from(_HEAD, raw, off)
+        end = off + length
+        if magic != _MAGIC or end > len(raw) or length <= _HEAD_LEN:
+            return None
+        if sum(raw[off:end - 1]) & 0xFF != raw[end - 1]:
+            return None
+        data = {}
+        i = off + _HEAD_LEN
+        try:
+            for _ in range(n):
+                key_len = raw[i]
+                key = bytes(raw[i + 1:i + 1 + key_len]).decode()
+                i += 1 + key_len
+                t = raw[i]
+                i += 1
+                if t == 0x62:   # b
+                    data[key] = raw[i] != 0
+                    i += 1
+                elif t == 0x69: # i
+                    data[key] = ustruct.unpack_from("<i", raw, i)[0]
+                    i += 4
+                elif t == 0x66: # f
+                    data[key] = ustruct.unpack_from("<f", raw, i)[0]
+                    i += 4
+                elif t == 0x73: # s
+                    str_len = raw[i]
+                    data[key] = bytes(raw[i + 1:i + 1 + str_len]).decode()
+                    i += 1 + str_len
+                else:
+                    return None
+        except Exception:
+            return None
+        return ts, data, end
@@ -0,0 +1,67 @@
+import time
+
+# Poll passive mode sensors without blocking: send the read request of every
+# due sensor at once, then collect the responses in later run() calls, every
+# request has its own deadline.
+# A sensor provides: uart, passive_cmd() -> request bytes or None to skip,
+# handle(read bytes or None) -> count of data frames, data is sent to its on_data,
+# None while waiting and nothing read, so a decoder can give out a held frame
+
+
+class Sensor_Poller:
+    def __init__(self):
+        self.sensors = []   # [name, sensor, interval ms, timeout ms, next poll ticks, sent ticks or -1]
+        self.stats = {}     # name: {...}
+
+    def add(self, name, sensor, interval, timeout=500):
+        # interval: s, timeout: ms
+        self.sensors.append([name, sensor, int(interval * 1000), timeout, time.ticks_ms(), -1])
+        self.stats[name] = {
+            "polls": 0,
+            "ok": 0,
+            "timeout": 0,
+            "late": 0,      # response came after timeout
+            "lat_last": 0,  # ms, request to response
+            "lat_max": 0,
+            "lat_sum": 0
+        }
+
+    def run(self):
+        now = time.ticks_ms()
+        for item in self.sensors:
+            name, sensor, interval, timeout, next_t, sent_t = item
+            stats = self.stats[name]
+            if sent_t >= 0:
+                if sensor.handle(sensor.uart.read() if sensor.uart.any() else None):
+                    latency = now - sent_t
+                    stats["ok"] += 1
+                    stats["lat_last"] = latency
+                    stats["lat_sum"] += latency
+                    if latency > stats["lat_max"]:
+                        stats["lat_max"] = latency
+                    item[5] = -1
+                elif now - sent_t > timeout:
+                    stats["timeout"] += 1
+                    print("--[WARNING] sensor {} no response in {}ms".format(name, timeout))
+                    item[5] = -1
+            elif now - next_t >= 0:
+                if sensor.uart.any() and sensor.handle(sensor.uart.read()):
+                    stats["late"] += 1
+                cmd = sensor.passive_cmd()
+                if not cmd:
+                    # not ready, e.g. sleeping, ask again next run
+                    continue
+                sensor.uart.write(cmd)
+                stats["polls"] += 1
+                item[4] = now + interval
+                item[5] = now
+
+    def lines(self):
+        # text lines for LCD or console
+        lines = []
+        for name, sensor, interval, timeout, next_t, sent_t in self.sensors:
+            stats = self.stats[name]
+            lines.append("{}: {}/{} ok, {} timeout, lat {}ms avg {}ms max".format(
+                name, stats["ok"], stats["polls"], stats["timeout"],
+                stats["lat_sum"] // stats["ok"] if stats["ok"] else 0, stats["lat_max"]))
+        return lines
@@ -2,22 +2,52 @@ import time
 import json
 import ure
 import image, lcd
-from explorer import Explorer_AT
+from explorer import Explorer_AT, PRIO_HIGH, PRIO_LOW
+from conn_mgr import Conn_Manager, STATE_SUBSCRIBED
 from Maix import GPIO
 from machine import UART
 from fpioa_manager import fm
-from pms7003 import PMS7003
+from pms7003 import PMS7003, Duty_Cycle
 from ws_h3 import WS_H3
+from report_store import Report_Store
+from aggregate import Aggregator
+from sensor_poller import Sensor_Poller
+from uart_capture import Capture_Log
+from history import History, draw_trend
+
+
+# LCD pages: name, refresh ms (0: on change), trend span s
+PAGES = (
+    ("panel", 0, 0),
+    ("trend", 60000, 24 * 3600),
+    ("trend", 600000, 30 * 86400),
+    ("trend", 3600000, 365 * 86400),
+    ("diag", 1000, 0)       # AT command metrics
+)
 
 
 class App:
-    def __init__(self, product_key, device_name, device_key, product_secret=None):
+    def __init__(self, product_key, device_name, device_key, product_secret=None, uart_baud=115200, capture=None):
         self.product_key = product_key
         self.device_name = device_name
         self.device_key = device_key
         self.product_secret = product_secret
+        self.uart_baud = uart_baud
+        # record uart traffic to file for tools/replay_uart.py, e.g. "/sd/uart.cap"
+        self.capture = Capture_Log(capture) if capture else None
+        # window means every report_interval, minute/hour/day tiers in flash
+        self.history = History(["pm2_5", "pm1_0", "pm10", "hcho_ug", "hcho_ppb"])
+        # keep sensor data in flash when server is not connected, and report later,
+        # opened once, init0 runs again after errors and records in RAM must be kept
+        self.store = Report_Store("rq_", seg_size=4096, seg_max=8)
+        self.page = 0 # PAGE_*, short push of button switches
         self.init0()
 
+    def _uart(self, uart, name):
+        if self.capture:
+            return self.capture.wrap(uart, name)
+        return uart
+
     def init0(self):
         fm.register(8, fm.fpioa.GPIOHS1, force=True)
         fm.register(12, fm.fpioa.GPIOHS2, force=True)
@@ -29,19 +59,25 @@ class App:
         self.led_g=GPIO(GPIO.GPIOHS2, GPIO.OUT)
         self.led_b=GPIO(GPIO.GPIOHS6, GPIO.OUT)
         self.button=GPIO(GPIO.GPIOHS3, GPIO.PULL_UP)
-        self.uart = UART(UART.UART2,115200,timeout=1000, read_buf_len=4096)
+        self.uart = self._uart(UART(UART.UART2,115200,timeout=1000, read_buf_len=4096), "explorer")
 
         self.led_g.value(1)
         self.led_b.value(1)
         self.wifi_rst_btn.value(1)
         lcd.init()
 
+        # device info set to the module is kept after an error, so Conn_Manager
+        # skips config when it's not changed
+        configured = self.explorer.configured if getattr(self, "explorer", None) else None
         self.explorer = Explorer_AT(self.uart, self.on_msg)
+        if configured:
+            self.explorer.set_device(*configured)
         self.smartconfiging = False
         self.wifi_ip = ""
         self.server_conn = False
         self.show_text = ""
         self.button_down_t = -1
+        self._page_t = 0
         self.explorer.data = {
             "pm2_5": 0,
             "pm1_0": 0,
@@ -50,33 +86,65 @@ class App:
             "hcho_ug": 0,
             "hcho_ppb": 0
         }
-
+        self.explorer.priority = {
+            "light": PRIO_HIGH,
+            "pm2_5": PRIO_LOW,
+            "pm1_0": PRIO_LOW,
+            "pm10": PRIO_LOW,
+            "hcho_ug": PRIO_LOW,
+            "hcho_ppb": PRIO_LOW
+        }
+        pm_policy = {"deadband": 3, "deadband_rel": 0.1, "min_interval": 10, "heartbeat": 300}
+        hcho_policy = {"deadband": 5, "deadband_rel": 0.1, "min_interval": 10, "heartbeat": 300}
+        self.explorer.policy = {
+            "pm2_5": pm_policy,
+            "pm1_0": pm_policy,
+            "pm10": pm_policy,
+            "hcho_ug": hcho_policy,
+            "hcho_ppb": hcho_policy
+        }
+        self.explorer.store = self.store
+        self.explorer.store_keys = ["pm2_5", "pm1_0", "pm10", "hcho_ug", "hcho_ppb"]
+        self.explorer.replay_interval = 2000
+        # PMS7003 sleeps between samples, wakes 30s before sampling to be stable
+        self.pms7003_up_interval = 120 # s
+        self.pms7003_samples = 5
+        # average readings between reports, pm of the last PMS7003 wake
+        self.agg = Aggregator({
+            "pm2_5": self.pms7003_samples,
+            "pm1_0": self.pms7003_samples,
+            "pm10": self.pms7003_samples,
+            "hcho_ug": 12,
+            "hcho_ppb": 12
+        })
+        self.report_interval = 20 # s, update explorer.data with window mean
+        self._report_t = time.ticks_ms()
+
+        # read sensors in passive mode at the same time, not blocking
+        self.poller = Sensor_Poller()
         self._init_pm2_5()
         self._init_hcho()
 
     def _init_pm2_5(self):
         fm.register(9, fm.fpioa.UART1_TX, force=True)
         fm.register(10, fm.fpioa.UART1_RX, force=True)
-        uart = UART(UART.UART1, 9600, 8, 0, 0, timeout=1000, read_buf_len=1024)
+        uart = self._uart(UART(UART.UART1, 9600, 8, 0, 0, timeout=1000, read_buf_len=1024), "pms7003")
 
         self.pms7003 = PMS7003(uart, self.on_pm2_5_data)
         self.pms7003.set_power_mode(low_power = False)
         self.pms7003.set_data_mode(active = False)
-
-        self.pms7003_up_interval = 20 # s
-        self._pms7003_last_up_t = -20
+        self.pms7003_duty = Duty_Cycle(self.pms7003, period=self.pms7003_up_interval, warmup=30, samples=self.pms7003_samples)
+        self.poller.add("pms7003", self.pms7003_duty, interval=2, timeout=500)
     
     def _init_hcho(self):
         fm.register(34, fm.fpioa.UART3_TX, force=True)
         fm.register(33, fm.fpioa.UART3_RX, force=True)
-        uart = UART(UART.UART3, 9600, 8, 0, 0, timeout=1000, read_buf_len=1024)
+        uart = self._uart(UART(UART.UART3, 9600, 8, 0, 0, timeout=1000, read_buf_len=1024), "ws_h3")
 
         self.ws_h3 = WS_H3(uart, self.on_hcho_data)
         # ws_h3.set_power_mode(low_power = False)
         self.ws_h3.set_data_mode(active = False)
-
-        self.ws_h3_up_interval = 20 # s
-        self._ws_h3_last_up_t = -20
+        self.poller.add("ws_h3", self.ws_h3, interval=5, timeout=500)
 
     def show(self, text=None, wifi_ip=None, server_conn=None, append=False, print_text=True):
         if not text is None:
@@ -116,19 +184,34 @@ class App:
         self.explorer.data["hcho_ppb"] = ppb
 
     def on_pm2_5_data(self, data):
-        print("--read pm2.5 data:", data)
-        self.explorer.data["pm2_5"] = data["pm2.5"]
-        self.explorer.data["pm1_0"] = data["pm1.0"]
-        self.explorer.data["pm10"] = data["pm10"]
-        self.explorer.notify_report(["pm2_5", "pm1_0", "pm10"])
-        self.show()
+        self.agg.add("pm2_5", data["pm2.5"])
+        self.agg.add("pm1_0", data["pm1.0"])
+        self.agg.add("pm10", data["pm10"])
 
     def on_hcho_data(self, data):
-        print("--read hcho data:", data)
-        self.explorer.data["hcho_ug"] = data["value_ug_m3"]
-        self.explorer.data["hcho_ppb"] = data["value_ppb"]
-        self.explorer.notify_report(["hcho_ug", "hcho_ppb"])
-        self.show()
+        if "value_ppb" not in data:
+            return
+        self.agg.add("hcho_ug", data["value_ug_m3"])
+        self.agg.add("hcho_ppb", data["value_ppb"])
+
+    def update_sensor_data(self):
+        # window mean to explorer.data, policy decides if report
+        keys = []
+        for key in self.agg.channels:
+            value = self.agg.mean(key)
+            if value is None:
+                continue
+            self.explorer.data[key] = int(value + 0.5)
+            keys.append(key)
+        if keys:
+            # only channels with readings in the window, not the 0 placeholders
+            # while the PMS7003 warms up or sleeps
+            self.history.add(dict((key, self.explorer.data[key]) for key in keys))
+            print("--sensor data:", [(key, self.explorer.data[key]) for key in keys])
+            for line in self.poller.lines() + self.pms7003_duty.lines():
+                print("--", line)
+            self.explorer.notify_report(keys)
+            self.show()
 
     def set_hint_led(self, on):
         self.led_b.value(0 if on else 1)
@@ -148,41 +231,24 @@ class App:
             print("--report reply, id:{}, status:{}".format(msg["clientToken"], msg["status"]) )
         
 
-    def try_connect(self):
-        ip = self.explorer.get_ip()
-        self.show(wifi_ip=ip)
-        print("IP:", ip)
-        if ip:
-            text = "config..."
-            self.show(text=text, print_text=True)
-            self.explorer.config(self.product_key, self.device_name, self.device_key, self.product_secret)
-            text ="--config ok"
-            self.show(text=text, append=True, print_text=True)
-            text = "connect to server..."
-            self.show(text=text, append=True, print_text=True)
-            try:
-                self.explorer.connect()
-                self.show(text="connect to server ok", server_conn=True, append=True, print_text=True)
-                self.on_connect()
-            except Exception as e:
-                self.explorer.server_conn = False
-                print("--connect expoler fail: ", e)
-                self.show(text="connect server fail", server_conn=False, append=True, print_text=True)
-        else:
+    def on_conn_state(self, state, ip):
+        connected = state == STATE_SUBSCRIBED
+        self.show(wifi_ip=ip, server_conn=connected)
+        if connected:
+            self.show(text="connect to server ok", append=True, print_text=True)
+            self.on_connect()
+        elif not ip:
             print("no IP, wait or long push func button to start config WiFi")
             text = "Wait or long push button to config WiFi"
             self.show(text=text)
 
     def on_connect(self):
         keys = list(self.explorer.data.keys())
-        keys = [keys[:len(keys)//2], keys[len(keys)//2:]]
         print("on_connect", keys)
-        self.explorer.notify_report(keys)
+        self.explorer.notify_report(keys, force=True)
 
     def main_loop(self):
-        if not self.wifi_ip:
-            time.sleep_ms(2000)
-            self.try_connect()
+        self.conn.run()
 
         if self.button.value() == 0:
             time.sleep_ms(20)
@@ -201,23 +267,30 @@ class App:
                                 self.explorer.smartconfig()
                                 wifi_ip = self.explorer.get_ip()
                                 print("-- smartconfig success, ip:", wifi_ip)
-                                self.show(wifi_ip=wifi_ip, server_conn=True)
-                                self.on_connect()
+                                self.show(wifi_ip=wifi_ip)
                             except Exception:
                                 print("--[ERROR] smartconfig fail")
                                 self.show(wifi_ip="null", server_conn=False)
+                            self.conn.reset() # connect to server again
                             self.set_hint_led(False)
                             self.smartconfiging = False
         else:
+            if self.button_down_t >= 0 and time.ticks_ms() - self.button_down_t < 1000:
+                # short push, next page
+                self.page = (self.page + 1) % len(PAGES)
+                self.show_update()
             self.button_down_t = -1
-            # sensors
-            if self.server_conn:
-                if time.ticks_ms() - self._pms7003_last_up_t * 1000 > self.pms7003_up_interval * 1000: # TODO: overflow deal
-                    self.pms7003.run()
-                    self._pms7003_last_up_t = time.ticks_ms() / 1000.0
-                if time.ticks_ms() - self._ws_h3_last_up_t * 1000 > self.ws_h3_up_interval * 1000: # TODO: overflow deal
-                    self.ws_h3.run()
-                    self._ws_h3_last_up_t = time.ticks_ms()  / 1000.0
+            refresh = PAGES[self.page][1]
+            if refresh and time.ticks_ms() - self._page_t > refresh:
+                self.show_update()
+            # sensors, keep reading when server not connected, explorer.store keeps the data
+            self.pms7003_duty.run()
+            self.poller.run()
+            if self.capture:
+                self.capture.run()
+            if time.ticks_ms() - self._report_t > self.report_interval * 1000:
+                self._report_t = time.ticks_ms()
+                self.update_sensor_data()
 
 
     def get_pannel(self):
@@ -238,6 +311,19 @@ class App:
         return img
 
     def show_update(self):
+        name = PAGES[self.page][0]
+        if name != "panel":
+            self._page_t = time.ticks_ms()
+            img = image.Image(size=(320, 240))
+            if name == "diag":
+                self.explorer.metrics.draw(img)
+            else:
+                span = PAGES[self.page][2]
+                draw_trend(img, self.history, "pm2_5", span, 0, 0, 320, 120, title="PM2.5 ug/m3")
+                draw_trend(img, self.history, "hcho_ug", span, 0, 120, 320, 120, color=(255, 255, 0), title="HCHO ug/m3")
+            lcd.display(img)
+            del img
+            return
         pos = (0, 40)
         color = (255, 255, 255)
         scale = 1
@@ -253,12 +339,15 @@ class App:
         self.show(text=text)
         self.explorer.wifi_reset(self.wifi_rst_btn)
         print("reset ok")
+        self.explorer.set_baud(self.uart_baud, self.wifi_rst_btn)
         if not self.device_name:
             mac = self.explorer.get_mac()
             if not mac:
                 raise Exception("can not get MAC address")
             self.device_name = mac.replace(":", "_")
         print("device name:", self.device_name)
+        self.conn = Conn_Manager(self.explorer, self.product_key, self.device_name, self.device_key,
+                                 self.product_secret, on_state=self.on_conn_state)
 
         #print("reset config")
         #self.explorer.restore_config()
@@ -284,7 +373,9 @@ if __name__ == "__main__":
             "product_key": "",
             "device_name": "",
             "device_key": "",
-            "product_secret": "null"
+            "product_secret": "null",
+            "uart_baud": 115200,
+            "capture": ""
         }'''
         with open(config_name, "w") as f:
             f.write(config)
@@ -296,7 +387,8 @@ if __name__ == "__main__":
         import sys
         print("config:", config)
         sys.exit("config error, please config first at explorer.conf")
-    app = App(config["product_key"], config["device_name"], config["device_key"], config["product_secret"])
+    app = App(config["product_key"], config["device_name"], config["device_key"], config["product_secret"],
+              config.get("uart_baud", 115200), config.get("capture"))
 
     while 1:
         try:
@@ -0,0 +1,298 @@
+# CPython stand-in for the ESP8266 with Tencent AT firmware, used as the UART
+# object of Explorer_AT on a Linux box. It understands the commands explorer.py
+# sends, and can add per command latency, limit throughput to the baud rate,
+# drop bytes and answer ERROR/FAIL on purpose. Bytes are garbled when the K210
+# side baud (init()) doesn't match the module (AT+UART_CUR), or is over max_baud.
+#
+#   sim = ESP_AT_Sim(baud=115200, latency={"AT+TCMQTTPUB": 0.05}, drop_rate=0, fail_rate=0)
+#   explorer = Explorer_AT(sim, on_msg)
+import json
+import random
+import time
+
+# s, time from command received to reply
+DEFAULT_LATENCY = {
+    "AT": 0.001,
+    "AT+CIFSR": 0.005,
+    "AT+TCDEVINFOSET": 0.02,
+    "AT+TCPRDINFOSET": 0.02,
+    "AT+TCDEVREG": 0.5,
+    "AT+TCMQTTCONN": 0.3,
+    "AT+TCMQTTSUB": 0.05,
+    "AT+TCMQTTPUB": 0.03,
+    "AT+TCMQTTDISCONN": 0.02,
+    "AT+TCMQTTSTATE?": 0.002,
+    "AT+TCSTARTSMART": 1.0,
+    "AT+TCRESTORE": 0.05,
+    "AT+UART_CUR": 0.002,
+}
+
+FAIL_REPLY = {
+    "AT+TCDEVREG": "+TCDEVREG:FAIL,1",
+    "AT+TCMQTTCONN": "+TCMQTTCONN:FAIL,202",
+    "AT+TCMQTTSUB": "+TCMQTTSUB:FAIL",
+    "AT+TCMQTTPUB": "+TCMQTTPUB:FAIL,-1\r\nERROR",
+}
+
+
+class ESP_AT_Sim:
+    def __init__(self, baud=115200, latency=None, cloud_latency=0.08, drop_rate=0.0, fail_rate=0.0,
+                 echo=True, ip="192.168.0.123", seed=1, clock=time.monotonic, max_baud=4000000):
+        self.default_baud = baud
+        self.baud = baud        # module side
+        self.host_baud = baud   # K210 side
+        self.max_baud = max_baud # link doesn't work over it
+        self.latency = dict(DEFAULT_LATENCY)
+        if latency:
+            self.latency.update(latency)
+        self.cloud_latency = cloud_latency  # s, publish to report_reply / puback
+        self.drop_rate = drop_rate          # probability a byte sent to K210 is lost
+        self.fail_rate = fail_rate          # probability a command gets ERROR/FAIL
+        self.echo = echo
+        self.ip = ip
+        self.mac = "18:fe:34:de:a6:00"
+        self.clock = clock
+        self.rnd = random.Random(seed)
+        self.product_key = None
+        self.device_name = None
+        self.mqtt = False
+        self.link_down_until = 0
+        self._in = b""
+        self._events = []       # [time, bytes] sorted, bytes start to go out at time
+        self._wire_t = 0        # time the last byte read out left the module
+        self._busy_until = 0    # module handles one command at a time
+        self.stats = {"cmds": 0, "pubs": 0, "fails": 0, "pub_fails": 0, "dropped_bytes": 0, "garbled_bytes": 0,
+                      "bytes_out": 0, "bytes_in": 0}
+        self.downlinks = []     # send time of every downlink, index is the id in clientToken
+
+    # ---- UART interface ----
+
+    def write(self, data):
+        data = bytes(data)
+        now = self.clock()
+        self.stats["bytes_in"] += len(data)
+        # bytes reach the module after they are clocked out at baud rate
+        t = now + len(data) * 10.0 / self.host_baud
+        if not self._link_ok(self.baud):
+            self.stats["garbled_bytes"] += len(data)
+            return len(data)
+        self._in += data
+        while 1:
+            idx = self._in.find(b"\r\n")
+            if idx < 0:
+                break
+            line = self._in[:idx].decode()
+            self._in = self._in[idx + 2:]
+            self._on_cmd(line, t)
+        return len(data)
+
+    def read(self, n=-1):
+        now = self.clock()
+        out = []
+        size = 0
+        while self._events and (n < 0 or size < n):
+            t, data, baud = self._events[0]
+            end = max(t, self._wire_t) + len(data) * 10.0 / baud
+            if end > now:
+                break
+            self._wire_t = end
+            if n >= 0 and size + len(data) > n:
+                self._events[0] = [end, data[n - size:], baud]
+                data = data[:n - size]
+            else:
+                self._events.pop(0)
+            if not self._link_ok(baud):
+                self.stats["garbled_bytes"] += len(data)
+                data = bytes(self.rnd.getrandbits(8) | 0x80 for i in range(len(data)))
+            out.append(data)
+            size += len(data)
+        if not out:
+            return None
+        data = b"".join(out)
+        if self.drop_rate:
+            kept = bytearray()
+            for b in data:
+                if self.rnd.random() < self.drop_rate:
+                    self.stats["dropped_bytes"] += 1
+                else:
+                    kept.append(b)
+            data = bytes(kept)
+        return data or None
+
+    def any(self):
+        now = self.clock()
+        n = 0
+        wire_t = self._wire_t
+        for t, data, baud in self._events:
+            wire_t = max(t, wire_t) + len(data) * 10.0 / baud
+            if wire_t > now:
+                break
+            n += len(data)
+        return n
+
+    def init(self, baud, *args, **kwargs):
+        # machine.UART.init() on K210 side
+        self.host_baud = baud
+
+    # ---- test control ----
+
+    def reset(self, boot_time=0.3):
+        # module reset by pin, back to default baud, connection lost
+        now = self.clock()
+        self.baud = self.default_baud
+        self.mqtt = False
+        self._in = b""
+        self._events = []
+        self._busy_until = now + boot_time
+        self._reply("ready", now + boot_time)
+
+    def send_control(self, params, at=None):
+        # cloud sends a control message, return its id
+        msg_id = len(self.downlinks)
+        payload = json.dumps({"method": "control", "clientToken": "clientToken-{}".format(msg_id), "params": params},
+                             separators=(",", ":"))
+        t = self.clock() if at is None else at
+        self.downlinks.append(t)
+        self._urc(self._rcvpub(payload), t)
+        return msg_id
+
+    def drop_link(self, duration):
+        # server connection lost, can't reconnect for `duration` s
+        now = self.clock()
+        self.link_down_until = now + duration
+        if self.mqtt:
+            self.mqtt = False
+            self._urc("+TCMQTTDISCON,-1", now)
+
+    # ---- internal ----
+
+    def _on_cmd(self, line, t):
+        if not line:
+            return
+        self.stats["cmds"] += 1
+        verb = line.split("=", 1)[0]
+        start = max(t, self._busy_until)
+        done = start + self.latency.get(verb, 0.01)
+        self._busy_until = done
+        if self.echo:
+            self._reply(line, start)
+        fail = self.fail_rate and self.rnd.random() < self.fail_rate
+        if fail:
+            self.stats["fails"] += 1
+            if verb == "AT+TCMQTTPUB":
+                self.stats["pub_fails"] += 1
+            self._reply(FAIL_REPLY.get(verb, "ERROR"), done)
+            return
+        handler = None
+        if verb.startswith("AT+"):
+            handler = getattr(self, "_cmd_" + verb[3:].replace("?", "_query").lower(), None)
+        if verb == "AT" or verb.startswith("ATE"):
+            if verb.startswith("ATE"):
+                self.echo = verb == "ATE1"
+            self._reply("OK", done)
+        elif handler:
+            handler(line, done)
+        else:
+            self._reply("ERROR", done)
+
+    def _cmd_cifsr(self, line, t):
+        ip = self.ip if self.ip else "0.0.0.0"
+        self._reply('+CIFSR:STAIP,"{}"\r\n+CIFSR:STAMAC,"{}"\r\n\r\nOK'.format(ip, self.mac), t)
+
+    def _cmd_tcdevinfoset(self, line, t):
+        args = self._args(line)
+        self.product_key, self.device_name = args[1], args[2]
+        self._reply("OK\r\n+TCDEVINFOSET:OK", t)
+
+    def _cmd_tcprdinfoset(self, line, t):
+        args = self._args(line)
+        self.product_key, self.device_name = args[1], args[3]
+        self._reply("OK\r\n+TCPRDINFOSET:OK", t)
+
+    def _cmd_tcdevreg(self, line, t):
+        self._reply("OK\r\n+TCDEVREG:OK", t)
+
+    def _cmd_tcmqttconn(self, line, t):
+        if not self.ip or t < self.link_down_until:
+            self._reply("OK\r\n+TCMQTTCONN:FAIL,202", t)
+            return
+        self.mqtt = True
+        self._reply("OK\r\n+TCMQTTCONN:OK", t)
+
+    def _cmd_tcmqttsub(self, line, t):
+        self._reply("OK\r\n+TCMQTTSUB:OK" if self.mqtt else "+TCMQTTSUB:FAIL", t)
+
+    def _cmd_tcmqttdisconn(self, line, t):
+        self.mqtt = False
+        self._reply("OK", t)
+
+    def _cmd_tcmqttstate_query(self, line, t):
+        self._reply("+TCMQTTSTATE:{}\r\nOK".format(1 if self.mqtt else 0), t)
+
+    def _cmd_tcstartsmart(self, line, t):
+        self._reply("OK\r\n+TCSTARTSMART:WIFI_CONNECT_SUCCESS", t)
+
+    def _cmd_tcrestore(self, line, t):
+        self.product_key = self.device_name = None
+        self._reply("OK", t)
+
+    def _cmd_uart_cur(self, line, t):
+        self._reply("OK", t)
+        # following bytes are sent at the new baud rate, not saved to flash
+        self.baud = int(self._args(line)[0])
+
+    def _cmd_tcmqttpub(self, line, t):
+        if not self.mqtt:
+            self.stats["pub_fails"] += 1
+            self._reply(FAIL_REPLY["AT+TCMQTTPUB"], t)
+            return
+        self.stats["pubs"] += 1
+        self._reply("OK", t)
+        self._reply("+TCMQTTPUB:OK", t + self.cloud_latency)
+        payload = line.split(',1,"', 1)[1][:-1].replace('\\"', '"').replace('\\,', ',')
+        try:
+            token = json.loads(payload)["clientToken"]
+        except Exception:
+            return
+        reply = json.dumps({"method": "report_reply", "clientToken": token, "code": 0, "status": "success"},
+                           separators=(",", ":"))
+        self._urc(self._rcvpub(reply), t + self.cloud_latency * 1.5)
+
+    def _rcvpub(self, payload):
+        topic = "$thing/down/property/{}/{}".format(self.product_key, self.device_name)
+        return '+TCMQTTRCVPUB:"{}",{},"{}"'.format(topic, len(payload), payload)
+
+    def _args(self, line):
+        return [a.strip('"') for a in line.split("=", 1)[1].split(",")]
+
+    def _reply(self, text, t):
+        self._emit((text + "\r\n").encode(), t)
+
+    def _urc(self, text, t):
+        if self.mqtt or not text.startswith("+TCMQTTRCVPUB"):
+            self._emit((text + "\r\n").encode(), t)
+
+    def _emit(self, data, t):
+        # bytes are serialized on the wire at baud rate when read
+        self.stats["bytes_out"] += len(data)
+        i = len(self._events)
+        while i > 0 and self._events[i - 1][0] > t:
+            i -= 1
+        self._events.insert(i, [t, data, self.baud])
+
+    def _link_ok(self, baud):
+        return baud == self.host_baud and baud <= self.max_baud
+
+
+class Reset_Pin:
+    # stands for the GPIO of the module reset pin, for Explorer_AT.wifi_reset()
+    def __init__(self, sim):
+        self.sim = sim
+        self._value = 1
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        if v and not self._value:
+            self.sim.reset()
+        self._value = v
@@ -0,0 +1,162 @@
+# Compare the line parser based Explorer_AT._cmd with the old
+# accumulate-and-rescan implementation on recorded AT replies. Short replies
+# cost more CPU with the parser (command queue and ring overhead), it wins on
+# long replies in many reads and while waiting for a reply, where the old
+# _cmd spins on uart.read()
+#
+#   python3 bench_at_parser.py -n 200
+#   python3 bench_at_parser.py --delay 0.5 --waits 4
+import argparse
+import contextlib
+import io
+import time
+
+import host
+from explorer import Explorer_AT
+
+
+class Replay_UART:
+    # None in chunks means one empty poll (no byte arrived yet)
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pos = 0
+        self.reads = 0
+
+    def rewind(self):
+        self.pos = 0
+        self.reads = 0
+
+    def read(self, n=-1):
+        self.reads += 1
+        if self.pos >= len(self.chunks):
+            return None
+        chunk = self.chunks[self.pos]
+        self.pos += 1
+        return chunk
+
+    def write(self, data):
+        return len(data)
+
+    def any(self):
+        return self.pos < len(self.chunks)
+
+
+class Timed_UART(Replay_UART):
+    # reply arrives `delay` s after rewind, nothing before, like a module busy
+    # with a slow command
+    def __init__(self, chunks, delay):
+        Replay_UART.__init__(self, chunks)
+        self.delay = delay
+        self._t = time.monotonic()
+
+    def rewind(self):
+        Replay_UART.rewind(self)
+        self._t = time.monotonic()
+
+    def read(self, n=-1):
+        if time.monotonic() - self._t < self.delay:
+            self.reads += 1
+            return None
+        return Replay_UART.read(self, n)
+
+
+def legacy_cmd(self, cmd, expected=[], fail_ack=["ERROR"], timeout=6):
+    # Explorer_AT._cmd before the line parser
+    cmd += "\r\n"
+    self.uart.read()
+    self.uart.write(cmd.encode())
+    ack = ""
+    t = time.ticks_ms()
+    while 1:
+        read = self.uart.read()
+        if read:
+            try:
+                read = read.decode()
+                ack += read
+            except Exception as e:
+                print("decode error: {}".format(read))
+            for msg in expected:
+                if msg in ack:
+                    return ack
+            for msg in fail_ack:
+                if msg in ack:
+                    break
+        if time.ticks_ms() - t > timeout * 1000:
+            break
+    raise Exception("cmd ack error: {}, ack: {}".format(cmd, ack))
+
+
+def split(data, size, idle=0):
+    chunks = [None]  # consumed by the flush read in _cmd
+    for i in range(0, len(data), size):
+        chunks.append(data[i:i + size])
+        chunks.extend([None] * idle)
+    return chunks
+
+
+def streams():
+    pub = 'AT+TCMQTTPUB="$thing/up/property/1WAN4M5NPX/device_01",1,"{\\"clientToken\\": \\"msgpub-token-000000000012\\"\\, \\"method\\": \\"report\\"\\, \\"params\\": {\\"pm2_5\\": 12\\, \\"pm1_0\\": 8\\, \\"pm10\\": 15}}"'
+    cifsr = b'AT+CIFSR\r\n+CIFSR:STAIP,"192.168.0.123"\r\n+CIFSR:STAMAC,"18:fe:34:de:a6:00"\r\n\r\nOK\r\n'
+    urc = b''.join(b'+TCMQTTRCVPUB:"$thing/down/property/1WAN4M5NPX/device_01",89,"{"method":"report_reply","clientToken":"msgpub-token-%012d","code":0,"status":"success"}"\r\n' % i for i in range(40))
+    streams = [
+        ("AT+CIFSR", "AT+CIFSR", ["OK"], ["ERROR"], split(cifsr, 16)),
+        ("slow TCMQTTPUB", pub, ["+TCMQTTPUB:OK"], ["ERROR"],
+            split(pub.encode() + b"\r\n\r\nOK\r\n", 32, idle=2) + [None] * 2000 + [b"+TCMQTTPUB:OK\r\n"]),
+        ("URC flood + TCMQTTPUB", pub, ["+TCMQTTPUB:OK"], ["ERROR"],
+            split(pub.encode() + b"\r\n\r\nOK\r\n" + urc + b"+TCMQTTPUB:OK\r\n", 64)),
+    ]
+    # long replies in 16 byte reads: the old _cmd joins and searches the whole
+    # reply again on every read, cost grows with the square of the length
+    for aps in (16, 64, 256):
+        cwlap = b"AT+CWLAP\r\n" + b"".join(
+            b'+CWLAP:(3,"ap-%03d",-%d,"18:fe:34:de:a6:%02x",6)\r\n' % (i, 40 + i % 50, i % 256) for i in range(aps))
+        streams.append(("AT+CWLAP {:.1f} KB".format(len(cwlap) / 1024), "AT+CWLAP", ["OK"], ["ERROR"],
+                        split(cwlap + b"\r\nOK\r\n", 16)))
+    return streams
+
+
+def wait_streams(delay):
+    # same reply after `delay` s of wall time, old _cmd spins on uart.read(),
+    # new one sleeps poll_interval ms between empty reads
+    cifsr = b'AT+CIFSR\r\n+CIFSR:STAIP,"192.168.0.123"\r\n+CIFSR:STAMAC,"18:fe:34:de:a6:00"\r\n\r\nOK\r\n'
+    return [
+        ("AT+CIFSR after {}ms".format(int(delay * 1000)), "AT+CIFSR", ["OK"], ["ERROR"], [None, cifsr]),
+    ]
+
+
+def run(explorer, cmd_func, cmd, expected, fail_ack, n):
+    reads = 0
+    t = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(n):
+            explorer.uart.rewind()
+            cmd_func(explorer, cmd, expected, fail_ack, timeout=60)
+            reads += explorer.uart.reads
+    return (time.process_time() - t) / n * 1000000, reads // n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AT reply parser benchmark")
+    parser.add_argument("-n", type=int, default=200, dest="n", help="runs per stream")
+    parser.add_argument("--delay", type=float, default=0.1, dest="delay", help="s, reply delay of the wait stream")
+    parser.add_argument("--waits", type=int, default=10, dest="waits", help="runs of the wait stream")
+    args = parser.parse_args()
+
+    # CPU time per command, replayed as fast as possible, no sleep
+    print("{:<24}{:>14}{:>14}{:>12}{:>12}".format("stream", "legacy us", "parser us", "legacy rd", "parser rd"))
+    for name, cmd, expected, fail_ack, chunks in streams():
+        explorer = Explorer_AT(Replay_UART(chunks), lambda msg: None)
+        explorer.poll_interval = 0
+        legacy = run(explorer, legacy_cmd, cmd, expected, fail_ack, args.n)
+        parser = run(explorer, Explorer_AT._cmd, cmd, expected, fail_ack, args.n)
+        print("{:<24}{:>14.1f}{:>14.1f}{:>12}{:>12}".format(name, legacy[0], parser[0], legacy[1], parser[1]))
+    # CPU time per command while waiting for the reply, default poll_interval
+    for name, cmd, expected, fail_ack, chunks in wait_streams(args.delay):
+        explorer = Explorer_AT(Timed_UART(chunks, args.delay), lambda msg: None)
+        legacy = run(explorer, legacy_cmd, cmd, expected, fail_ack, args.waits)
+        parser = run(explorer, Explorer_AT._cmd, cmd, expected, fail_ack, args.waits)
+        print("{:<24}{:>14.1f}{:>14.1f}{:>12}{:>12}".format(name, legacy[0], parser[0], legacy[1], parser[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Heap allocations and time per report command, json.dumps + str.replace
+# (Explorer_AT.report_ before) against Report_Encoder
+#
+#   python3 bench_encoder.py -n 2000
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import host
+from at_encoder import Report_Encoder
+
+PRODUCT_KEY = "1WAN4M5NPX"
+DEVICE_NAME = "18_fe_34_de_a6_00"
+
+SAMPLES = [
+    {"pm2_5": 12, "pm1_0": 8, "pm10": 15},
+    {"hcho_ug": 31, "hcho_ppb": 25},
+    {"door": 1, "last_user": "No.3"},
+    {"light": True, "temp": -3.25, "name": 'a "quoted", \\ value\n'},
+    {"temp": 3.14159, "hum": 0.1, "big": 1e20, "small": -2.5e-07, "third": 1 / 3},
+    {"name": "caf\u00e9 \u6e29\u5ea6 \U0001f600", "ctl": "\x01\x7f\b\f"},
+]
+
+
+def legacy_report_cmd(send_id, data):
+    data = json.dumps(data)
+    cmd = '{}"clientToken": "msgpub-token-{}", "method": "report", "params": {}{}'.format(
+         "{", "{:012d}".format(send_id),
+        data, "}"
+    )
+    cmd = cmd.replace('"', '\\"')
+    cmd = cmd.replace(',', '\\,')
+    cmd = 'AT+TCMQTTPUB="$thing/up/property/{}/{}",1,"{}"'.format(PRODUCT_KEY, DEVICE_NAME, cmd)
+    return (cmd + "\r\n").encode()
+
+
+def check(encoder):
+    # @return True if output is the same as the old code for every sample
+    same = True
+    for i, data in enumerate(SAMPLES):
+        old = legacy_report_cmd(i, data)
+        new = bytes(encoder.report(PRODUCT_KEY, DEVICE_NAME, i, data))
+        if old != new:
+            print("--[WARNING] output differs:\n  {}\n  {}".format(old, new))
+            same = False
+    return same
+
+
+def measure(func, n):
+    t = time.process_time()
+    for i in range(n):
+        func(i, SAMPLES[i % len(SAMPLES)])
+    used = time.process_time() - t
+    # heap used while building one command, on device use gc.mem_free() instead
+    tracemalloc.start()
+    peak = 0
+    for data in SAMPLES:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        func(0, data)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return used / n * 1000000, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="report encoder benchmark")
+    parser.add_argument("-n", type=int, default=2000, dest="n", help="reports to encode")
+    args = parser.parse_args()
+
+    encoder = Report_Encoder(1024)
+    if not check(encoder):
+        return 1
+    new = lambda i, data: encoder.report(PRODUCT_KEY, DEVICE_NAME, i, data)
+    print("{:<12}{:>12}{:>20}".format("encoder", "us/report", "peak heap bytes"))
+    for name, func in (("legacy", legacy_report_cmd), ("encoder", new)):
+        us, peak = measure(func, args.n)
+        print("{:<12}{:>12.1f}{:>20}".format(name, us, peak))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+# Run Explorer_AT and Conn_Manager against the ESP AT simulator and measure
+# publishes per second, downlink to on_msg latency and recovery time after
+# the server connection is lost
+#
+#   python3 bench_explorer.py --baud 115200 --pubs 200 --fail-rate 0.02
+#   python3 bench_explorer.py --uart-baud 921600 --pub-latency 0.002 --cloud-latency 0.02
+import argparse
+import contextlib
+import io
+import sys
+import time
+
+import host
+from at_sim import ESP_AT_Sim, Reset_Pin
+from explorer import Explorer_AT
+from conn_mgr import Conn_Manager
+
+PRODUCT_KEY = "1WAN4M5NPX"
+DEVICE_NAME = "device_01"
+DEVICE_KEY = "ZGV2aWNlX2tleQ=="
+
+
+class Bench:
+    def __init__(self, sim, loop_sleep):
+        self.sim = sim
+        self.loop_sleep = loop_sleep   # ms, sleep of the main loop on device
+        self.got = {}                  # downlink id: receive time
+        self.explorer = Explorer_AT(sim, self.on_msg)
+        self.explorer.report_debounce = 0
+        self.conn = Conn_Manager(self.explorer, PRODUCT_KEY, DEVICE_NAME, DEVICE_KEY)
+
+    def on_msg(self, msg):
+        token = msg.get("clientToken", "")
+        if msg.get("method") == "control" and token.startswith("clientToken-"):
+            self.got[int(token[12:])] = time.monotonic()
+
+    def step(self):
+        self.conn.run()
+        self.explorer.run()
+        if self.loop_sleep:
+            time.sleep_ms(self.loop_sleep)
+
+    def run_until(self, cond, timeout):
+        t = time.monotonic()
+        while not cond():
+            if time.monotonic() - t > timeout:
+                return False
+            self.step()
+        return True
+
+    def set_baud(self, baud):
+        pin = Reset_Pin(self.sim)
+        self.explorer.wifi_reset(pin)
+        return self.explorer.set_baud(baud, pin)
+
+    def connect(self):
+        t = time.monotonic()
+        if not self.run_until(self.conn.connected, 120):
+            raise Exception("connect timeout")
+        return time.monotonic() - t
+
+    def publishes(self, n):
+        explorer = self.explorer
+        result = {"ok": 0, "fail": 0}
+
+        def on_ack(ok, ack):
+            result["ok" if ok else "fail"] += 1
+
+        sent = [0]
+
+        def done():
+            # leave room for retries of the publishes in flight
+            while sent[0] < n and len(explorer.queue) < explorer.queue_max - explorer.window - 1:
+                explorer.report_({"light": sent[0] % 2, "pm2_5": sent[0]}, callback=on_ack)
+                sent[0] += 1
+            return result["ok"] + result["fail"] >= n
+
+        t = time.monotonic()
+        self.run_until(done, n * 10)
+        return time.monotonic() - t, result["ok"], result["fail"]
+
+    def downlinks(self, n):
+        latency = []
+        for i in range(n):
+            msg_id = self.sim.send_control({"light": i % 2})
+            if self.run_until(lambda: msg_id in self.got, 5):
+                latency.append(self.got[msg_id] - self.sim.downlinks[msg_id])
+        return latency
+
+    def recovery(self, down):
+        # time from server reachable again to subscribed
+        self.sim.drop_link(down)
+        up_t = self.sim.link_down_until
+        self.run_until(lambda: not self.conn.connected(), 5)
+        if not self.run_until(self.conn.connected, down + 120):
+            return None
+        return time.monotonic() - up_t
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Explorer_AT benchmark with simulated ESP AT firmware")
+    parser.add_argument("--baud", type=int, default=115200, dest="baud", help="module default baud")
+    parser.add_argument("--uart-baud", type=int, default=0, dest="uart_baud", help="change to baud by AT+UART_CUR")
+    parser.add_argument("--max-baud", type=int, default=4000000, dest="max_baud", help="link fails over this baud")
+    parser.add_argument("--pub-latency", type=float, default=0.03, dest="pub_latency", help="s, AT+TCMQTTPUB to OK")
+    parser.add_argument("--cloud-latency", type=float, default=0.08, dest="cloud_latency", help="s, OK to +TCMQTTPUB:OK")
+    parser.add_argument("--drop-rate", type=float, default=0, dest="drop_rate", help="probability of a dropped byte")
+    parser.add_argument("--fail-rate", type=float, default=0, dest="fail_rate", help="probability of ERROR/FAIL reply")
+    parser.add_argument("--pubs", type=int, default=200, dest="pubs")
+    parser.add_argument("--downlinks", type=int, default=100, dest="downlinks")
+    parser.add_argument("--down", type=float, default=3, dest="down", help="s, server unreachable time")
+    parser.add_argument("--recoveries", type=int, default=3, dest="recoveries")
+    parser.add_argument("--window", type=int, default=4, dest="window", help="reports waiting for report_reply")
+    parser.add_argument("--loop-sleep", type=int, default=2, dest="loop_sleep", help="ms, main loop sleep")
+    parser.add_argument("--seed", type=int, default=1, dest="seed")
+    args = parser.parse_args()
+
+    sim = ESP_AT_Sim(baud=args.baud, latency={"AT+TCMQTTPUB": args.pub_latency}, cloud_latency=args.cloud_latency,
+                     drop_rate=args.drop_rate, fail_rate=args.fail_rate, seed=args.seed, max_baud=args.max_baud)
+    bench = Bench(sim, args.loop_sleep)
+    bench.explorer.window = args.window
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        if args.uart_baud:
+            bench.set_baud(args.uart_baud)
+        connect_t = bench.connect()
+        used, ok, fail = bench.publishes(args.pubs)
+        latency = bench.downlinks(args.downlinks)
+        recovery = [bench.recovery(args.down) for i in range(args.recoveries)]
+
+    print("uart baud: {}, connect: {:.3f}s".format(bench.explorer.baud, connect_t))
+    print("publish: {} ok, {} fail, {:.1f} publish/s".format(ok, fail, ok / used if used else 0))
+    rtt = bench.explorer.rtt_stats
+    print("report rtt: min {}ms, mean {:.1f}ms, max {}ms, retry {}, lost {}, dropped {}".format(
+        rtt["min"], rtt["sum"] / rtt["count"] if rtt["count"] else 0, rtt["max"], rtt["retry"], rtt["lost"],
+        rtt["dropped"]))
+    # every publish is replied, lost after retries or dropped before sent,
+    # every failed publish is retried or lost (reply timeouts too when bytes are dropped)
+    reconciled = ok == rtt["count"] and fail == rtt["lost"] + rtt["dropped"] and (
+        args.drop_rate or rtt["retry"] + rtt["lost"] == sim.stats["pub_fails"])
+    print("reconcile: ok {} + lost {} + dropped {} = {}, retry {} + lost {} = publish fails {}: {}".format(
+        ok, rtt["lost"], rtt["dropped"], args.pubs, rtt["retry"], rtt["lost"], sim.stats["pub_fails"],
+        "OK" if reconciled else "FAIL"))
+    print("downlink: {}/{} received, latency mean {:.1f}ms, p95 {:.1f}ms, max {:.1f}ms".format(
+        len(latency), args.downlinks, sum(latency) / len(latency) * 1000 if latency else 0,
+        percentile(latency, 0.95) * 1000, max(latency) * 1000 if latency else 0))
+    print("recovery after {}s down: {}".format(
+        args.down, ", ".join("timeout" if t is None else "{:.2f}s".format(t) for t in recovery)))
+    for line in bench.explorer.metrics.lines():
+        print(line)
+    print("parser: dropped {}, truncated {}, framer dropped {}, sim: {}".format(
+        bench.explorer.parser.dropped, bench.explorer.parser.truncated, bench.explorer.framer.dropped, sim.stats))
+    return 0 if reconciled else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
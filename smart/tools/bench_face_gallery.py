@@ -0,0 +1,160 @@
+# Face_Gallery against the old Face_Recog loop (compare every feature into a
+# list, then a second pass for the max) with synthetic int8 features: every
+# user has a random identity vector, queries are noisy copies of enrolled users
+# or strangers. Reports compares and time per query and top-1 agreement with
+# the exact search (NumPy reference when numpy is installed). Also checks that
+# of two similar users over the threshold the better one is returned, in
+# either storage order.
+#
+#   python3 bench_face_gallery.py --users 500 --queries 200
+import argparse
+import random
+import struct
+import sys
+import time
+
+import host
+from face_gallery import Face_Gallery
+from face_gallery_ref import face_compare, Numpy_Gallery
+
+
+def make_feature(rnd, base, noise):
+    values = []
+    for v in base:
+        v = int(v + rnd.gauss(0, noise))
+        values.append(max(-128, min(127, v)))
+    return struct.pack("{}b".format(len(values)), *values)
+
+
+def legacy_search(features, feature):
+    scores = []
+    for j in range(len(features)):
+        scores.append(face_compare(features[j], feature))
+    max_score = 0
+    index = 0
+    for k in range(len(scores)):
+        if max_score < scores[k]:
+            max_score = scores[k]
+            index = k
+    return max_score, index
+
+
+def exact_search(features, feature):
+    best = (0, 0)
+    for j in range(len(features)):
+        score = face_compare(features[j], feature)
+        if score > best[0]:
+            best = (score, j)
+    return best
+
+
+class Counter:
+    def __init__(self):
+        self.n = 0
+
+    def __call__(self, a, b):
+        self.n += 1
+        return face_compare(a, b)
+
+
+def check_similar(rnd, dim, noise):
+    # query near user "a", twin "b" also over threshold: a must win, stored
+    # first or last, flat and indexed. @return True if ok
+    base = [rnd.gauss(0, 40) for d in range(dim)]
+    a = make_feature(rnd, base, 2)
+    b = make_feature(rnd, base, 6)
+    query = make_feature(rnd, base, 1)
+    if not face_compare(a, query) > face_compare(b, query) > 85:
+        return None
+    others = [make_feature(rnd, [rnd.gauss(0, 40) for d in range(dim)], noise) for i in range(70)]
+    for order in (("b", "a"), ("a", "b")):
+        features = {"a": a, "b": b}
+        for users in ([], others):
+            gallery = Face_Gallery(face_compare, threshold=85)
+            gallery.set(list(order) + ["x"] * len(users), [features[name] for name in order] + users)
+            name, score = gallery.match(query)
+            if name != "a":
+                return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="face gallery search benchmark")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=192, help="feature length")
+    parser.add_argument("--noise", type=float, default=12, help="noise of a query against its user")
+    parser.add_argument("--strangers", type=float, default=0.2, help="part of queries not enrolled")
+    parser.add_argument("--probe", type=int, default=2)
+    parser.add_argument("-k", type=int, default=5, dest="k")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    bases = [[rnd.gauss(0, 40) for d in range(args.dim)] for i in range(args.users)]
+    names = ["No.{}".format(i + 1) for i in range(args.users)]
+    features = [make_feature(rnd, base, args.noise) for base in bases]
+    queries = []
+    for i in range(args.queries):
+        if rnd.random() < args.strangers:
+            queries.append(make_feature(rnd, [rnd.gauss(0, 40) for d in range(args.dim)], 0))
+        else:
+            queries.append(make_feature(rnd, bases[rnd.randrange(args.users)], args.noise))
+    exact = [exact_search(features, q) for q in queries]
+
+    t = time.process_time()
+    for q in queries:
+        legacy_search(features, q)
+    legacy_t = (time.process_time() - t) / len(queries)
+
+    print("{:<22}{:>12}{:>12}{:>10}".format("search", "compares/q", "ms/query", "top-1 ok"))
+    print("{:<22}{:>12}{:>12.2f}{:>10}".format("legacy 2 pass", args.users, legacy_t * 1000, "100%"))
+    counter = Counter()
+    gallery = Face_Gallery(counter, threshold=85, probe=args.probe)
+    t = time.process_time()
+    gallery.set(names, features)
+    build_t = time.process_time() - t
+    modes = (
+        ("1 pass, top-1", dict(coarse=False)),
+        ("1 pass, top-{}".format(args.k), dict(coarse=False, k=args.k)),
+        ("indexed, top-1", dict()),
+        ("indexed, top-{}".format(args.k), dict(k=args.k)),
+    )
+    for name, kwargs in modes:
+        counter.n = 0
+        ok = 0
+        t = time.process_time()
+        for i in range(len(queries)):
+            best = gallery.search(queries[i], **kwargs)
+            # a match must agree with exact search, a stranger must stay under threshold
+            if exact[i][0] > gallery.threshold:
+                ok += best and best[0][1] == exact[i][1]
+            else:
+                ok += not best or best[0][0] <= gallery.threshold
+        used = (time.process_time() - t) / len(queries)
+        print("{:<22}{:>12.1f}{:>12.2f}{:>9.1f}%".format(name, counter.n / len(queries), used * 1000,
+                                                        ok * 100.0 / len(queries)))
+    print("index: {} groups, build {:.0f}ms".format(len(gallery.centroids), build_t * 1000))
+    similar = [check_similar(rnd, args.dim, args.noise) for i in range(20)]
+    tested = [r for r in similar if r is not None]
+    similar_ok = all(tested)
+    print("similar users: best one returned in {}/{} cases: {}".format(
+        sum(tested), len(tested), "OK" if similar_ok else "FAIL"))
+
+    try:
+        ref = Numpy_Gallery(features)
+    except ImportError:
+        print("numpy not installed, no reference")
+        return 0 if similar_ok else 1
+    t = time.process_time()
+    ok = 0
+    for i in range(len(queries)):
+        best = ref.search(queries[i], k=args.k)
+        ok += best[0][1] == exact[i][1] or exact[i][0] <= gallery.threshold
+    used = (time.process_time() - t) / len(queries)
+    print("{:<22}{:>12}{:>12.3f}{:>9.1f}%".format("numpy reference", args.users, used * 1000, ok * 100.0 / len(queries)))
+    return 0 if similar_ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+# Time per frame and heap used by checksums, the old one frame per read()
+# decoders (PMS7003._decode, WS_H3._decode before) against Frame_Codec.
+# The legacy decoders get exactly one frame per read, the codec gets the
+# same frames back to back, split at random points
+#
+#   python3 bench_frame_codec.py -n 20000
+import argparse
+import random
+import struct
+import time
+import tracemalloc
+
+import host
+from frames import pms7003_frame, ws_h3_passive, split
+from frame_codec import Frame_Codec, sum16_be, neg_sum8
+import pms7003
+import ws_h3
+
+
+def legacy_pms7003(raw_data):
+    data = struct.unpack(">HHHHHHHHHHHHHHBBH", raw_data)
+    if data[0] == 0x424d:
+        parity = sum(list(raw_data)[:-2]) % 0xffff
+        if parity != data[16]:
+            return None
+        data = dict(zip(pms7003.KEYS, data[2:-1]))
+    return data
+
+
+def legacy_ws_h3(raw_data):
+    data = struct.unpack(">BBHHHB", raw_data)
+    if data[0] == 0xFF:
+        parity = (~(sum(list(raw_data[1:-1])) % 256) + 1) % 256
+        if parity != data[5]:
+            return None
+        data = dict(zip(ws_h3.PASSIVE_KEYS, data[1:-1]))
+    return data
+
+
+def legacy_sum_pms7003(raw_data):
+    return sum(list(raw_data)[:-2]) % 0xffff
+
+
+def legacy_sum_ws_h3(raw_data):
+    return (~(sum(list(raw_data[1:-1])) % 256) + 1) % 256
+
+
+def run_legacy(decode, frames):
+    n = 0
+    for frame in frames:
+        if decode(frame):
+            n += 1
+    return n
+
+
+def run_codec(spec, chunks):
+    codec = Frame_Codec(spec, 128)
+    n = 0
+    for chunk in chunks:
+        for frame in codec.frames(chunk):
+            n += 1
+    return n
+
+
+def checksum_peak(func, frame):
+    # heap used by one checksum, on device use gc.mem_free() instead
+    buf = bytearray(frame)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    func(buf)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sensor frame codec benchmark")
+    parser.add_argument("-n", type=int, default=20000, dest="n", help="frames per sensor")
+    parser.add_argument("--seed", type=int, default=1, dest="seed")
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    sensors = (
+        ("pms7003", pms7003.FRAME, legacy_pms7003, legacy_sum_pms7003, lambda b: sum16_be(b, 0, len(b)),
+         [pms7003_frame([rnd.randint(0, 999) for i in range(12)]) for i in range(args.n)]),
+        ("ws_h3", ws_h3.FRAME, legacy_ws_h3, legacy_sum_ws_h3, lambda b: neg_sum8(b, 0, len(b)),
+         [ws_h3_passive(rnd.randint(0, 999), rnd.randint(0, 999)) for i in range(args.n)]),
+    )
+    print("{:<10}{:<8}{:>10}{:>10}{:>22}".format("sensor", "decoder", "frames", "us/frame", "checksum heap bytes"))
+    for name, spec, legacy, legacy_sum, new_sum, frames in sensors:
+        chunks = split(b"".join(frames), rnd, 64)
+        t = time.process_time()
+        n = run_legacy(legacy, frames)
+        used = time.process_time() - t
+        print("{:<10}{:<8}{:>10}{:>10.2f}{:>22}".format(name, "legacy", n, used / args.n * 1000000,
+                                                       checksum_peak(legacy_sum, frames[0])))
+        t = time.process_time()
+        n = run_codec(spec, chunks)
+        used = time.process_time() - t
+        print("{:<10}{:<8}{:>10}{:>10.2f}{:>22}".format(name, "codec", n, used / args.n * 1000000,
+                                                       checksum_peak(new_sum, frames[0])))
+
+
+if __name__ == "__main__":
+    main()
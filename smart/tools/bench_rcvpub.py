@@ -0,0 +1,107 @@
+# Flood Explorer_AT with back-to-back +TCMQTTRCVPUB control messages split
+# at random points, check every message is delivered once and in order,
+# payloads have non ASCII chars, bare "\n" and empty lines. With --short,
+# some messages follow a frame whose <len> is 1-64 bytes too long, then
+# OK/ERROR/+TCMQTTDISCON lines, which must reach the pending command
+#
+#   python3 bench_rcvpub.py -n 5000
+#   python3 bench_rcvpub.py -n 5000 --short 0.1
+import argparse
+import contextlib
+import io
+import random
+import sys
+import time
+
+import host
+from explorer import Explorer_AT, PRIO_SYNC
+from bench_at_parser import Replay_UART
+
+TOPIC = "$thing/down/property/1WAN4M5NPX/device_01"
+# more params, <len> counts bytes: UTF-8, bare "\n" and empty lines in payload
+EXTRA = ("", "", ',"name":"\u6e29\u5ea6 caf\u00e9"', ',\n"light2":1', ',\r\n\r\n"light2":0\n', ',"name":"\u00e9"\r\n')
+
+
+def make_stream(n, seed, short=0.0):
+    # return chunks, bytes, short frames and lines cutting them
+    rnd = random.Random(seed)
+    data = []
+    size = 0
+    shorts = 0
+    cuts = {"OK": 0, "ERROR": 0, "+TCMQTTDISCON": 0}
+    ends = []   # a read ends after every cut line, the next command is sent by then
+    for i in range(n):
+        frames = []
+        if rnd.random() < short:
+            payload = b'{"method":"control","clientToken":"short-%d"}' % i
+            frames.append(b'+TCMQTTRCVPUB:"%s",%d,"%s"\r\n' % (TOPIC.encode(), len(payload) + rnd.randint(1, 64), payload))
+            shorts += 1
+            cut = rnd.choice((None, "OK", "ERROR", "+TCMQTTDISCON"))
+            if cut:
+                frames.append(cut.encode() + b"\r\n")
+                cuts[cut] += 1
+                ends.append(size + sum(len(f) for f in frames))
+        payload = '{"method":"control","clientToken":"clientToken-%d","params":{"light":%d,"door":%d%s}}' % (
+            i, i % 2, rnd.randint(0, 1), rnd.choice(EXTRA))
+        payload = payload.encode()
+        frames.append(b'+TCMQTTRCVPUB:"%s",%d,"%s"\r\n' % (TOPIC.encode(), len(payload), payload))
+        if rnd.random() < 0.1:
+            frames.append(b"+TCMQTTRECONNECTING\r\n+TCMQTTRECONNECTED\r\n")
+        for f in frames:
+            data.append(f)
+            size += len(f)
+    data = b"".join(data)
+    ends.append(len(data))
+    chunks = []
+    pos = 0
+    for end in ends:
+        while pos < end:
+            step = min(rnd.randint(1, 512), end - pos)
+            chunks.append(data[pos:pos + step])
+            pos += step
+    return chunks, len(data), shorts, cuts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="downlink framer throughput")
+    parser.add_argument("-n", type=int, default=5000, dest="n", help="control messages")
+    parser.add_argument("--seed", type=int, default=1, dest="seed")
+    parser.add_argument("--short", type=float, default=0.0, dest="short",
+                        help="rate of short frames before a message")
+    args = parser.parse_args()
+
+    chunks, size, shorts, cuts = make_stream(args.n, args.seed, args.short)
+    got = []
+    acks = {"OK": 0, "ERROR": 0, "+TCMQTTDISCON": 0}
+
+    def on_ack(ok, ack):
+        # the line that finished the command, URCs may come before it
+        line = ack.split("\r\n")[-2]
+        acks[line] = acks.get(line, 0) + 1
+
+    explorer = Explorer_AT(Replay_UART(chunks), lambda msg: got.append(msg["clientToken"]))
+    # one command waits for every OK/ERROR/+TCMQTTDISCON line that cuts a frame
+    for i in range(sum(cuts.values())):
+        explorer.cmd_async("AT", ["OK", "+TCMQTTDISCON"], ["ERROR"], timeout=3600,
+                           priority=PRIO_SYNC, callback=on_ack)
+    t = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        while explorer.uart.any():
+            explorer.poll()
+    used = time.process_time() - t
+
+    expected = ["clientToken-{}".format(i) for i in range(args.n)]
+    print("messages: {}, delivered: {}, in order: {}, dropped frames: {}".format(
+        args.n, len(got), got == expected, explorer.framer.dropped))
+    if shorts:
+        print("short frames: {}, cut by {}, acks: {}".format(shorts, cuts, acks))
+    ok = got == expected and explorer.framer.dropped == shorts and acks == cuts
+    print("{:.0f} msg/s, {:.2f} MB/s, {:.1f} us/msg".format(
+        args.n / used, size / used / 1000000, used / args.n * 1000000))
+    if not ok:
+        print("FAIL")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,43 @@
+# Host side scorers for Face_Gallery and the NumPy reference of a gallery search.
+# Features are int8 vectors as returned by kpu.face_encode, the score is the
+# cosine similarity * 100 like kpu.face_compare.
+import math
+
+
+def face_compare(a, b):
+    # pure Python stand-in of kpu.face_compare, a/b: bytes-like int8
+    a = memoryview(a).cast("b")
+    b = memoryview(b).cast("b")
+    dot = 0
+    na = 0
+    nb = 0
+    for i in range(len(a)):
+        x = a[i]
+        y = b[i]
+        dot += x * y
+        na += x * x
+        nb += y * y
+    if not na or not nb:
+        return 0.0
+    return dot / math.sqrt(na * nb) * 100
+
+
+class Numpy_Gallery:
+    # exact search: one matrix product of the whole gallery, then top k
+    def __init__(self, features):
+        import numpy as np
+        self.np = np
+        m = np.array([np.frombuffer(f, dtype=np.int8) for f in features], dtype=np.float32)
+        norms = np.linalg.norm(m, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self.m = m / norms
+
+    def search(self, feature, k=1):
+        np = self.np
+        q = np.frombuffer(feature, dtype=np.int8).astype(np.float32)
+        norm = np.linalg.norm(q)
+        scores = self.m @ (q / (norm or 1)) * 100
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(i)) for i in top]
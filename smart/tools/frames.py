@@ -0,0 +1,56 @@
+# Build PMS7003 and WS_H3 frames for the frame codec benchmark and fuzz test
+import struct
+
+
+def pms7003_frame(values, version=0x91, err_code=0):
+    # values: 12 words, pm1.0 ... num10um
+    body = struct.pack(">HH12H", 0x424d, 28, *values) + bytes([version, err_code])
+    return body + struct.pack(">H", sum(body) & 0xFFFF)
+
+
+def pms7003_ack(cmd, data):
+    body = struct.pack(">HHBB", 0x424d, 4, cmd, data)
+    return body + struct.pack(">H", sum(body) & 0xFFFF)
+
+
+def ws_h3_sum(body):
+    return (~sum(body[1:]) + 1) & 0xFF
+
+
+def ws_h3_passive(ug_m3, ppb):
+    body = struct.pack(">BBHHH", 0xFF, 0x86, ug_m3, 0, ppb)
+    return body + bytes([ws_h3_sum(body)])
+
+
+def ws_h3_active(value, value_range=2000):
+    body = struct.pack(">BBBBHH", 0xFF, 0x17, 0x04, 0x00, value, value_range)
+    return body + bytes([ws_h3_sum(body)])
+
+
+class Fake_UART:
+    # returns the chunks in order, one chunk every read()
+    def __init__(self, chunks=None):
+        self.chunks = list(chunks or [])
+        self.written = []
+
+    def any(self):
+        return len(self.chunks[0]) if self.chunks else 0
+
+    def read(self, n=-1):
+        if not self.chunks:
+            return None
+        return self.chunks.pop(0)
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        return len(data)
+
+
+def split(data, rnd, max_chunk):
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rnd.randint(1, max_chunk)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
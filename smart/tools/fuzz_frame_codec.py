@@ -0,0 +1,170 @@
+# Fuzz the PMS7003 and WS_H3 drivers with valid frames mixed with garbage,
+# truncated frames, bit flips and fake headers, split at random points.
+# Replays the corpus in corpus/<sensor>/ first, file name ends with the count
+# of frames expected, e.g. garbage_prefix-2.bin
+#
+#   python3 fuzz_frame_codec.py -n 2000
+#   python3 fuzz_frame_codec.py --write-corpus
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+
+import host
+from frames import pms7003_frame, pms7003_ack, ws_h3_passive, ws_h3_active, Fake_UART, split
+from pms7003 import PMS7003
+from ws_h3 import WS_H3
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+
+def pms_valid(rnd):
+    return pms7003_frame([rnd.randint(0, 0xFFFF) for i in range(12)])
+
+
+def ws_valid(rnd):
+    if rnd.random() < 0.5:
+        return ws_h3_passive(rnd.randint(0, 3000), rnd.randint(0, 3000))
+    return ws_h3_active(rnd.randint(0, 3000))
+
+
+SENSORS = {
+    # name: (driver class, valid frame maker, header)
+    "pms7003": (PMS7003, pms_valid, b"\x42\x4d"),
+    "ws_h3": (WS_H3, ws_valid, b"\xff"),
+}
+
+
+def make_stream(rnd, valid, header, frames):
+    # @return stream bytes, valid frames planted
+    out = []
+    planted = []
+    for i in range(frames):
+        kind = rnd.random()
+        if kind < 0.15:
+            out.append(bytes(rnd.getrandbits(8) for i in range(rnd.randint(1, 40))))
+        elif kind < 0.25:
+            out.append(valid(rnd)[:rnd.randint(1, 8)])                  # truncated
+        elif kind < 0.3:
+            frame = bytearray(valid(rnd))
+            frame[rnd.randint(len(header), len(frame) - 1)] ^= 1 << rnd.randint(0, 7)
+            out.append(bytes(frame))                                     # bad checksum
+        elif kind < 0.35:
+            out.append(header * rnd.randint(1, 3))                       # fake headers
+        frame = valid(rnd)
+        out.append(frame)
+        planted.append(frame)
+    return b"".join(out), planted
+
+
+def run_driver(cls, chunks):
+    got = []
+    uart = Fake_UART(chunks)
+    driver = cls(uart, got.append)
+    driver.data_mode_active = True
+    with contextlib.redirect_stdout(io.StringIO()):
+        while uart.any():
+            driver.run()
+        # idle poll, gives out a frame held for a possible inner frame
+        driver.run()
+    return got, driver.codec.stats
+
+
+def write_corpus():
+    rnd = random.Random(0)
+    cases = {
+        "pms7003": [
+            ("clean", pms_valid(rnd) + pms_valid(rnd), 2),
+            ("garbage_prefix", b"\x00\x42\x13\x42" + pms_valid(rnd), 1),
+            ("truncated_then_valid", pms_valid(rnd)[:20] + pms_valid(rnd), 1),
+            ("bad_length", b"\x42\x4d\xff\xff" + pms_valid(rnd), 1),
+            ("bad_checksum", pms_valid(rnd)[:-1] + b"\x00" + pms_valid(rnd), 1),
+            ("ack_and_data", pms7003_ack(0xe1, 0) + pms_valid(rnd), 1),
+            ("header_in_data", pms7003_frame([0x424d] * 12) + pms7003_frame([0x4d42] * 12), 2),
+        ],
+        "ws_h3": [
+            ("clean", ws_h3_passive(100, 80) + ws_h3_active(50), 2),
+            ("garbage_prefix", b"\x01\x02\xff\x86" + ws_h3_passive(10, 8), 1),
+            ("truncated_then_valid", ws_h3_passive(10, 8)[:5] + ws_h3_passive(11, 9), 1),
+            ("bad_checksum", ws_h3_active(7)[:-1] + b"\x00" + ws_h3_active(7), 1),
+            ("header_in_data", ws_h3_passive(0xff, 0xffff) + ws_h3_active(0xff00), 2),
+        ],
+    }
+    for sensor in cases:
+        path = os.path.join(CORPUS_DIR, sensor)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name, data, count in cases[sensor]:
+            with open(os.path.join(path, "{}-{}.bin".format(name, count)), "wb") as f:
+                f.write(data)
+    print("corpus written to", CORPUS_DIR)
+
+
+def replay_corpus(sensor, cls, rnd):
+    path = os.path.join(CORPUS_DIR, sensor)
+    if not os.path.exists(path):
+        return 0
+    fails = 0
+    for name in sorted(os.listdir(path)):
+        with open(os.path.join(path, name), "rb") as f:
+            data = f.read()
+        expected = int(name[:-4].rsplit("-", 1)[1])
+        for max_chunk in (1, 3, len(data)):
+            got, stats = run_driver(cls, split(data, rnd, max_chunk))
+            if len(got) != expected:
+                print("[FAIL] {}/{} chunk {}: {} frames, expected {}".format(sensor, name, max_chunk, len(got), expected))
+                fails += 1
+    return fails
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sensor frame codec fuzz test")
+    parser.add_argument("-n", type=int, default=500, dest="n", help="random streams per sensor")
+    parser.add_argument("--frames", type=int, default=50, dest="frames", help="valid frames per stream")
+    parser.add_argument("--seed", type=int, default=1, dest="seed")
+    parser.add_argument("--write-corpus", action="store_true", dest="write_corpus")
+    args = parser.parse_args()
+
+    if args.write_corpus:
+        write_corpus()
+        return
+    rnd = random.Random(args.seed)
+    fails = 0
+    for sensor in SENSORS:
+        cls, valid, header = SENSORS[sensor]
+        fails += replay_corpus(sensor, cls, rnd)
+        planted_n = 0
+        missed = 0
+        extra = 0
+        totals = {}
+        for i in range(args.n):
+            stream, planted = make_stream(rnd, valid, header, args.frames)
+            try:
+                got, stats = run_driver(cls, split(stream, rnd, 64))
+            except Exception as e:
+                print("[FAIL] {} exception {}: {}".format(sensor, e, stream.hex()))
+                fails += 1
+                continue
+            planted_n += len(planted)
+            # every planted frame should be found in order, garbage may decode too (8 bit checksum)
+            expected = [run_driver(cls, [frame])[0][0] for frame in planted]
+            matched = 0
+            for data in got:
+                if matched < len(expected) and data == expected[matched]:
+                    matched += 1
+            missed += len(expected) - matched
+            extra += len(got) - matched
+            for key in stats:
+                totals[key] = totals.get(key, 0) + stats[key]
+        print("{}: planted {}, missed {}, extra {}, stats {}".format(sensor, planted_n, missed, extra, totals))
+        if planted_n and missed > planted_n * 0.01:
+            print("[FAIL] {} missed too many frames".format(sensor))
+            fails += 1
+    if fails:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
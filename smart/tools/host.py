@@ -0,0 +1,71 @@
+# Make the modules in smart/ importable on a Linux box with CPython,
+# only for the host side tools and benchmarks in this directory
+import sys
+import os
+import time
+import re
+import struct
+import binascii
+import io
+import json
+
+SMART_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SMART_DIR not in sys.path:
+    sys.path.insert(0, SMART_DIR)
+
+_t0 = time.monotonic()
+
+
+def ticks_ms():
+    return int((time.monotonic() - _t0) * 1000)
+
+
+def ticks_us():
+    return int((time.monotonic() - _t0) * 1000000)
+
+
+def ticks_diff(a, b):
+    return a - b
+
+
+def ticks_add(a, b):
+    return a + b
+
+
+def sleep_ms(ms):
+    if ms > 0:
+        time.sleep(ms / 1000.0)
+
+
+def sleep_us(us):
+    if us > 0:
+        time.sleep(us / 1000000.0)
+
+
+for _name, _func in (("ticks_ms", ticks_ms), ("ticks_us", ticks_us), ("ticks_diff", ticks_diff),
+                     ("ticks_add", ticks_add), ("sleep_ms", sleep_ms), ("sleep_us", sleep_us)):
+    if not hasattr(time, _name):
+        setattr(time, _name, _func)
+
+
+class _ure:
+    # '.' of ure matches new line too
+    @staticmethod
+    def match(pattern, string):
+        return re.match(pattern, string, re.DOTALL)
+
+    @staticmethod
+    def search(pattern, string):
+        return re.search(pattern, string, re.DOTALL)
+
+    @staticmethod
+    def compile(pattern):
+        return re.compile(pattern, re.DOTALL)
+
+
+sys.modules.setdefault("ure", _ure)
+sys.modules.setdefault("ustruct", struct)
+sys.modules.setdefault("ubinascii", binascii)
+sys.modules.setdefault("uio", io)
+sys.modules.setdefault("ujson", json)
+sys.modules.setdefault("utime", time)
@@ -0,0 +1,237 @@
+# Replay a capture of uart_capture.Capture_Log into the unmodified drivers
+# (PMS7003, WS_H3, Explorer_AT), at real speed, accelerated, or as fast as
+# possible (--speed 0) to measure decoder throughput.
+# The channel name given to Capture_Log.wrap() selects the driver.
+#
+#   python3 replay_uart.py uart.cap                # real speed
+#   python3 replay_uart.py uart.cap --speed 20
+#   python3 replay_uart.py uart.cap --speed 0 --repeat 50
+#   python3 replay_uart.py --sample sample.cap     # write a synthetic capture
+import argparse
+import contextlib
+import io
+import random
+import time
+
+import host
+from uart_capture import Capture_Log, records, KIND_RX, KIND_TX, KIND_BAUD, KIND_NAME, KIND_LOST
+from frames import pms7003_frame, ws_h3_passive, Fake_UART
+from pms7003 import PMS7003
+from ws_h3 import WS_H3
+from explorer import Explorer_AT
+
+
+class Replay_UART:
+    # rx chunks come back at their captured time / speed, speed 0: one chunk every read()
+    def __init__(self, chunks, t0, speed):
+        self.chunks = chunks    # [(ticks_ms, data)]
+        self.t0 = t0
+        self.speed = speed
+        self.pos = 0
+        self.start = 0
+        self.written = 0
+
+    def rewind(self):
+        self.pos = 0
+        self.start = time.ticks_ms()
+
+    def done(self):
+        return self.pos >= len(self.chunks)
+
+    def _ready(self):
+        if self.pos >= len(self.chunks):
+            return 0
+        if not self.speed:
+            return 1
+        now = time.ticks_ms() - self.start
+        n = 0
+        while self.pos + n < len(self.chunks) and \
+                ((self.chunks[self.pos + n][0] - self.t0) & 0xFFFFFFFF) / self.speed <= now:
+            n += 1
+        return n
+
+    def any(self):
+        n = self._ready()
+        return sum(len(self.chunks[self.pos + i][1]) for i in range(n))
+
+    def read(self, *args):
+        n = self._ready()
+        if not n:
+            return None
+        data = b"".join(self.chunks[self.pos + i][1] for i in range(n))
+        self.pos += n
+        return data
+
+    def write(self, data):
+        self.written += len(data)
+        return len(data)
+
+    def init(self, baud, *args, **kw):
+        pass
+
+
+class Channel:
+    def __init__(self, name):
+        self.name = name
+        self.rx = []
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.lost = 0
+        self.bauds = []
+
+
+def load(path):
+    with open(path, "rb") as f:
+        raw = f.read()
+    channels = {}
+    t0 = None
+    for t, chan, kind, data in records(raw):
+        if t0 is None:
+            t0 = t
+        if kind == KIND_NAME:
+            channels[chan] = Channel(data.decode())
+            continue
+        c = channels.setdefault(chan, Channel("chan{}".format(chan)))
+        if kind == KIND_RX:
+            c.rx.append((t, data))
+            c.rx_bytes += len(data)
+        elif kind == KIND_TX:
+            c.tx_bytes += len(data)
+        elif kind == KIND_BAUD:
+            c.bauds.append(int.from_bytes(data[:4], "little"))
+        elif kind == KIND_LOST:
+            c.lost += int.from_bytes(data[:4], "little")
+    return channels, t0 or 0
+
+
+def make_driver(name, uart):
+    # @return step(), count of frames/messages, driver
+    count = [0]
+
+    def on_data(data):
+        count[0] += 1
+
+    if name.startswith("pms7003"):
+        driver = PMS7003(uart, on_data)
+        def step():
+            if uart.any():
+                driver.handle(uart.read())
+    elif name.startswith("ws_h3"):
+        driver = WS_H3(uart, on_data)
+        def step():
+            if uart.any():
+                driver.handle(uart.read())
+    elif name.startswith("explorer"):
+        driver = Explorer_AT(uart, on_data)
+        on_line = driver._on_line
+        def count_line(line):
+            count[0] += 1
+            on_line(line)
+        driver._on_line = count_line
+        def step():
+            driver.poll()
+    else:
+        return None, count, None
+    return step, count, driver
+
+
+def replay(channels, t0, speed, repeat):
+    items = []
+    for chan in sorted(channels):
+        c = channels[chan]
+        uart = Replay_UART(c.rx, t0, speed)
+        step, count, driver = make_driver(c.name, uart)
+        if not step:
+            print("--skip channel {}, no driver for it".format(c.name))
+            continue
+        items.append([c, uart, step, count, driver, 0.0])
+    for i in range(repeat):
+        for item in items:
+            item[1].rewind()
+        with contextlib.redirect_stdout(io.StringIO()):
+            while 1:
+                busy = False
+                for item in items:
+                    uart = item[1]
+                    if uart.done() and not uart.any():
+                        continue
+                    busy = True
+                    t = time.perf_counter()
+                    item[2]()
+                    item[5] += time.perf_counter() - t
+                if not busy:
+                    break
+                if speed:
+                    time.sleep_ms(1)
+    return items
+
+
+def make_sample(path, seconds, seed):
+    # synthetic capture: PMS7003 active every 1s, WS_H3 passive every 5s,
+    # +TCMQTTRCVPUB control messages, split like a UART buffer does
+    rnd = random.Random(seed)
+    base = time.ticks_ms
+    time.ticks_ms = lambda: 0
+    cap = Capture_Log(path, buf_size=64 * 1024, max_size=16 * 1024 * 1024)
+    events = []
+    for i in range(seconds):
+        values = [rnd.randint(0, 300) for j in range(12)]
+        events.append((i * 1000 + rnd.randint(0, 50), "pms7003", pms7003_frame(values)))
+        if i % 5 == 0:
+            events.append((i * 1000 + rnd.randint(0, 50), "ws_h3", ws_h3_passive(rnd.randint(0, 200), rnd.randint(0, 150))))
+        if i % 10 == 3:
+            payload = '{"method":"control","clientToken":"clientToken-%d","params":{"light":%d}}' % (i, i % 2)
+            msg = '+TCMQTTRCVPUB:"$thing/down/property/1WAN4M5NPX/device_01",{},"{}"\r\n'.format(len(payload), payload)
+            events.append((i * 1000 + rnd.randint(0, 999), "explorer", msg.encode()))
+    events.sort()
+    uarts = {}
+    for name in ("pms7003", "ws_h3", "explorer"):
+        uarts[name] = cap.wrap(Fake_UART(), name)
+    for t, name, data in events:
+        time.ticks_ms = lambda: t
+        pos = 0
+        while pos < len(data):
+            size = rnd.randint(1, len(data) - pos)
+            uarts[name].uart.chunks.append(data[pos:pos + size])
+            uarts[name].read()
+            pos += size
+    time.ticks_ms = base
+    cap.flush()
+    print("--wrote {}: {} chunks, {} bytes".format(path, cap.stats["chunks"], cap.size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay captured uart traffic into the drivers")
+    parser.add_argument("path", help="capture file")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 real time, 0 as fast as possible")
+    parser.add_argument("--repeat", type=int, default=1, help="replay times, for throughput")
+    parser.add_argument("--sample", action="store_true", help="write a synthetic capture to path and exit")
+    parser.add_argument("--seconds", type=int, default=600, help="length of --sample capture")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.sample:
+        make_sample(args.path, args.seconds, args.seed)
+        return
+    channels, t0 = load(args.path)
+    t = time.perf_counter()
+    items = replay(channels, t0, args.speed, args.repeat)
+    used = time.perf_counter() - t
+    print("{:<10}{:>10}{:>10}{:>8}{:>8}{:>10}{:>10}{:>10}".format(
+        "channel", "rx bytes", "tx bytes", "lost", "chunks", "frames", "us/frame", "MB/s"))
+    for c, uart, step, count, driver, busy in items:
+        frames = count[0]
+        print("{:<10}{:>10}{:>10}{:>8}{:>8}{:>10}{:>10.1f}{:>10.2f}".format(
+            c.name, c.rx_bytes, c.tx_bytes, c.lost, len(c.rx), frames,
+            busy / frames * 1000000 if frames else 0,
+            c.rx_bytes * args.repeat / busy / 1000000 if busy else 0))
+        if c.bauds:
+            print("  baud changes:", c.bauds)
+        codec = getattr(driver, "codec", None)
+        if codec:
+            print("  codec:", codec.stats)
+    print("replay {:.2f}s, speed {}".format(used, args.speed or "max"))
+
+
+if __name__ == "__main__":
+    main()
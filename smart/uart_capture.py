@@ -0,0 +1,142 @@
+import time
+import ustruct
+
+# Capture UART traffic of the drivers to a file, to replay on a PC
+# (tools/replay_uart.py). Chunks are kept in a fixed RAM buffer, only
+# run()/flush() write the file, so read()/write() of the drivers never wait
+# for flash/SD, if the buffer or the file is full chunks are dropped and a
+# LOST record tells how many bytes.
+#
+#   cap = Capture_Log("/sd/uart.cap")
+#   uart = cap.wrap(UART(UART.UART1, 9600), "pms7003")
+#   ... in main loop: cap.run()
+#
+# file:   b"UCAP" version(B), records
+# record: ticks_ms(I) channel(B) kind(B) length(H) data
+
+MAGIC = b"UCAP"
+VERSION = 1
+_HEAD = "<IBBH"
+_HEAD_LEN = 8
+
+KIND_RX = 0
+KIND_TX = 1
+KIND_BAUD = 2    # data: baud(I), uart.init() called
+KIND_NAME = 3    # data: channel name, first record of a channel
+KIND_LOST = 4    # data: bytes(I) dropped before this record
+
+
+class Capture_Log:
+    def __init__(self, path, buf_size=4096, max_size=512 * 1024, tx=True):
+        self.path = path
+        self.max_size = max_size        # file size limit
+        self.tx = tx                    # capture written bytes too
+        self._buf = bytearray(buf_size)
+        self._mv = memoryview(self._buf)
+        self._len = 0
+        self._lost = {}                 # channel: bytes dropped, not recorded yet
+        self._chans = 0
+        self._names = {}                # channel name: channel
+        with open(path, "wb") as f:
+            f.write(MAGIC + ustruct.pack("<B", VERSION))
+        self.size = len(MAGIC) + 1
+        self.stats = {
+            "chunks": 0,
+            "bytes": 0,
+            "lost": 0,
+            "flushes": 0,
+            "flush_ms_max": 0
+        }
+
+    def wrap(self, uart, name):
+        # one channel per name, wrapping again (init after error) keeps it
+        chan = self._names.get(name)
+        if chan is None:
+            chan = self._chans
+            self._chans += 1
+            self._names[name] = chan
+            self.add(chan, KIND_NAME, name.encode())
+        return UART_Capture(uart, self, chan)
+
+    def add(self, chan, kind, data):
+        lost = self._lost.get(chan, 0)
+        n = _HEAD_LEN + len(data)
+        if lost:
+            n += _HEAD_LEN + 4
+        if self._len + n > len(self._buf) or self.size + self._len + n > self.max_size:
+            self._lost[chan] = lost + len(data)
+            self.stats["lost"] += len(data)
+            return False
+        t = time.ticks_ms() & 0xFFFFFFFF
+        if lost:
+            self._put(t, chan, KIND_LOST, ustruct.pack("<I", lost))
+            self._lost[chan] = 0
+        self._put(t, chan, kind, data)
+        self.stats["chunks"] += 1
+        self.stats["bytes"] += len(data)
+        return True
+
+    def run(self):
+        # call in main loop, write file when buffer is half full
+        if self._len >= len(self._buf) // 2:
+            self.flush()
+
+    def flush(self):
+        if not self._len:
+            return
+        t = time.ticks_ms()
+        with open(self.path, "ab") as f:
+            f.write(self._mv[:self._len])
+        self.size += self._len
+        self._len = 0
+        t = time.ticks_ms() - t
+        self.stats["flushes"] += 1
+        if t > self.stats["flush_ms_max"]:
+            self.stats["flush_ms_max"] = t
+
+    def _put(self, t, chan, kind, data):
+        ustruct.pack_into(_HEAD, self._buf, self._len, t, chan, kind, len(data))
+        self._len += _HEAD_LEN
+        self._buf[self._len:self._len + len(data)] = data
+        self._len += len(data)
+
+
+class UART_Capture:
+    # same methods as machine.UART used by the drivers, pass through and record
+    def __init__(self, uart, log, chan):
+        self.uart = uart
+        self.log = log
+        self.chan = chan
+
+    def any(self):
+        return self.uart.any()
+
+    def read(self, *args):
+        data = self.uart.read(*args)
+        if data:
+            self.log.add(self.chan, KIND_RX, data)
+        return data
+
+    def write(self, data):
+        if self.log.tx:
+            self.log.add(self.chan, KIND_TX, data)
+        return self.uart.write(data)
+
+    def init(self, baud, *args, **kw):
+        self.log.add(self.chan, KIND_BAUD, ustruct.pack("<I", baud))
+        return self.uart.init(baud, *args, **kw)
+
+
+def records(raw):
+    # parse a capture file content, yield (ticks_ms, channel, kind, data),
+    # stop at a broken record (power lost while writing)
+    if raw[:len(MAGIC)] != MAGIC:
+        raise Exception("not a uart capture")
+    off = len(MAGIC) + 1
+    while off + _HEAD_LEN <= len(raw):
+        t, chan, kind, length = ustruct.unpack_from(_HEAD, raw, off)
+        off += _HEAD_LEN
+        if off + length > len(raw):
+            break
+        yield t, chan, kind, bytes(raw[off:off + length])
+        off += length
@@ -1,55 +1,81 @@
-from fpioa_manager import fm
-from board import board_info
-from machine import UART
 import ustruct
 import time
+from frame_codec import Frame_Spec, Frame_Codec, neg_sum8, sum8
+
+ACTIVE_KEYS = [
+    "name",
+    "unit",
+    "precision",
+    "value",
+    "range"
+    ]
+PASSIVE_KEYS = [
+    "cmd",
+    "value_ug_m3",
+    "rsv",
+    "value_ppb"
+    ]
+
+# 9 bytes, 0xFF, ..., checksum: two's complement of sum of byte 1~7
+# passive (read) ack's byte 1 is 0x86, active upload's is gas name, 0x17: CH2O
+FRAME = Frame_Spec(
+    header=b"\xFF",
+    size=9,
+    checksum=neg_sum8,
+    layouts=[
+        ("passive", (1, 0x86), ">BBHHHB", [None] + PASSIVE_KEYS + [None]),
+        ("active", (1, 0x17), ">BBBBHHB", [None] + ACTIVE_KEYS + [None])
+    ])
+
 
 class WS_H3:
     def __init__(self, uart_obj, on_data):
         self.uart = uart_obj
         self.on_data = on_data
         self.data_mode_active = None
-        self.active_keys = [
-            "name",
-            "unit",
-            "precision",
-            "value",
-            "range"
-            ]
-        self.passive_keys = [
-            "cmd",
-            "value_ug_m3",
-            "rsv",
-            "value_ppb"
-            ]
+        self.active_keys = ACTIVE_KEYS
+        self.passive_keys = PASSIVE_KEYS
+        self.codec = Frame_Codec(FRAME, 64)
 
 
     def run(self):
-        data = None
+        read_data = None
         if self.data_mode_active is None:
             # self.set_data_mode(active = True)
             self.data_mode_active = True
         elif self.data_mode_active:
             if self.uart.any():
                 read_data = self.uart.read()
-                data = self._decode_active(read_data)
-                if data["name"] == 0x17:
-                    data["name"] = "CH2O"
-                if data["unit"] == 0x04:
-                    data["unit"] = "ppb"
         else:
             read_data = self.read_passive()
-            data = self._decode_passive(read_data)
-        if data:
+        self.handle(read_data)
+
+    def handle(self, read_data):
+        # decode bytes read, send data to on_data, @return count of data frames
+        n = 0
+        for name, data in self.codec.frames(read_data):
+            if name == "active":
+                self._active_names(data)
+            n += 1
             if self.on_data:
                 self.on_data(data)
+        return n
+
+    def passive_cmd(self):
+        # request of passive read, the response is a passive frame
+        return b'\xFF\x01\x86\x00\x00\x00\x00\x00\x79'
+
+    def _active_names(self, data):
+        if data["name"] == 0x17:
+            data["name"] = "CH2O"
+        if data["unit"] == 0x04:
+            data["unit"] = "ppb"
 
     def read_passive(self):
-        cmd = b'\xFF\x01\x86\x00\x00\x00\x00\x00\x79'
-        return self._send_cmd(cmd)
+        return self._send_cmd(self.passive_cmd())
 
     def parity(self, raw_data):
-        parity = (~(sum(list(raw_data)) % 256) + 1) % 256
+        parity = (~sum8(raw_data, 0, len(raw_data)) + 1) & 0xFF
         return parity
 
     def _send_cmd(self, cmd, parity=False, read_len=9):
@@ -74,36 +100,26 @@ class WS_H3:
         print("ack:", ack)
         self.data_mode_active = active
     
-    def _decode_active(self, raw_data, ):
-        unpack_fmt = ">BBBBHHB",
-        keys = self.active_keys
-        parity_idx = 6
-        return self._decode(raw_data, unpack_fmt, keys, parity_idx)
+    def _decode_active(self, raw_data):
+        data = self._decode(raw_data, "active")
+        if data:
+            self._active_names(data)
+        return data
     
     def _decode_passive(self, raw_data):
-        unpack_fmt = ">BBHHHB"
-        keys = self.passive_keys
-        parity_idx = 5
-        return self._decode(raw_data, unpack_fmt, keys, parity_idx)
+        return self._decode(raw_data, "passive")
     
-    def _decode(self, raw_data, unpack_fmt, keys, parity_idx):
+    def _decode(self, raw_data, layout):
+        # decode frames in raw_data, @return data of the last `layout` frame or None
         data = None
-        print("raw data:", raw_data)
-        try:
-            data = ustruct.unpack(unpack_fmt,raw_data)
-        except Exception:
-            return None
-        if data[0] == 0xFF:
-            parity = self.parity(raw_data[1:-1])
-            if parity != data[parity_idx]:
-                print("check parity error: {}--{}".format(parity, data[parity_idx]))
-                return None
-            print("decode data:", data)
-            data = data[1:-1]
-            data = dict(zip(keys, data))
+        for name, values in self.codec.frames(raw_data, flush=True):
+            if name == layout:
+                data = values
         return data
 
 if __name__ == "__main__":
+    from fpioa_manager import fm
+    from machine import UART
     import lcd, image
 
     lcd.init()